@@ -1,7 +1,8 @@
 import logging as log
 import json
+import asyncio
 import httpx
-from typing import Any, Callable
+from typing import Any, Callable, Awaitable
 
 class FinamError(Exception):
     http: int
@@ -16,6 +17,45 @@ class FinamError(Exception):
     def __str__(self):
         return f"HTTP {self.http}, code: {self.code}, message: {self.message}"
 
+# Response handling shared by sync and async API
+
+def isTokenError(response: httpx.Response) -> bool:
+    # True if the request is to be repeated with a new token, raises on other errors
+    match response.status_code:
+        case 401:
+            log.debug(f"Unauthorized, trying to recover")
+            return True
+
+        case 500:
+            err = getError(response)
+            if err is None:
+                response.raise_for_status()
+
+            if err.code == 13:
+                log.debug(f"Token error to be recovered: {err.message}")
+                return True
+            raise err
+
+        case 400:
+            err = getError(response)
+            if err is None:
+                response.raise_for_status()
+
+            raise err
+
+    return False
+
+def getData(response: httpx.Response) -> Any:
+    response.raise_for_status()
+    return json.loads(response.text)
+
+def getError(response: httpx.Response) -> FinamError:
+    try:
+        err = json.loads(response.text)
+        return FinamError(http=response.status_code, code=err["code"], message=err.get("message"))
+    except (json.JSONDecodeError, TypeError):
+        return None
+
 class FinamApi:
     BASE_URL = "https://api.finam.ru/v1"
 
@@ -50,40 +90,11 @@ class FinamApi:
 
         response = perform()
 
-        match response.status_code:
-            case 401:
-                log.debug(f"Unauthorized, trying to recover")
-                self.__updateJwtToken()
-                response = perform()
-
-            case 500:
-                err = self.__getError(response)
-                if err is None:
-                    response.raise_for_status()
-
-                if err.code == 13:
-                    log.debug(f"Token error to be recovered: {err.message}")
-                    self.__updateJwtToken()
-                    response = perform()
-                else:
-                    raise err
-
-            case 400:
-                err = self.__getError(response)
-                if err is None:
-                    response.raise_for_status()
-
-                raise err
-
-        response.raise_for_status()
-        return json.loads(response.text)
+        if isTokenError(response):
+            self.__updateJwtToken()
+            response = perform()
 
-    def __getError(self, response: httpx.Response) -> FinamError:
-        try:
-            err = json.loads(response.text)
-            return FinamError(http=response.status_code, code=err["code"], message=err.get("message"))
-        except (json.JSONDecodeError, TypeError):
-            return None
+        return getData(response)
 
     def __updateJwtToken(self) -> None:
         log.debug("Updating token")
@@ -94,3 +105,68 @@ class FinamApi:
         
         data = json.loads(response.text)
         self.__jwtToken = data["token"]
+
+class AsyncFinamApi:
+    # Async counterpart of FinamApi, for many requests in flight over a single HTTP/2 connection
+
+    BASE_URL = FinamApi.BASE_URL
+
+    # Requests in flight at once, the rest wait for their turn
+    MAX_CONCURRENCY = 16
+
+    __http: httpx.AsyncClient
+    __semaphore: asyncio.Semaphore
+
+    __token: str
+    __jwtToken: str
+    __jwtLock: asyncio.Lock
+
+    def __init__(self, http: httpx.AsyncClient, token: str, maxConcurrency: int = None):
+        self.__http = http
+        self.__semaphore = asyncio.Semaphore(maxConcurrency or self.MAX_CONCURRENCY)
+        self.__token = token
+        self.__jwtToken = None
+        self.__jwtLock = asyncio.Lock()
+
+    async def get(self, url: str, params: dict[str, Any]) -> Any:
+        return await self.__call(lambda jwtToken: self.__get(url, params, jwtToken))
+
+    async def __get(self, url: str, params: dict[str, Any], jwtToken: str) -> httpx.Response:
+        url = f"{self.BASE_URL}/{url}"
+        return await self.__http.get(url, params=params, headers={"Authorization": jwtToken})
+
+    async def getAccountIds(self) -> list[str]:
+        data = await self.__call(self.__getAccountIds)
+        return data["account_ids"]
+
+    async def __getAccountIds(self, jwtToken: str) -> httpx.Response:
+        url = f"{self.BASE_URL}/sessions/details"
+        return await self.__http.post(url, json={"token": jwtToken})
+
+    async def __call(self, perform: Callable[[str], Awaitable[httpx.Response]]) -> Any:
+        async with self.__semaphore:
+            jwtToken = self.__jwtToken or await self.__updateJwtToken(None)
+
+            response = await perform(jwtToken)
+
+            if isTokenError(response):
+                jwtToken = await self.__updateJwtToken(jwtToken)
+                response = await perform(jwtToken)
+
+        return getData(response)
+
+    async def __updateJwtToken(self, staleToken: str | None) -> str:
+        # Requests failed with the same token renew it once, the rest of them take the renewed one
+        async with self.__jwtLock:
+            if self.__jwtToken != staleToken:
+                return self.__jwtToken
+
+            log.debug("Updating token")
+
+            url = f"{self.BASE_URL}/sessions"
+            response = await self.__http.post(url, json={"secret": self.__token})
+            response.raise_for_status()
+
+            data = json.loads(response.text)
+            self.__jwtToken = data["token"]
+            return self.__jwtToken
@@ -1,4 +1,4 @@
-import os
+import os, gzip
 import logging as log
 import json
 from typing import Any, Callable, IO
@@ -10,6 +10,12 @@ def fileNameWithTs(fileName: str) -> str:
     ts = datetime.now().strftime("%Y%m%d-%H%M%S")
     return f"{name}.{ts}{ext}"
 
+def openText(fileName: str, mode: str = "r", **kwargs) -> IO:
+    # Gzipped file is told by its extension
+    if fileName.endswith(".gz"):
+        return gzip.open(fileName, f"{mode}t", **kwargs)
+    return open(fileName, mode, **kwargs)
+
 def saveText(fileName: str, data: str) -> None:
     saveData(fileName, lambda f: f.write(data))
 
@@ -1,6 +1,6 @@
 import sys
 import logging as log
-from typing import Any, Iterable, Callable
+from typing import Any, Iterable, Iterator, Callable
 from datetime import date
 
 def getDateFromArgv(defaultDate: date = None) -> date:
@@ -49,6 +49,11 @@ def forEachSafely[T](items: Iterable[T], process: Callable[[T], bool | None], br
 
     return success
 
+def extendRange[T](bounds: tuple[T, T] | None, low: T, high: T) -> tuple[T, T]:
+    if bounds is None:
+        return low, high
+    return min(bounds[0], low), max(bounds[1], high)
+
 def toIterable(value: Any, scalars: type | Iterable[type] = None) -> Iterable:
     if value is None:
         return ()
@@ -60,3 +65,26 @@ def toIterable(value: Any, scalars: type | Iterable[type] = None) -> Iterable:
         return (value,)
 
     return value
+
+class StreamStats[T]:
+    # Count, min and max of items passing through a stream, gathered on the fly
+
+    count: int
+    min: T | None
+    max: T | None
+
+    def __init__(self, key: Callable[[T], Any] = None):
+        self.__key = key if key is not None else lambda item: item
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def track(self, items: Iterable[T]) -> Iterator[T]:
+        key = self.__key
+        for item in items:
+            if self.count == 0 or key(item) < key(self.min):
+                self.min = item
+            if self.count == 0 or key(item) > key(self.max):
+                self.max = item
+            self.count += 1
+            yield item
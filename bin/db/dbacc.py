@@ -1,7 +1,8 @@
 import logging as log
+from typing import Iterable
 
 from db.dbtools import DbTypes, ColumnDef, MergeMode
-from db.dbtools import dbMergeRow
+from db.dbtools import dbMergeRow, dbMergeRows
 
 class Accounts:
     BROKER = ColumnDef("broker", DbTypes.VARCHAR(15))
@@ -45,3 +46,20 @@ def dbInsertAccount(curs,
 
     row = {"broker": broker, "code": code, "name": name}
     return dbMergeRow(curs, "accounts", row, key=("broker", "code"), returning="id", mode=mergeMode)
+
+def dbInsertAccounts(curs,
+                     broker: str,
+                     codes: Iterable[str], *,
+                     update: bool = False) -> dict[str, int]:
+
+    rows = [(broker, code, f"{broker} {code}") for code in codes]
+    if not rows:
+        return {}
+
+    log.debug(f"Updating accounts: {", ".join(row[2] for row in rows)}")
+
+    mergeMode = MergeMode.MERGE if update else MergeMode.INSERT
+
+    cols = (Accounts.BROKER, Accounts.CODE, Accounts.NAME)
+    accountIds = dbMergeRows(curs, "accounts", rows, cols, key=("broker", "code"), returning="id", mode=mergeMode)
+    return {code: accountId for (_, code), accountId in accountIds.items()}
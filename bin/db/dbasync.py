@@ -0,0 +1,253 @@
+import logging as log
+from typing import Any, Iterable, AsyncIterator
+
+from contextlib import asynccontextmanager
+
+import psycopg
+
+from db.dbbase import DbParams, ColumnDef, MergeMode, LoadMethod
+from db.dbbase import toIterable, toColumnNames, bindMerge, bindMergeRow, tempTableSql, copyLines
+from db.dbbase import mergeSql, mergeRowSql, mergeRowResult, mergeRowsStaging, mergeRowsSql, mergeRowsReturningSql, mergeRowsResult
+
+# Async counterpart of dbtools on psycopg 3. Function names and arguments mirror dbtools,
+# so a task can move over by awaiting the same calls. Differences to keep in mind:
+# - use "async with conn.transaction()" for a transaction, as "async with conn" closes the connection;
+# - statements issued inside "async with dbPipeline(conn)" are sent without waiting for each reply,
+#   see dbMergeRowBatch; COPY is not available in pipeline mode, so load data outside of it.
+
+class DbAsyncConnection(psycopg.AsyncConnection):
+    params: DbParams = None
+    loadMethod: LoadMethod = LoadMethod.COPY
+    tempTables: dict[str, str] = None
+
+__COPY_BUFFER_SIZE = 65536
+
+async def dbConnect(params: DbParams) -> DbAsyncConnection:
+    log.info(f"Connecting to: postgresql://{params.host}:{params.port}/{params.dbname}")
+    conn = await DbAsyncConnection.connect(
+        host=params.host,
+        port=params.port,
+        dbname=params.dbname,
+        user=params.user,
+        password=params.password)
+
+    conn.params = params
+    conn.loadMethod = LoadMethod[params.loadMethod.upper()]
+    conn.tempTables = {}
+
+    # The driver prepares hot statements by itself, negative threshold disables it
+    conn.prepare_threshold = params.prepareThreshold if params.prepareThreshold >= 0 else None
+
+    async with conn.cursor() as curs:
+        await curs.execute("SELECT version()")
+        log.debug(f"Connected to: {(await curs.fetchone())[0]}")
+
+    # Otherwise "async with conn.transaction()" would make a savepoint in the transaction left open
+    await conn.rollback()
+
+    return conn
+
+@asynccontextmanager
+async def dbPipeline(conn) -> AsyncIterator[None]:
+    log.debug("Entering pipeline mode")
+    async with conn.pipeline():
+        yield
+    log.debug("Pipeline synced")
+
+@asynccontextmanager
+async def dbSavepoint(curs, name: str = "sp") -> AsyncIterator[None]:
+    await curs.execute(f"SAVEPOINT {name};")
+    try:
+        yield
+    except Exception:
+        log.debug(f"Rolling back to savepoint: {name}")
+        await curs.execute(f"ROLLBACK TO SAVEPOINT {name};")
+        raise
+    await curs.execute(f"RELEASE SAVEPOINT {name};")
+
+async def dbTempTable(curs, tableName: str, cols: Iterable[ColumnDef], onCommit: str = "DELETE ROWS") -> None:
+    tempTables = getattr(curs.connection, "tempTables", None)
+    sqls, sqlTable = tempTableSql(tableName, cols, onCommit, tempTables)
+
+    if sqlTable is not None and tempTables.get(tableName) == sqlTable:
+        log.debug(f"Reusing temp table: {tableName}")
+    else:
+        log.debug(f"Creating temp table: {tableName}")
+
+    # Extended protocol (and so pipeline mode) takes one statement per query
+    for sql in sqls:
+        log.debug(f"Query: {sql}")
+        await curs.execute(sql)
+
+    if sqlTable is not None:
+        tempTables[tableName] = sqlTable
+
+async def dbLoadData(curs, tableName: str, data: Iterable[Any], cols: Iterable[str | ColumnDef], method: LoadMethod = None) -> None:
+    if method is None:
+        method = getattr(curs.connection, "loadMethod", LoadMethod.COPY)
+
+    colNames = toColumnNames(cols)
+    sqlCols = ", ".join(colNames)
+
+    if method == LoadMethod.COPY:
+        log.debug(f"Copying data into table: {tableName}")
+
+        sql = f"COPY {tableName} ({sqlCols}) FROM STDIN"
+        log.debug(f"Query: {sql}")
+
+        async with curs.copy(sql) as copy:
+            parts, length = [], 0
+            for line in copyLines(data):
+                parts.append(line)
+                length += len(line)
+                if length >= __COPY_BUFFER_SIZE:
+                    await copy.write("".join(parts))
+                    parts, length = [], 0
+            if parts:
+                await copy.write("".join(parts))
+    elif method == LoadMethod.INSERT:
+        log.debug(f"Inserting data into table: {tableName}")
+
+        sqlValues = ", ".join("%s" for _ in colNames)
+        sql = f"INSERT INTO {tableName} ({sqlCols}) VALUES ({sqlValues})"
+        log.debug(f"Query: {sql}")
+
+        # Batched by the driver in pipeline mode
+        await curs.executemany(sql, data)
+    else:
+        raise Exception(f"Invalid load method: {method}")
+
+async def dbMerge(curs,
+                  targetTable: str,
+                  sourceTable: str, *,
+                  on: Iterable[str] | dict[str, Any],
+                  cols: Iterable[str | ColumnDef] | dict[str, Any] = None,
+                  params: Iterable[Any] = None,
+                  mode: MergeMode = None,
+                  bounds: dict[str, tuple[Any, Any]] = None) -> None:
+
+    log.debug(f"Merging into: {targetTable}, from: {sourceTable}")
+
+    on, cols, bounds, values = bindMerge(on, cols, params, bounds)
+
+    sql = mergeSql(targetTable, sourceTable, on, cols, mode, bounds)
+    if sql is None:
+        log.debug("Nothing to merge")
+        return
+
+    log.debug(f"Query: {sql}")
+
+    if values:
+        log.debug(f"Params: {values}")
+
+    await curs.execute(sql, values)
+    log.debug(f"Merge done")
+
+async def dbMergeRow(curs,
+                     targetTable: str,
+                     row: dict[str, Any] | Iterable[str], *,
+                     params: Iterable[Any] = None,
+                     key: Iterable[str],
+                     returning: Iterable[str] = None,
+                     mode: MergeMode = None) -> Any | None:
+
+    returning = tuple(toIterable(returning))
+
+    await __executeMergeRow(curs, targetTable, row, params, key, returning, mode)
+
+    retVals = None
+    if returning:
+        retVals = mergeRowResult(await curs.fetchone(), returning)
+        log.debug(f"Return: {retVals}")
+
+    log.debug(f"Row merged")
+    return retVals
+
+async def dbMergeRowBatch(conn,
+                          targetTable: str,
+                          rows: Iterable[dict[str, Any]], *,
+                          key: Iterable[str],
+                          returning: Iterable[str] = None,
+                          mode: MergeMode = None) -> list[Any | None]:
+
+    # Sends all the row merges in a pipeline, and only then reads the replies
+    log.debug(f"Merging row batch into: {targetTable}")
+
+    returning = tuple(toIterable(returning))
+
+    cursors = []
+    try:
+        async with dbPipeline(conn):
+            for row in rows:
+                curs = conn.cursor()
+                cursors.append(curs)
+                await __executeMergeRow(curs, targetTable, row, None, key, returning, mode)
+
+        retVals = []
+        for curs in cursors:
+            retVals.append(mergeRowResult(await curs.fetchone(), returning) if returning else None)
+    finally:
+        for curs in cursors:
+            await curs.close()
+
+    log.debug(f"Rows merged: {len(retVals)}")
+    return retVals
+
+async def dbMergeRows(curs,
+                      targetTable: str,
+                      rows: Iterable[Any],
+                      cols: Iterable[ColumnDef], *,
+                      key: Iterable[str],
+                      returning: Iterable[str] = None,
+                      mode: MergeMode = None) -> dict[Any, Any]:
+
+    log.debug(f"Merging rows into: {targetTable}")
+
+    cols = tuple(cols)
+    colNames = tuple(c.name for c in cols)
+    key = tuple(toIterable(key))
+    returning = tuple(toIterable(returning))
+
+    stagingTable, rows = mergeRowsStaging(targetTable, rows, colNames, key)
+
+    await dbTempTable(curs, stagingTable, cols)
+    await dbLoadData(curs, stagingTable, rows, cols)
+
+    sql = mergeRowsSql(targetTable, stagingTable, colNames, key, mode)
+    log.debug(f"Query: {sql}")
+
+    await curs.execute(sql)
+    log.debug(f"Rows merged: {curs.rowcount}")
+
+    if not returning:
+        return {}
+
+    sql = mergeRowsReturningSql(targetTable, stagingTable, key, returning)
+    log.debug(f"Query: {sql}")
+
+    await curs.execute(sql)
+
+    retVals = mergeRowsResult(await curs.fetchall(), key, returning)
+    log.debug(f"Returned {len(retVals)} rows")
+    return retVals
+
+async def __executeMergeRow(curs,
+                            targetTable: str,
+                            row: dict[str, Any] | Iterable[str],
+                            params: Iterable[Any] | None,
+                            key: Iterable[str],
+                            returning: tuple,
+                            mode: MergeMode) -> None:
+
+    log.debug(f"Merging row into: {targetTable}")
+
+    row, values = bindMergeRow(row, params)
+    key = tuple(toIterable(key))
+
+    sql = mergeRowSql(targetTable, row, key, returning, mode)
+    log.debug(f"Query: {sql}")
+
+    if values:
+        log.debug(f"Params: {values}")
+
+    await curs.execute(sql, values)
@@ -0,0 +1,317 @@
+import functools
+from typing import Any, Iterable, Iterator, Callable
+from typing import NamedTuple
+from enum import Enum
+from datetime import date, time, datetime
+
+from common.dtotools import ofmethod
+
+# Driver independent part of the DB layer, shared by sync (dbtools) and async (dbasync) backends
+
+@ofmethod
+class DbParams(NamedTuple):
+    # "postgresql", or "sqlite" with dbname as a database file path
+    engine: str = "postgresql"
+    host: str = "localhost"
+    port: int = 5432
+    dbname: str = "postgres"
+    user: str = None
+    password: str = None
+    loadMethod: str = "COPY"
+    prepareThreshold: int = 5
+    loadWorkers: int = 1
+    poolMinSize: int = 0
+    poolMaxSize: int = 4
+    poolTimeout: float = 30
+    poolCheckIdle: float = 60
+    poolReset: str = "ROLLBACK"
+    initScript: str = None
+
+class DbTypes:
+    VARCHAR = lambda n = None: "VARCHAR" if n is None else f"VARCHAR({n})"
+    BIGINT = "BIGINT"
+    DECIMAL = lambda s, p = None: f"DECIMAL({s})" if p is None else f"DECIMAL({s}, {p})"
+    TIMESTAMPTZ = "TIMESTAMP WITH TIME ZONE"
+
+class ColumnDef(NamedTuple):
+    name: str
+    type: str = DbTypes.VARCHAR
+
+    def __getattribute__(self, name: str) -> Any:
+        value = object.__getattribute__(self, name)
+        if name == "type" and callable(value):
+            value = value()
+        return value
+
+class SqlParam(NamedTuple):
+    placeholder: str = "%s"
+
+class SqlExpr(NamedTuple):
+    expr: str
+
+class MergeMode(Enum):
+    MERGE = 1
+    INSERT = 2
+    UPDATE = 3
+
+class LoadMethod(Enum):
+    COPY = 1
+    INSERT = 2
+
+__SQL_COLUMN = "COLUMN"
+__SQL_EXPR = "EXPR"
+__SQL_PARAM = "PARAM"
+
+__COPY_ESCAPES = str.maketrans({
+    "\\": "\\\\",
+    "\t": "\\t",
+    "\n": "\\n",
+    "\r": "\\r"
+})
+
+def toIterable(value: Any) -> Iterable:
+    if value is None:
+        value = ()
+    elif isinstance(value, (ColumnDef, str)) or not isinstance(value, Iterable):
+        value = (value,)
+    return value
+
+def toDict(value: Any, mapper: Callable) -> dict:
+    if not isinstance(value, dict):
+        value = {v: mapper(v) for v in toIterable(value)}
+    return value
+
+def toColumnNames(cols: Iterable[str | ColumnDef]) -> list[str]:
+    return [c.name if isinstance(c, ColumnDef) else c for c in toIterable(cols)]
+
+def bindRow(row: dict[str, Any], params: Iterator[Any], prefix: str = "") -> tuple[tuple, dict[str, Any]]:
+    # Splits row into a hashable SQL shape (used as SQL cache key) and bound values
+    shape, values = [], {}
+    for col, value in row.items():
+        placeholder = "%s"
+        if isinstance(value, SqlParam):
+            placeholder, value = value.placeholder, next(params)
+
+        if isinstance(value, ColumnDef):
+            shape.append((col, (__SQL_COLUMN, value.name)))
+        elif isinstance(value, SqlExpr):
+            shape.append((col, (__SQL_EXPR, value.expr)))
+        else:
+            name = f"{prefix}{col}"
+            shape.append((col, (__SQL_PARAM, placeholder.replace("%s", f"%({name})s"))))
+            values[name] = value
+
+    return tuple(shape), values
+
+def bindMerge(on: Iterable[str] | dict[str, Any],
+              cols: Iterable[str | ColumnDef] | dict[str, Any],
+              params: Iterable[Any],
+              bounds: dict[str, tuple[Any, Any]] = None) -> tuple[tuple, tuple, tuple, dict[str, Any]]:
+
+    params = iter(params or ())
+    on, onValues = bindRow(toDict(on, ColumnDef), params, "on_")
+
+    if not isinstance(cols, dict):
+        cols = {c: ColumnDef(c) for c in toColumnNames(cols)}
+    cols, colValues = bindRow(cols, params, "col_")
+
+    bounds, boundValues = bindBounds(bounds)
+
+    return on, cols, bounds, onValues | colValues | boundValues
+
+def bindBounds(bounds: dict[str, tuple[Any, Any]] | None) -> tuple[tuple, dict[str, Any]]:
+    # Inclusive value ranges of target columns, for the target scan to skip the rest (e.g. partitions)
+    shape, values = [], {}
+    for col, (fromValue, toValue) in (bounds or {}).items():
+        shape.append((col, f"%(bound_{col}_from)s", f"%(bound_{col}_to)s"))
+        values[f"bound_{col}_from"], values[f"bound_{col}_to"] = fromValue, toValue
+
+    return tuple(shape), values
+
+def boundsSql(bounds: tuple, tableAlias: str) -> str:
+    return "".join(f" AND {tableAlias}.{col} BETWEEN {fromSql} AND {toSql}" for col, fromSql, toSql in bounds)
+
+def bindMergeRow(row: dict[str, Any] | Iterable[str], params: Iterable[Any]) -> tuple[tuple, dict[str, Any]]:
+    return bindRow(toDict(row, lambda v: SqlParam()), iter(params or ()))
+
+def tempTableSql(tableName: str,
+                 cols: Iterable[ColumnDef],
+                 onCommit: str,
+                 tempTables: dict[str, str] | None) -> tuple[list[str], str | None]:
+
+    # Returns statements to run and, if the table is reusable, its definition to register after they succeed
+    sqlCols = ", ".join(f"{c.name} {c.type}" for c in cols)
+    sqlTable = f"TEMPORARY TABLE {tableName} ({sqlCols}) ON COMMIT {onCommit}"
+
+    if tempTables is None or onCommit.upper() == "DROP":
+        return [f"CREATE {sqlTable};"], None
+
+    if tempTables.get(tableName) == sqlTable:
+        # The table is still gone if the transaction it was created in was rolled back
+        return [f"CREATE {sqlTable.replace("TABLE", "TABLE IF NOT EXISTS", 1)};", f"DELETE FROM {tableName};"], sqlTable
+
+    return [f"DROP TABLE IF EXISTS pg_temp.{tableName};", f"CREATE {sqlTable};"], sqlTable
+
+def copyLines(data: Iterable[Any]) -> Iterator[str]:
+    for row in data:
+        yield "\t".join(__copyValue(v) for v in row) + "\n"
+
+def __copyValue(value: Any) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, str):
+        return value.translate(__COPY_ESCAPES)
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    return str(value)
+
+def shapeToSql(shape: tuple, tableAlias: str = None) -> dict[str, str]:
+    return {col: __fragmentToSql(fragment, tableAlias) for col, fragment in shape}
+
+def __fragmentToSql(fragment: tuple[str, str], tableAlias: str = None) -> str:
+    kind, value = fragment
+    if kind == __SQL_COLUMN and tableAlias is not None:
+        return f"{tableAlias}.{value}"
+    return value
+
+def mergeColumns(on: tuple, cols: tuple, mode: MergeMode, sourceAlias: str) -> tuple[dict[str, str], dict[str, str], dict[str, str]]:
+    # Returns SQL of the match condition, of inserted and of updated columns
+    on = shapeToSql(on, sourceAlias)
+    cols = shapeToSql(cols, sourceAlias)
+
+    onCols = {col.casefold() for col in on}
+    insert = on | {col: sql for col, sql in cols.items() if col.casefold() not in onCols}
+    update = cols
+
+    if mode == MergeMode.INSERT:
+        update = {}
+    elif mode == MergeMode.UPDATE:
+        insert = {}
+    elif mode is not None and mode != MergeMode.MERGE:
+        raise Exception(f"Invalid merge mode: {mode}")
+
+    return on, insert, update
+
+@functools.cache
+def mergeSql(targetTable: str, sourceTable: str, on: tuple, cols: tuple, mode: MergeMode, bounds: tuple = ()) -> str | None:
+    targetAlias, sourceAlias = "t", "s"
+
+    on, insert, update = mergeColumns(on, cols, mode, sourceAlias)
+    if not insert and not update:
+        return None
+
+    sqlOn = " AND ".join(f"{targetAlias}.{col} = {val}" for col, val in on.items())
+    sqlOn += boundsSql(bounds, targetAlias)
+    sql = (
+        f"MERGE INTO {targetTable} AS {targetAlias} " +
+        f"USING {sourceTable} AS {sourceAlias} " +
+        f"ON ({sqlOn})")
+
+    if insert:
+        sqlInsert = ", ".join(insert.keys())
+        sqlValues = ", ".join(insert.values())
+        sql += f" WHEN NOT MATCHED THEN INSERT ({sqlInsert}) VALUES ({sqlValues})"
+
+    if update:
+        sqlWhere = " OR ".join(f"{targetAlias}.{col} IS DISTINCT FROM {val}" for col, val in update.items())
+        sqlUpdate = ", ".join(f"{col} = {val}" for col, val in update.items())
+        sql += f" WHEN MATCHED AND ({sqlWhere}) THEN UPDATE SET {sqlUpdate}"
+
+    return sql + ";"
+
+@functools.cache
+def mergeRowSql(targetTable: str, row: tuple, key: tuple, returning: tuple, mode: MergeMode) -> str:
+    targetAlias = "t"
+
+    row = shapeToSql(row)
+
+    sqlInsert = ", ".join(row.keys())
+    sqlValues = ", ".join(row.values())
+
+    sql = f"INSERT INTO {targetTable} AS {targetAlias} ({sqlInsert}) VALUES ({sqlValues})"
+
+    if mode is None or mode == MergeMode.MERGE:
+        keySet = {col.casefold() for col in key}
+        update = [col for col in row.keys() if col.casefold() not in keySet]
+
+        sqlOnConflict = ", ".join(key)
+        sqlUpdate = ", ".join(f"{col} = EXCLUDED.{col}" for col in update)
+        sqlWhere = " OR ".join(f"{targetAlias}.{col} IS DISTINCT FROM EXCLUDED.{col}" for col in update)
+
+        sql += f" ON CONFLICT ({sqlOnConflict}) DO UPDATE SET {sqlUpdate} WHERE {sqlWhere}"
+    elif mode == MergeMode.INSERT:
+        sql += " ON CONFLICT DO NOTHING"
+    else:
+        raise Exception(f"Invalid or unsupported merge mode: {mode}")
+
+    if returning:
+        sqlReturning = ", ".join(returning)
+        sqlWhere = " AND ".join(f"{targetAlias}.{col} IS NOT DISTINCT FROM {row.get(col)}" for col in key)
+
+        sql = (
+            f"WITH q AS ({sql} RETURNING {sqlReturning}) " +
+            f"SELECT * FROM q UNION ALL " +
+            f"SELECT {sqlReturning} FROM {targetTable} AS {targetAlias} " +
+            f"WHERE {sqlWhere} AND NOT EXISTS (SELECT NULL FROM q)")
+
+    return sql + ";"
+
+def mergeRowResult(row: tuple | None, returning: tuple) -> Any | None:
+    if not returning:
+        return None
+    if len(returning) == 1:
+        return row[0]
+    return {col: row[i] for i, col in enumerate(returning)}
+
+def mergeRowsStaging(targetTable: str, rows: Iterable[Any], colNames: list[str], key: tuple) -> tuple[str, Iterable[Any]]:
+    # ON CONFLICT DO UPDATE refuses to touch the same row twice
+    keyIdx = [colNames.index(col) for col in key]
+    rows = {tuple(row[i] for i in keyIdx): row for row in rows}.values()
+
+    return f"{targetTable}_staging", rows
+
+@functools.cache
+def mergeRowsSql(targetTable: str, stagingTable: str, colNames: tuple, key: tuple, mode: MergeMode) -> str:
+    targetAlias = "t"
+
+    sqlCols = ", ".join(colNames)
+    # WHERE keeps ON CONFLICT from being parsed as a join constraint by SQLite
+    sql = f"INSERT INTO {targetTable} AS {targetAlias} ({sqlCols}) SELECT {sqlCols} FROM {stagingTable} WHERE true"
+
+    keySet = {col.casefold() for col in key}
+    update = [col for col in colNames if col.casefold() not in keySet]
+
+    if (mode is None or mode == MergeMode.MERGE) and update:
+        sqlOnConflict = ", ".join(key)
+        sqlUpdate = ", ".join(f"{col} = EXCLUDED.{col}" for col in update)
+        sqlWhere = " OR ".join(f"{targetAlias}.{col} IS DISTINCT FROM EXCLUDED.{col}" for col in update)
+
+        sql += f" ON CONFLICT ({sqlOnConflict}) DO UPDATE SET {sqlUpdate} WHERE {sqlWhere}"
+    elif mode is None or mode in (MergeMode.MERGE, MergeMode.INSERT):
+        sql += " ON CONFLICT DO NOTHING"
+    else:
+        raise Exception(f"Invalid or unsupported merge mode: {mode}")
+
+    return sql + ";"
+
+@functools.cache
+def mergeRowsReturningSql(targetTable: str, stagingTable: str, key: tuple, returning: tuple) -> str:
+    targetAlias, sourceAlias = "t", "s"
+
+    sqlKey = ", ".join(f"{sourceAlias}.{col}" for col in key)
+    sqlReturning = ", ".join(f"{targetAlias}.{col}" for col in returning)
+    sqlOn = " AND ".join(f"{targetAlias}.{col} = {sourceAlias}.{col}" for col in key)
+
+    return (
+        f"SELECT {sqlKey}, {sqlReturning} " +
+        f"FROM {stagingTable} AS {sourceAlias} " +
+        f"JOIN {targetTable} AS {targetAlias} ON ({sqlOn});")
+
+def mergeRowsResult(rows: Iterable[tuple], key: tuple, returning: tuple) -> dict[Any, Any]:
+    retVals = {}
+    for row in rows:
+        keyVals, vals = row[:len(key)], row[len(key):]
+        if len(key) == 1:
+            keyVals = keyVals[0]
+        retVals[keyVals] = mergeRowResult(vals, returning)
+    return retVals
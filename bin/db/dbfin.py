@@ -1,8 +1,16 @@
 import logging as log
-from typing import Iterable
+import hashlib
+import threading
+import itertools
+from typing import Any, Iterable, Iterator
+from typing import NamedTuple
+from queue import Queue
 
-from db.dbtools import DbTypes, ColumnDef, MergeMode
-from db.dbtools import dbTempTable, dbLoadData, dbMerge, dbMergeRow
+from common.tools import forEachSafely, extendRange, StreamStats
+
+from db.dbtools import DbTypes, ColumnDef, MergeMode, DbPool
+from db.dbtools import dbConnect, dbSavepoint, dbTempTable, dbLoadData, dbMerge, dbMergeRows
+from db import dbsqlite, dbasync
 
 class Assets:
     MARKET = ColumnDef("market", DbTypes.VARCHAR(15))
@@ -11,6 +19,8 @@ class Assets:
     UNIT = ColumnDef("unit", DbTypes.VARCHAR(15))
 
 class Trades:
+    ASSET_ID = ColumnDef("asset_id", DbTypes.BIGINT)
+    AGG_TYPE = ColumnDef("agg_type", DbTypes.VARCHAR(15))
     DT = ColumnDef("dt", DbTypes.TIMESTAMPTZ)
     O = ColumnDef("o", DbTypes.DECIMAL(20, 4))
     H = ColumnDef("h", DbTypes.DECIMAL(20, 4))
@@ -19,6 +29,19 @@ class Trades:
     V = ColumnDef("v", DbTypes.BIGINT)
     UNIT = ColumnDef("unit", DbTypes.VARCHAR(15))
 
+class AssetDef(NamedTuple):
+    market: str
+    code: str
+    name: str = None
+    unit: str = None
+
+class LoadFingerprints:
+    ASSET_ID = ColumnDef("asset_id", DbTypes.BIGINT)
+    AGG_TYPE = ColumnDef("agg_type", DbTypes.VARCHAR(15))
+    START_DT = ColumnDef("start_dt", DbTypes.TIMESTAMPTZ)
+    END_DT = ColumnDef("end_dt", DbTypes.TIMESTAMPTZ)
+    HASH = ColumnDef("hash", DbTypes.VARCHAR(64))
+
 class AggType:
     INTRADAY = "I"
     SNAPSHOT = "S"
@@ -33,17 +56,100 @@ def dbInsertAsset(curs,
                   unit: str = None, *,
                   update: bool = False) -> int:
 
-    if name is None:
-        name = f"{market} {code}"
-        if unit is not None:
-            name = f"{name}, {unit}"
+    assetIds = dbInsertAssets(curs, (AssetDef(market, code, name, unit),), update=update)
+    return assetIds[(market, code)]
+
+def dbInsertAssets(curs,
+                   assets: Iterable[AssetDef], *,
+                   update: bool = False) -> dict[tuple[str, str], int]:
+
+    cache = __getAssetCache(curs)
+
+    assetIds = {}
+    pending = []
+    for asset in assets:
+        asset = __namedAsset(asset)
+
+        key = (asset.market, asset.code)
+        cached = cache.get(key)
+        if cached is not None and (not update or (cached.name, cached.unit) == (asset.name, asset.unit)):
+            assetIds[key] = cached.id
+        else:
+            pending.append(asset)
+
+    log.debug(f"Resolved {len(assetIds)} assets from cache, {len(pending)} to be updated")
+
+    if pending:
+        log.debug(f"Updating assets: {", ".join(a.name for a in pending)}")
+
+        mergeMode = MergeMode.MERGE if update else MergeMode.INSERT
+
+        # Merged rows are evicted rather than cached, since the transaction may still be rolled back
+        for asset in pending:
+            cache.pop((asset.market, asset.code), None)
+
+        cols = (Assets.MARKET, Assets.CODE, Assets.NAME, Assets.UNIT)
+        assetIds |= dbMergeRows(curs, "assets", pending, cols, key=("market", "code"), returning="id", mode=mergeMode)
 
-    log.debug(f"Updating asset: {name}")
+    return assetIds
 
+def dbInsertAssetsSafely(curs,
+                         assets: Iterable[AssetDef], *,
+                         update: bool = False) -> dict[tuple[str, str], int]:
+
+    # Keeps the transaction usable when some asset fails: it is logged and left out of the result,
+    # so that only the trades of it fail later on the lookup of its id
+    assets = list(assets)
+    try:
+        with dbSavepoint(curs, "assets"):
+            return dbInsertAssets(curs, assets, update=update)
+    except Exception:
+        log.exception(f"Failed to insert assets, retrying one by one")
+
+    assetIds = {}
+
+    def insertAsset(asset: AssetDef) -> None:
+        with dbSavepoint(curs, "asset"):
+            assetIds.update(dbInsertAssets(curs, (asset,), update=update))
+
+    forEachSafely(assets, insertAsset)
+    return assetIds
+
+async def dbInsertAssetsAsync(conn,
+                              assets: Iterable[AssetDef], *,
+                              update: bool = False) -> dict[tuple[str, str], int]:
+
+    # Counterpart of dbInsertAssetsSafely on a dbasync connection, committed by itself. The upserts are sent
+    # in one pipeline, and when some of them fails, which aborts the rest, they are retried one by one
+    assets = [__namedAsset(asset) for asset in assets]
+    rows = [asset._asdict() for asset in assets]
     mergeMode = MergeMode.MERGE if update else MergeMode.INSERT
 
-    row = {"market": market, "code": code, "name": name, "unit": unit}
-    return dbMergeRow(curs, "assets", row, key=("market", "code"), returning="id", mode=mergeMode)
+    log.debug(f"Updating assets in a pipeline: {len(assets)}")
+
+    # Bypassing the cache, so the assets are evicted from it
+    if __assetCache is not None:
+        for asset in assets:
+            __assetCache.pop((asset.market, asset.code), None)
+
+    try:
+        async with conn.transaction():
+            ids = await dbasync.dbMergeRowBatch(conn, "assets", rows, key=("market", "code"), returning="id", mode=mergeMode)
+        return {(asset.market, asset.code): id for asset, id in zip(assets, ids)}
+    except Exception:
+        log.exception(f"Failed to insert assets, retrying one by one")
+
+    assetIds = {}
+    async with conn.transaction():
+        async with conn.cursor() as curs:
+            for asset, row in zip(assets, rows):
+                try:
+                    async with dbasync.dbSavepoint(curs, "asset"):
+                        assetIds[(asset.market, asset.code)] = await dbasync.dbMergeRow(curs, "assets", row, key=("market", "code"),
+                                                                                        returning="id", mode=mergeMode)
+                except Exception:
+                    log.exception(f"Failed to process: {asset}")
+    return assetIds
 
 def dbInsertTrades(curs,
                    assetId: int,
@@ -64,4 +170,389 @@ def dbInsertTrades(curs,
     cols = (Trades.DT,) + valueCols
     dbTempTable(curs, "temp", cols)
     dbLoadData(curs, "temp", data, cols)
-    dbMerge(curs, "trades", "temp", on={"asset_id": assetId, "agg_type": aggType, "dt": ColumnDef("dt")}, cols=cols, mode=mergeMode)
+
+    curs.execute("SELECT MIN(dt), MAX(dt) FROM temp;")
+    dtRange = curs.fetchone()
+    if dtRange[0] is None:
+        log.debug("No trades to load")
+        return
+
+    dbEnsureTradesPartitions(curs, *dtRange)
+    dbMerge(curs, "trades", "temp", on={"asset_id": assetId, "agg_type": aggType, "dt": ColumnDef("dt")}, cols=cols, mode=mergeMode,
+            bounds={"dt": dtRange})
+
+def dbEnsureTradesPartitions(curs, startDt: Any, endDt: Any) -> None:
+    # Trades are partitioned by dt in PostgreSQL only, partitions have to exist before merge to be pruned by it
+    if dbsqlite.isSqlite(curs):
+        return
+
+    log.debug(f"Ensuring trades partitions from: {startDt}, to: {endDt}")
+    curs.execute("SELECT ensure_trades_partitions(%s, %s);", (startDt, endDt))
+
+class TradesStage:
+    # Staging table and trades merge on a single connection
+
+    STAGING_TABLE = "trades_staging"
+    WINDOWS_TABLE = "trades_windows"
+
+    curs: Any
+    cols: tuple[ColumnDef]
+    valueCols: tuple[ColumnDef]
+    mergeMode: MergeMode
+    assetIds: set[int]
+
+    # Off for workers, whose partitions are created by the caller beforehand
+    ensurePartitions: bool
+
+    # (asset_id, agg_type, start_dt, end_dt) of staged windows -> hash, None if not fingerprinted
+    windows: dict[tuple[int, str, Any, Any], str | None]
+
+    # Min and max dt of all staged trades, for the merge to touch only partitions within
+    dtRange: tuple[Any, Any] | None
+
+    def __init__(self, curs, valueCols: tuple[ColumnDef], mergeMode: MergeMode, ensurePartitions: bool = True):
+        self.curs = curs
+        self.valueCols = valueCols
+        self.cols = (Trades.ASSET_ID, Trades.AGG_TYPE, Trades.DT) + valueCols
+        self.mergeMode = mergeMode
+        self.assetIds = set()
+        self.ensurePartitions = ensurePartitions
+        self.windows = {}
+        self.dtRange = None
+
+        dbTempTable(curs, self.STAGING_TABLE, self.cols)
+
+    def add(self, assetId: int, aggType: str, data: Iterable, hash: str | None = None) -> bool:
+        # Streams data into staging, returns False if nothing was staged
+        log.debug(f"Staging trades for asset id: {assetId}")
+
+        rows = ((assetId, aggType) + tuple(row) for row in data)
+        stats = StreamStats(key=lambda row: row[2])
+
+        with dbSavepoint(self.curs, "trades_add"):
+            dbLoadData(self.curs, self.STAGING_TABLE, stats.track(rows), self.cols)
+
+        if not stats.count:
+            return False
+
+        self.assetIds.add(assetId)
+        self.dtRange = extendRange(self.dtRange, stats.min[2], stats.max[2])
+
+        # Repeated adds of the same window are fingerprinted as a whole
+        window = (assetId, aggType, stats.min[2], stats.max[2])
+        if window in self.windows:
+            prevHash = self.windows[window]
+            hash = hashlib.sha256(f"{prevHash}{hash}".encode()).hexdigest() if prevHash is not None and hash is not None else None
+        self.windows[window] = hash
+        return True
+
+    def merge(self) -> bool:
+        if not self.assetIds:
+            return True
+
+        try:
+            with dbSavepoint(self.curs, "trades_merge"):
+                if self.ensurePartitions:
+                    dbEnsureTradesPartitions(self.curs, *self.dtRange)
+                self.__merge(self.STAGING_TABLE)
+            merged, success = self.assetIds, True
+        except Exception:
+            log.exception("Failed to merge trades batch, falling back to merge by asset")
+            merged = set()
+            success = forEachSafely(sorted(self.assetIds), lambda assetId: self.__mergeAsset(assetId, merged))
+
+        self.__saveFingerprints(merged)
+        return success
+
+    def __mergeAsset(self, assetId: int, merged: set[int]) -> None:
+        log.debug(f"Merging trades for asset id: {assetId}")
+
+        with dbSavepoint(self.curs, "trades_merge"):
+            self.__merge(f"(SELECT * FROM {self.STAGING_TABLE} WHERE asset_id = {int(assetId)})")
+
+        merged.add(assetId)
+
+    def __merge(self, sourceTable: str) -> None:
+        dbMerge(self.curs, "trades", sourceTable, on=("asset_id", "agg_type", "dt"), cols=self.valueCols, mode=self.mergeMode,
+                bounds={"dt": self.dtRange})
+
+    def __saveFingerprints(self, merged: set[int]) -> None:
+        windows = [window for window in self.windows.items() if window[0][0] in merged]
+        if not windows:
+            return
+
+        log.debug(f"Saving load fingerprints of {len(windows)} windows")
+
+        cols = (LoadFingerprints.ASSET_ID, LoadFingerprints.AGG_TYPE, LoadFingerprints.START_DT, LoadFingerprints.END_DT)
+        try:
+            with dbSavepoint(self.curs, "trades_fingerprints"):
+                # Fingerprints of windows overlapping the merged ones no longer tell what is stored
+                dbTempTable(self.curs, self.WINDOWS_TABLE, cols)
+                dbLoadData(self.curs, self.WINDOWS_TABLE, (window for window, _ in windows), cols)
+                self.curs.execute(f"""
+                    DELETE FROM load_fingerprints AS f
+                    WHERE EXISTS (
+                        SELECT 1 FROM {self.WINDOWS_TABLE} AS w
+                        WHERE w.asset_id = f.asset_id AND w.agg_type = f.agg_type
+                            AND w.start_dt <= f.end_dt AND w.end_dt >= f.start_dt);""")
+
+                rows = [window + (hash,) for window, hash in windows if hash is not None]
+                if rows:
+                    dbMergeRows(self.curs, "load_fingerprints", rows, cols + (LoadFingerprints.HASH,),
+                                key=("asset_id", "agg_type", "start_dt", "end_dt"), mode=MergeMode.MERGE)
+        except Exception:
+            log.exception("Failed to save load fingerprints")
+
+class TradesBatch:
+    # Trades of a run, merged at once in the caller's transaction. With workers, they are merged
+    # in the workers' own transactions instead, and the caller's one is committed before that, for
+    # the workers to see the assets and partitions created in it. So a run is not atomic then.
+    # Used as a context manager, for the workers to be stopped if the run fails before merge.
+
+    WORKER_QUEUE_SIZE = 16
+    WORKER_CHUNK_ROWS = 10000
+
+    # Windows are hashed before staging, so they are held in memory up to this size.
+    # Longer ones, as of backfills which are rarely unchanged, are streamed without fingerprint.
+    FINGERPRINT_MAX_ROWS = 50000
+
+    curs: Any
+    valueCols: tuple[ColumnDef]
+    mergeMode: MergeMode
+    assetIds: set[int]
+    skippedIds: set[int]
+
+    # Min and max dt of trades passed to workers, whose partitions are created by the caller
+    dtRange: tuple[Any, Any] | None
+
+    # (asset_id, agg_type, hash) of loaded windows, None if skipping of unchanged trades is off
+    fingerprints: set[tuple[int, str, str]] | None
+
+    # Either a stage on the caller's connection, or worker threads with their own connections
+    stage: TradesStage | None
+    workers: list[tuple[threading.Thread, Queue]]
+    workerResults: list[tuple[bool, set[int]]]
+    pool: DbPool | None
+
+    # Set when workers are stopped by close() rather than merge(), for them to discard what they staged
+    aborted: bool
+
+    def __init__(self,
+                 curs,
+                 valueCols: Iterable[ColumnDef], *,
+                 update: bool = True,
+                 skipUnchanged: bool = True,
+                 workers: int = None,
+                 pool: DbPool = None):
+
+        if valueCols is None:
+            valueCols = (Trades.C,)
+        elif isinstance(valueCols, (ColumnDef, str)) or not isinstance(valueCols, Iterable):
+            valueCols = (valueCols,)
+
+        self.curs = curs
+        self.valueCols = tuple(valueCols)
+        self.mergeMode = MergeMode.MERGE if update else MergeMode.INSERT
+        self.assetIds = set()
+        self.skippedIds = set()
+        self.dtRange = None
+
+        # Hash covers dt of trades too, so matching one matches the window as well
+        self.fingerprints = None
+        if skipUnchanged:
+            curs.execute("SELECT asset_id, agg_type, hash FROM load_fingerprints;")
+            self.fingerprints = set(curs.fetchall())
+
+        params = getattr(curs.connection, "params", None)
+        if workers is None:
+            workers = params.loadWorkers if params is not None else 1
+
+        # Workers borrow from the pool besides the caller, more of them would wait for each other
+        if pool is not None and workers >= pool.params.poolMaxSize:
+            log.warning(f"Workers limited to {pool.params.poolMaxSize - 1} by pool size")
+            workers = max(pool.params.poolMaxSize - 1, 1)
+
+        self.pool = pool
+        self.stage = None
+        self.workers = []
+        self.workerResults = []
+        self.aborted = False
+
+        if workers > 1:
+            log.info(f"Starting {workers} trades load workers")
+            for i in range(workers):
+                queue = Queue(self.WORKER_QUEUE_SIZE)
+                thread = threading.Thread(target=self.__work, args=(params, queue), name=f"trades-{i + 1}", daemon=True)
+                thread.start()
+                self.workers.append((thread, queue))
+        else:
+            self.stage = TradesStage(curs, self.valueCols, self.mergeMode)
+
+    def __enter__(self) -> "TradesBatch":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        # Stops workers still waiting for trades, so that they give their connections back
+        if self.workers:
+            self.aborted = True
+            self.__stopWorkers()
+
+    def add(self, assetId: int, aggType: str, data: Iterable) -> None:
+        # Data is consumed as a stream, and held in memory only to be fingerprinted
+        hash = None
+        if self.fingerprints is not None:
+            data, hash = self.__fingerprint(data)
+            if hash is not None and (assetId, aggType, hash) in self.fingerprints:
+                log.debug(f"Trades unchanged, skipping asset id: {assetId}")
+                self.skippedIds.add(assetId)
+                return
+
+        if not self.workers:
+            if self.stage.add(assetId, aggType, data, hash):
+                self.assetIds.add(assetId)
+            return
+
+        # The same asset always goes to the same worker, which receives its rows in bounded chunks
+        _, queue = self.workers[assetId % len(self.workers)]
+        chunks = Queue(self.WORKER_QUEUE_SIZE)
+        queue.put((assetId, aggType, chunks, hash))
+        stats = StreamStats(key=lambda row: row[0])
+        try:
+            for chunk in itertools.batched(stats.track(data), self.WORKER_CHUNK_ROWS):
+                chunks.put(chunk)
+        except Exception:
+            chunks.put(Exception(f"Failed to fetch trades for asset id: {assetId}"))
+            raise
+        chunks.put(None)
+
+        self.assetIds.add(assetId)
+        if stats.count:
+            self.dtRange = extendRange(self.dtRange, stats.min[0], stats.max[0])
+
+    def merge(self) -> bool:
+        if not self.workers:
+            log.info(f"Merging trades for {len(self.assetIds)} assets, {len(self.skippedIds)} assets skipped as unchanged")
+            return self.stage.merge()
+
+        log.info(f"Finishing trades load for {len(self.assetIds)} assets in {len(self.workers)} workers")
+
+        # Partitions are created once here rather than by concurrent workers, and together with assets
+        # inserted by the caller must be visible to the workers' merges, so the caller's transaction is committed
+        if self.dtRange is not None:
+            dbEnsureTradesPartitions(self.curs, *self.dtRange)
+        self.curs.connection.commit()
+
+        workers = len(self.workers)
+        self.__stopWorkers()
+
+        merged = set().union(*(assetIds for _, assetIds in self.workerResults))
+        log.info(f"Merged trades for {len(merged)} assets, {len(self.skippedIds)} assets skipped as unchanged")
+
+        return len(self.workerResults) == workers and all(success for success, _ in self.workerResults)
+
+    def __stopWorkers(self) -> None:
+        for _, queue in self.workers:
+            queue.put(None)
+        for thread, _ in self.workers:
+            thread.join()
+        self.workers = []
+
+    def __fingerprint(self, data: Iterable) -> tuple[Iterable, str | None]:
+        data = iter(data)
+        rows = list(itertools.islice(data, self.FINGERPRINT_MAX_ROWS + 1))
+        if len(rows) > self.FINGERPRINT_MAX_ROWS:
+            return itertools.chain(rows, data), None
+
+        digest = hashlib.sha256(repr(tuple(c.name for c in self.valueCols)).encode())
+        for row in rows:
+            digest.update(repr(tuple(row)).encode())
+        return rows, digest.hexdigest()
+
+    def __work(self, params: Any, queue: Queue) -> None:
+        success, assetIds = False, set()
+        consumed = False
+        try:
+            # Workers borrow from the pool if there is one, so it should have room for them besides the caller
+            conn = self.pool.getconn() if self.pool is not None else dbConnect(params)
+            try:
+                with conn.cursor() as curs:
+                    with conn:
+                        stage = TradesStage(curs, self.valueCols, self.mergeMode, ensurePartitions=False)
+                        success = self.__workStage(stage, queue)
+                        consumed = True
+
+                        if not self.aborted:
+                            log.debug(f"Merging trades for {len(stage.assetIds)} assets")
+                            success = stage.merge() and success
+                            assetIds = stage.assetIds
+            finally:
+                if self.pool is not None:
+                    self.pool.putconn(conn)
+                else:
+                    conn.close()
+        except Exception:
+            log.exception("Trades load worker failed")
+            success = False
+            while not consumed and (item := queue.get()) is not None:
+                self.__drain(self.__chunkRows(item[2]))
+
+        self.workerResults.append((success, assetIds))
+
+    def __workStage(self, stage: TradesStage, queue: Queue) -> bool:
+        success = True
+        while (item := queue.get()) is not None:
+            assetId, aggType, chunks, hash = item
+            rows = self.__chunkRows(chunks)
+            try:
+                stage.add(assetId, aggType, rows, hash)
+            except Exception:
+                log.exception(f"Failed to process: {assetId}")
+                success = False
+            finally:
+                # Unblocks the producer if staging stopped halfway
+                self.__drain(rows)
+        return success
+
+    def __chunkRows(self, chunks: Queue) -> Iterator[tuple]:
+        while (chunk := chunks.get()) is not None:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield from chunk
+
+    def __drain(self, rows: Iterator[tuple]) -> None:
+        try:
+            for _ in rows:
+                pass
+        except Exception:
+            pass
+
+def __namedAsset(asset: AssetDef) -> AssetDef:
+    asset = AssetDef(*asset)
+    if asset.name is None:
+        name = f"{asset.market} {asset.code}"
+        if asset.unit is not None:
+            name = f"{name}, {asset.unit}"
+        asset = asset._replace(name=name)
+    return asset
+
+class __CachedAsset(NamedTuple):
+    id: int
+    name: str
+    unit: str
+
+__assetCache: dict[tuple[str, str], __CachedAsset] = None
+
+def __getAssetCache(curs) -> dict[tuple[str, str], __CachedAsset]:
+    global __assetCache
+    if __assetCache is None:
+        log.debug("Loading assets cache")
+
+        curs.execute("SELECT id, market, code, name, unit FROM assets;")
+        __assetCache = {(market, code): __CachedAsset(id, name, unit) for id, market, code, name, unit in curs.fetchall()}
+
+        log.debug(f"Cached {len(__assetCache)} assets")
+
+    return __assetCache
@@ -0,0 +1,366 @@
+import re, csv, json
+import functools
+import sqlite3
+import logging as log
+from typing import Any, Iterable, IO
+from decimal import Decimal
+from datetime import date, datetime, timezone
+
+from common.filetools import openText
+
+from db.dbbase import DbParams, ColumnDef, MergeMode
+from db.dbbase import toIterable, toColumnNames, bindMerge, bindMergeRow, shapeToSql, mergeColumns, boundsSql
+from db.dbbase import mergeRowResult, mergeRowsStaging, mergeRowsSql, mergeRowsReturningSql, mergeRowsResult
+
+# Embedded SQLite backend of dbtools, for offline runs and benchmarks without a database service.
+# Connections behave like psycopg2 ones: a transaction is opened by the first statement and ended
+# by commit/rollback or "with conn", cursors are context managers, and %s / %(name)s placeholders
+# are accepted. The schema is in db/sqlite, and can be applied on connect with initScript param.
+
+class SqliteCursor(sqlite3.Cursor):
+    __PLACEHOLDER_PATTERN = re.compile(r"%\((\w+)\)s|%s|%%")
+    __CALL_PATTERN = re.compile(r"^\s*CALL\s+(\w+)\s*\([^)]*\)\s*;?\s*$", re.IGNORECASE)
+
+    def __enter__(self) -> "SqliteCursor":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def execute(self, sql: str, params: Any = None) -> "SqliteCursor":
+        self.connection.begin()
+
+        call = self.__CALL_PATTERN.match(sql)
+        if call:
+            self.__call(call.group(1), params)
+            return self
+
+        if params is None:
+            return super().execute(sql)
+        return super().execute(self.__toSqlite(sql), params)
+
+    def executemany(self, sql: str, params: Iterable[Any]) -> "SqliteCursor":
+        self.connection.begin()
+        return super().executemany(self.__toSqlite(sql), params)
+
+    def __toSqlite(self, sql: str) -> str:
+        return self.__PLACEHOLDER_PATTERN.sub(self.__toSqlitePlaceholder, sql)
+
+    def __toSqlitePlaceholder(self, match: re.Match) -> str:
+        if match.group(1) is not None:
+            return f":{match.group(1)}"
+        return "?" if match.group(0) == "%s" else "%"
+
+    def __call(self, name: str, params: Any = None) -> None:
+        # Procedure bodies are kept in the procedures table of the schema. Arguments are bound
+        # to them as :arg1, :arg2, ..., lists as JSON arrays to be read with JSON_EACH
+        args = {f"arg{i + 1}": json.dumps(list(v)) if isinstance(v, (list, tuple)) else v for i, v in enumerate(params or ())}
+
+        super().execute("SELECT body FROM procedures WHERE name = ?;", (name,))
+        row = self.fetchone()
+        if row is None:
+            raise sqlite3.OperationalError(f"No such procedure: {name}")
+
+        sql = ""
+        for line in row[0].splitlines(keepends=True):
+            sql += line
+            if sqlite3.complete_statement(sql):
+                super().execute(sql, args)
+                sql = ""
+
+class SqliteConnection(sqlite3.Connection):
+    params: DbParams = None
+    tempTables: dict[str, str] = None
+    closed: bool = False
+
+    def cursor(self, factory: type = SqliteCursor) -> SqliteCursor:
+        return super().cursor(factory)
+
+    def begin(self) -> None:
+        if not self.in_transaction:
+            super().execute("BEGIN;")
+
+    def close(self) -> None:
+        super().close()
+        self.closed = True
+
+def __adaptDatetime(value: datetime) -> str:
+    # Aware timestamps are kept in UTC, so that they compare correctly as text
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.isoformat()
+
+sqlite3.register_adapter(Decimal, str)
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_adapter(datetime, __adaptDatetime)
+
+def __splitPart(value: str | None, delimiter: str, n: int) -> str | None:
+    if value is None:
+        return None
+    parts = value.split(delimiter)
+    return parts[n - 1] if 0 < n <= len(parts) else ""
+
+def __regexpReplace(value: str | None, pattern: str | None, replacement: str | None) -> str | None:
+    if value is None or pattern is None or replacement is None:
+        return None
+    return re.sub(pattern, re.sub(r"\\(\d)", r"\\g<\1>", replacement), value, count=1)
+
+def __regexp(pattern: str | None, value: str | None) -> bool | None:
+    # Operator "value REGEXP pattern", matching anywhere as ~ of PostgreSQL does
+    if value is None or pattern is None:
+        return None
+    return re.search(pattern, value) is not None
+
+def isSqlite(curs) -> bool:
+    return isinstance(curs, SqliteCursor)
+
+def dbConnect(params: DbParams) -> SqliteConnection:
+    log.info(f"Connecting to: sqlite:{params.dbname}")
+
+    # Transactions are begun explicitly by the cursor, see SqliteConnection.begin
+    conn = sqlite3.connect(params.dbname, factory=SqliteConnection, isolation_level=None, check_same_thread=False)
+
+    conn.params = params
+    conn.tempTables = {}
+
+    conn.create_function("SPLIT_PART", 3, __splitPart, deterministic=True)
+    conn.create_function("REGEXP_REPLACE", 3, __regexpReplace, deterministic=True)
+    conn.create_function("REGEXP", 2, __regexp, deterministic=True)
+
+    conn.execute("PRAGMA foreign_keys = ON;")
+    if params.dbname != ":memory:":
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("PRAGMA synchronous = NORMAL;")
+
+    if params.initScript:
+        log.debug(f"Running init script: {params.initScript}")
+        with open(params.initScript, "r") as f:
+            conn.executescript(f.read())
+
+    log.debug(f"Connected to: SQLite {sqlite3.sqlite_version}")
+    return conn
+
+def dbTempTable(curs, tableName: str, cols: Iterable[ColumnDef], onCommit: str = "DELETE ROWS") -> None:
+    # No ON COMMIT clause in SQLite, so rows are rather cleared when the table is requested again
+    sqlCols = ", ".join(f"{c.name} {c.type}" for c in cols)
+    sqlTable = f"TEMPORARY TABLE {tableName} ({sqlCols})"
+
+    tempTables = curs.connection.tempTables
+    if tempTables.get(tableName) == sqlTable:
+        log.debug(f"Reusing temp table: {tableName}")
+        # The table is still gone if the transaction it was created in was rolled back
+        sqls = [f"CREATE {sqlTable.replace("TABLE", "TABLE IF NOT EXISTS", 1)};", f"DELETE FROM temp.{tableName};"]
+    else:
+        log.debug(f"Creating temp table: {tableName}")
+        sqls = [f"DROP TABLE IF EXISTS temp.{tableName};", f"CREATE {sqlTable};"]
+
+    for sql in sqls:
+        log.debug(f"Query: {sql}")
+        curs.execute(sql)
+
+    if onCommit.upper() != "DROP":
+        tempTables[tableName] = sqlTable
+    else:
+        tempTables.pop(tableName, None)
+
+def dbLoadData(curs, tableName: str, data: Iterable[Any], cols: Iterable[str | ColumnDef], method: Any = None) -> None:
+    log.debug(f"Inserting data into table: {tableName}")
+
+    colNames = toColumnNames(cols)
+    sqlCols = ", ".join(colNames)
+    sqlValues = ", ".join("?" for _ in colNames)
+
+    sql = f"INSERT INTO {tableName} ({sqlCols}) VALUES ({sqlValues})"
+    log.debug(f"Query: {sql}")
+
+    curs.executemany(sql, data)
+
+def dbLoadCsv(curs, tableName: str, fileName: str, cols: Iterable[str | ColumnDef], sep=",") -> None:
+    log.debug(f"Loading CSV: {fileName} into table: {tableName}")
+
+    with openText(fileName, newline="") as f:
+        reader = csv.reader(f, delimiter=sep)
+        header = next(reader)
+        log.debug(f"Skipping CSV header: \"{sep.join(header)}\"")
+
+        # Empty value is NULL, as unquoted one is in CSV of COPY
+        rows = ([v if v != "" else None for v in row] for row in reader)
+        dbLoadData(curs, tableName, rows, cols)
+
+    log.debug(f"CSV loaded")
+
+def dbUnloadCsv(curs, sql: str, params: Iterable[Any] | dict[str, Any], f: IO[str]) -> None:
+    log.debug(f"Unloading CSV of query: {sql}")
+
+    # NULL is written as empty unquoted value, as COPY does
+    curs.execute(sql, params)
+    csv.writer(f, lineterminator="\n").writerows(curs)
+
+    log.debug(f"CSV unloaded")
+
+def dbMerge(curs,
+            targetTable: str,
+            sourceTable: str, *,
+            on: Iterable[str] | dict[str, Any],
+            cols: Iterable[str | ColumnDef] | dict[str, Any] = None,
+            params: Iterable[Any] = None,
+            mode: MergeMode = None,
+            bounds: dict[str, tuple[Any, Any]] = None) -> None:
+
+    log.debug(f"Merging into: {targetTable}, from: {sourceTable}")
+
+    on, cols, bounds, values = bindMerge(on, cols, params, bounds)
+
+    sqls = __mergeSql(targetTable, sourceTable, on, cols, mode, bounds)
+    if not sqls:
+        log.debug("Nothing to merge")
+        return
+
+    if values:
+        log.debug(f"Params: {values}")
+
+    for sql in sqls:
+        log.debug(f"Query: {sql}")
+        curs.execute(sql, values)
+
+    log.debug(f"Merge done")
+
+def dbMergeRow(curs,
+               targetTable: str,
+               row: dict[str, Any] | Iterable[str], *,
+               params: Iterable[Any] = None,
+               key: Iterable[str],
+               returning: Iterable[str] = None,
+               mode: MergeMode = None) -> Any | None:
+
+    log.debug(f"Merging row into: {targetTable}")
+
+    row, values = bindMergeRow(row, params)
+    key = tuple(toIterable(key))
+    returning = tuple(toIterable(returning))
+
+    sql, sqlSelect = __mergeRowSql(targetTable, row, key, returning, mode)
+    log.debug(f"Query: {sql}")
+
+    if values:
+        log.debug(f"Params: {values}")
+
+    curs.execute(sql, values)
+
+    retVals = None
+    if returning:
+        # Nothing is returned if the row was there already and unchanged
+        retRow = curs.fetchone()
+        if retRow is None:
+            log.debug(f"Query: {sqlSelect}")
+            curs.execute(sqlSelect, values)
+            retRow = curs.fetchone()
+
+        retVals = mergeRowResult(retRow, returning)
+        log.debug(f"Return: {retVals}")
+
+    log.debug(f"Row merged")
+    return retVals
+
+def dbMergeRows(curs,
+                targetTable: str,
+                rows: Iterable[Any],
+                cols: Iterable[ColumnDef], *,
+                key: Iterable[str],
+                returning: Iterable[str] = None,
+                mode: MergeMode = None) -> dict[Any, Any]:
+
+    log.debug(f"Merging rows into: {targetTable}")
+
+    cols = tuple(cols)
+    colNames = tuple(c.name for c in cols)
+    key = tuple(toIterable(key))
+    returning = tuple(toIterable(returning))
+
+    stagingTable, rows = mergeRowsStaging(targetTable, rows, colNames, key)
+
+    dbTempTable(curs, stagingTable, cols)
+    dbLoadData(curs, stagingTable, rows, cols)
+
+    sql = mergeRowsSql(targetTable, stagingTable, colNames, key, mode)
+    log.debug(f"Query: {sql}")
+
+    curs.execute(sql)
+    log.debug(f"Rows merged: {curs.rowcount}")
+
+    if not returning:
+        return {}
+
+    sql = mergeRowsReturningSql(targetTable, stagingTable, key, returning)
+    log.debug(f"Query: {sql}")
+
+    curs.execute(sql)
+
+    retVals = mergeRowsResult(curs.fetchall(), key, returning)
+    log.debug(f"Returned {len(retVals)} rows")
+    return retVals
+
+@functools.cache
+def __mergeSql(targetTable: str, sourceTable: str, on: tuple, cols: tuple, mode: MergeMode, bounds: tuple = ()) -> tuple[str]:
+    # MERGE emulated by UPDATE ... FROM of matched rows, then INSERT of the rest,
+    # both driven by the target's unique index on the match columns
+    targetAlias, sourceAlias = "t", "s"
+
+    on, insert, update = mergeColumns(on, cols, mode, sourceAlias)
+    sqlOn = " AND ".join(f"{targetAlias}.{col} = {val}" for col, val in on.items())
+    sqlOn += boundsSql(bounds, targetAlias)
+
+    sqls = []
+
+    if update:
+        sqlUpdate = ", ".join(f"{col} = {val}" for col, val in update.items())
+        sqlWhere = " OR ".join(f"{targetAlias}.{col} IS NOT {val}" for col, val in update.items())
+        sqls.append(
+            f"UPDATE {targetTable} AS {targetAlias} SET {sqlUpdate} " +
+            f"FROM {sourceTable} AS {sourceAlias} " +
+            f"WHERE {sqlOn} AND ({sqlWhere});")
+
+    if insert:
+        sqlInsert = ", ".join(insert.keys())
+        sqlValues = ", ".join(insert.values())
+        sqls.append(
+            f"INSERT INTO {targetTable} ({sqlInsert}) " +
+            f"SELECT {sqlValues} FROM {sourceTable} AS {sourceAlias} " +
+            f"WHERE NOT EXISTS (SELECT NULL FROM {targetTable} AS {targetAlias} WHERE {sqlOn});")
+
+    return tuple(sqls)
+
+@functools.cache
+def __mergeRowSql(targetTable: str, row: tuple, key: tuple, returning: tuple, mode: MergeMode) -> tuple[str, str | None]:
+    targetAlias = "t"
+
+    row = shapeToSql(row)
+
+    sqlInsert = ", ".join(row.keys())
+    sqlValues = ", ".join(row.values())
+
+    sql = f"INSERT INTO {targetTable} AS {targetAlias} ({sqlInsert}) VALUES ({sqlValues})"
+
+    keySet = {col.casefold() for col in key}
+    update = [col for col in row.keys() if col.casefold() not in keySet]
+
+    if (mode is None or mode == MergeMode.MERGE) and update:
+        sqlOnConflict = ", ".join(key)
+        sqlUpdate = ", ".join(f"{col} = excluded.{col}" for col in update)
+        sqlWhere = " OR ".join(f"{targetAlias}.{col} IS NOT excluded.{col}" for col in update)
+
+        sql += f" ON CONFLICT ({sqlOnConflict}) DO UPDATE SET {sqlUpdate} WHERE {sqlWhere}"
+    elif mode is None or mode in (MergeMode.MERGE, MergeMode.INSERT):
+        sql += " ON CONFLICT DO NOTHING"
+    else:
+        raise Exception(f"Invalid or unsupported merge mode: {mode}")
+
+    sqlSelect = None
+    if returning:
+        sqlReturning = ", ".join(returning)
+        sql += f" RETURNING {sqlReturning}"
+
+        sqlWhere = " AND ".join(f"{col} IS {row.get(col)}" for col in key)
+        sqlSelect = f"SELECT {sqlReturning} FROM {targetTable} WHERE {sqlWhere};"
+
+    return sql + ";", sqlSelect
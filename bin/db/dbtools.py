@@ -1,62 +1,62 @@
+import io, re, select
+import time
+import threading
 import logging as log
-from typing import Any, Iterable, Callable
+from typing import Any, Iterable, Iterator, IO
 from typing import NamedTuple
-from enum import Enum
+
+from contextlib import contextmanager
 
 import psycopg2, psycopg2.extras
 
-from common.dtotools import ofmethod
-
-@ofmethod
-class DbParams(NamedTuple):
-    host: str = "localhost"
-    port: int = 5432
-    dbname: str = "postgres"
-    user: str = None
-    password: str = None
-
-class DbTypes:
-    VARCHAR = lambda n = None: "VARCHAR" if n is None else f"VARCHAR({n})"
-    BIGINT = "BIGINT"
-    DECIMAL = lambda s, p = None: f"DECIMAL({s})" if p is None else f"DECIMAL({s}, {p})"
-    TIMESTAMPTZ = "TIMESTAMP WITH TIME ZONE"
-
-class ColumnDef(NamedTuple):
-    name: str
-    type: str = DbTypes.VARCHAR
-
-    def __getattribute__(self, name: str) -> Any:
-        value = object.__getattribute__(self, name)
-        if name == "type" and callable(value):
-            value = value()
-        return value
-
-class SqlParam(NamedTuple):
-    placeholder: str = "%s"
-
-class SqlExpr(NamedTuple):
-    expr: str
-
-class MergeMode(Enum):
-    MERGE = 1
-    INSERT = 2
-    UPDATE = 3
-
-__SQL_CONVERTERS: dict[type, Callable] = {
-    type(None): lambda v: "NULL",
-    str: lambda v: f"'{v}'",
-    SqlParam: lambda v: f"{v.placeholder}",
-    SqlExpr: lambda v: f"{v.expr}"
-}
+from common.filetools import openText
+
+import db.dbsqlite as dbsqlite
+
+from db.dbbase import DbParams, DbTypes, ColumnDef, SqlParam, SqlExpr, MergeMode, LoadMethod
+from db.dbbase import toIterable, toColumnNames, bindMerge, bindMergeRow, tempTableSql, copyLines
+from db.dbbase import mergeSql, mergeRowSql, mergeRowResult, mergeRowsStaging, mergeRowsSql, mergeRowsReturningSql, mergeRowsResult
+
+class DbConnection(psycopg2.extensions.connection):
+    params: DbParams = None
+    loadMethod: LoadMethod = LoadMethod.COPY
+
+    # Negative threshold disables server-side prepared statements
+    prepareThreshold: int = -1
+    statementHits: dict[str, int] = None
+    preparedStatements: dict[str, tuple[str, tuple[str]]] = None
+
+    # Numbers names of prepared statements, which outlive transactions and so are never reused
+    preparedCount: int = 0
+
+    tempTables: dict[str, str] = None
+
+__SQL_PARAM_PATTERN = re.compile(r"%\((\w+)\)s")
+
+__COPY_BUFFER_SIZE = 65536
 
 def dbConnect(params: DbParams):
+    if params.engine == "sqlite":
+        return dbsqlite.dbConnect(params)
+    if params.engine != "postgresql":
+        raise Exception(f"Invalid DB engine: {params.engine}")
+
     log.info(f"Connecting to: postgresql://{params.host}:{params.port}/{params.dbname}")
     conn = psycopg2.connect(
         host=params.host,
         port=params.port,
         dbname=params.dbname,
         user=params.user,
-        password=params.password)
+        password=params.password,
+        connection_factory=DbConnection)
+
+    conn.params = params
+    conn.loadMethod = LoadMethod[params.loadMethod.upper()]
+    conn.prepareThreshold = params.prepareThreshold
+    conn.statementHits = {}
+    conn.preparedStatements = {}
+    conn.preparedCount = 0
+    conn.tempTables = {}
 
     with conn.cursor() as curs:
         curs.execute("SELECT version()")
@@ -64,94 +64,336 @@ def dbConnect(params: DbParams):
 
     return conn
 
-def dbTempTable(curs, tableName: str, cols: Iterable[ColumnDef], onCommit: str = "DROP") -> None:
-    log.debug(f"Creating temp table: {tableName}")
+class DbPoolStats(NamedTuple):
+    size: int
+    idle: int
+    inUse: int
+    peakInUse: int
+    checkouts: int
+    # Checkouts which found the pool saturated and had to wait
+    waits: int
+    timeouts: int
+    totalWait: float
+    maxWait: float
+
+class DbPool:
+    # Bounded pool of DbConnection, thread safe
+
+    params: DbParams
+
+    def __init__(self, params: DbParams):
+        self.params = params
+        self.__cond = threading.Condition()
+        self.__idle = []
+        self.__size = 0
+        self.__closed = False
+
+        self.__inUse = 0
+        self.__peakInUse = 0
+        self.__checkouts = 0
+        self.__waits = 0
+        self.__timeouts = 0
+        self.__totalWait = 0.0
+        self.__maxWait = 0.0
+
+        for _ in range(min(params.poolMinSize, params.poolMaxSize)):
+            self.__idle.append((dbConnect(params), time.monotonic()))
+            self.__size += 1
+
+    @contextmanager
+    def connection(self, timeout: float = None) -> Iterator[Any]:
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def getconn(self, timeout: float = None) -> Any:
+        if timeout is None:
+            timeout = self.params.poolTimeout
+
+        start = time.monotonic()
+        conn = None
+        with self.__cond:
+            waited = False
+            while True:
+                if self.__closed:
+                    raise Exception("Connection pool is closed")
+                if self.__idle:
+                    conn, lastUsed = self.__idle.pop()
+                    break
+                if self.__size < self.params.poolMaxSize:
+                    self.__size += 1
+                    break
+
+                remaining = start + timeout - time.monotonic()
+                if remaining <= 0:
+                    self.__timeouts += 1
+                    raise TimeoutError(f"No free connection in pool within {timeout} s, pool size: {self.__size}")
+
+                if not waited:
+                    log.debug("Connection pool saturated, waiting")
+                    waited = True
+                self.__cond.wait(remaining)
+
+            wait = time.monotonic() - start
+            self.__inUse += 1
+            self.__peakInUse = max(self.__peakInUse, self.__inUse)
+            self.__checkouts += 1
+            self.__waits += waited
+            self.__totalWait += wait
+            self.__maxWait = max(self.__maxWait, wait)
+
+        try:
+            if conn is not None and not self.__isHealthy(conn, lastUsed):
+                self.__discard(conn)
+                conn = None
+            if conn is None:
+                conn = dbConnect(self.params)
+        except Exception:
+            with self.__cond:
+                self.__inUse -= 1
+                self.__size -= conn is None
+                self.__cond.notify()
+            raise
+
+        return conn
+
+    def putconn(self, conn: Any) -> None:
+        healthy = self.__reset(conn)
+        if not healthy:
+            self.__discard(conn)
+
+        with self.__cond:
+            self.__inUse -= 1
+            if healthy and not self.__closed:
+                self.__idle.append((conn, time.monotonic()))
+            else:
+                self.__size -= 1
+                if healthy:
+                    conn.close()
+            self.__cond.notify()
+
+    def close(self) -> None:
+        with self.__cond:
+            self.__closed = True
+            idle, self.__idle = self.__idle, []
+            self.__size -= len(idle)
+            self.__cond.notify_all()
+
+        for conn, _ in idle:
+            conn.close()
+
+        stats = self.stats()
+        avgWait = stats.totalWait / stats.checkouts if stats.checkouts else 0
+        log.info(
+            f"Connection pool closed, checkouts: {stats.checkouts}, saturated: {stats.waits}, timeouts: {stats.timeouts}, " +
+            f"wait avg: {avgWait * 1000:.1f} ms, max: {stats.maxWait * 1000:.1f} ms, " +
+            f"peak in use: {stats.peakInUse} of {self.params.poolMaxSize}")
+
+    def stats(self) -> DbPoolStats:
+        with self.__cond:
+            return DbPoolStats(
+                size=self.__size,
+                idle=len(self.__idle),
+                inUse=self.__inUse,
+                peakInUse=self.__peakInUse,
+                checkouts=self.__checkouts,
+                waits=self.__waits,
+                timeouts=self.__timeouts,
+                totalWait=self.__totalWait,
+                maxWait=self.__maxWait)
+
+    def __isHealthy(self, conn: Any, lastUsed: float) -> bool:
+        if conn.closed:
+            return False
+        if self.params.poolCheckIdle < 0 or time.monotonic() - lastUsed < self.params.poolCheckIdle:
+            return True
+
+        log.debug("Checking idle pooled connection")
+        try:
+            with conn.cursor() as curs:
+                curs.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            log.warning("Pooled connection is broken, reconnecting")
+            return False
+
+    def __reset(self, conn: Any) -> bool:
+        # Returns connection to a clean session state, according to poolReset mode
+        if conn.closed:
+            return False
+
+        mode = self.params.poolReset.upper()
+        try:
+            conn.rollback()
+            if mode == "TEMP":
+                with conn.cursor() as curs:
+                    curs.execute("DISCARD TEMP;")
+                conn.commit()
+                conn.tempTables.clear()
+            elif mode == "ALL":
+                # Not allowed inside a transaction block
+                conn.autocommit = True
+                try:
+                    with conn.cursor() as curs:
+                        curs.execute("DISCARD ALL;")
+                finally:
+                    conn.autocommit = False
+                conn.tempTables.clear()
+                conn.statementHits.clear()
+                conn.preparedStatements.clear()
+            elif mode != "ROLLBACK":
+                raise Exception(f"Invalid pool reset mode: {self.params.poolReset}")
+            return True
+        except psycopg2.Error:
+            log.warning("Failed to reset pooled connection, discarding")
+            return False
+
+    def __discard(self, conn: Any) -> None:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+def dbListen(conn, channel: str) -> None:
+    if isinstance(conn, dbsqlite.SqliteConnection):
+        raise Exception("LISTEN is not supported by SQLite")
+
+    # Notifications are delivered between transactions only, so keep the listening connection out of them
+    conn.commit()
+    conn.autocommit = True
+
+    log.debug(f"Listening channel: {channel}")
+    with conn.cursor() as curs:
+        curs.execute(f"LISTEN {channel};")
+
+def dbWaitNotifies(conn, timeout: float | None = None) -> list[Any]:
+    # Waits for notifications up to timeout seconds (forever if None), returns empty list on timeout
+    if not conn.notifies:
+        if timeout is not None and timeout <= 0:
+            conn.poll()
+        elif select.select([conn], [], [], timeout)[0]:
+            conn.poll()
+
+    notifies = list(conn.notifies)
+    conn.notifies.clear()
+
+    for n in notifies:
+        log.debug(f"Notify: {n.channel}, payload: {n.payload}")
+
+    return notifies
+
+@contextmanager
+def dbSavepoint(curs, name: str = "sp") -> Iterator[None]:
+    curs.execute(f"SAVEPOINT {name};")
+    try:
+        yield
+    except Exception:
+        log.debug(f"Rolling back to savepoint: {name}")
+        curs.execute(f"ROLLBACK TO SAVEPOINT {name};")
+        raise
+    curs.execute(f"RELEASE SAVEPOINT {name};")
+
+def dbTempTable(curs, tableName: str, cols: Iterable[ColumnDef], onCommit: str = "DELETE ROWS") -> None:
+    if dbsqlite.isSqlite(curs):
+        return dbsqlite.dbTempTable(curs, tableName, cols, onCommit)
+
+    tempTables = getattr(curs.connection, "tempTables", None)
+    sqls, sqlTable = tempTableSql(tableName, cols, onCommit, tempTables)
+
+    if sqlTable is not None and tempTables.get(tableName) == sqlTable:
+        log.debug(f"Reusing temp table: {tableName}")
+    else:
+        log.debug(f"Creating temp table: {tableName}")
 
-    sqlCols = ", ".join(f"{c.name} {c.type}" for c in cols)
-    sql = f"CREATE TEMPORARY TABLE {tableName} ({sqlCols}) ON COMMIT {onCommit};"
+    sql = " ".join(sqls)
     log.debug(f"Query: {sql}")
-
     curs.execute(sql)
 
-def dbLoadData(curs, tableName: str, data: Iterable[Any], cols: Iterable[str | ColumnDef]) -> None:
-    log.debug(f"Inserting data into table: {tableName}")
+    if sqlTable is not None:
+        tempTables[tableName] = sqlTable
 
-    sqlCols = ", ".join(c.name if isinstance(c, ColumnDef) else c for c in cols)
-    sql = f"INSERT INTO {tableName} ({sqlCols}) VALUES %s"
-    log.debug(f"Query: {sql}")
+def dbLoadData(curs, tableName: str, data: Iterable[Any], cols: Iterable[str | ColumnDef], method: LoadMethod = None) -> None:
+    if dbsqlite.isSqlite(curs):
+        return dbsqlite.dbLoadData(curs, tableName, data, cols, method)
 
-    psycopg2.extras.execute_values(curs, sql, data, page_size=1000)
+    if method is None:
+        method = getattr(curs.connection, "loadMethod", LoadMethod.COPY)
+
+    sqlCols = ", ".join(toColumnNames(cols))
+
+    if method == LoadMethod.COPY:
+        log.debug(f"Copying data into table: {tableName}")
+
+        sql = f"COPY {tableName} ({sqlCols}) FROM STDIN"
+        log.debug(f"Query: {sql}")
+
+        curs.copy_expert(sql, __CopyStream(copyLines(data)), size=__COPY_BUFFER_SIZE)
+    elif method == LoadMethod.INSERT:
+        log.debug(f"Inserting data into table: {tableName}")
+
+        sql = f"INSERT INTO {tableName} ({sqlCols}) VALUES %s"
+        log.debug(f"Query: {sql}")
+
+        psycopg2.extras.execute_values(curs, sql, data, page_size=1000)
+    else:
+        raise Exception(f"Invalid load method: {method}")
 
 def dbLoadCsv(curs, tableName: str, fileName: str, cols: Iterable[str | ColumnDef], sep=",") -> None:
+    if dbsqlite.isSqlite(curs):
+        return dbsqlite.dbLoadCsv(curs, tableName, fileName, cols, sep)
+
     log.debug(f"Loading CSV: {fileName} into table: {tableName}")
 
-    with open(fileName, 'r') as f:
+    with openText(fileName) as f:
         header = next(f).rstrip("\r\n")
         log.debug(f"Skipping CSV header: \"{header}\"")
 
-        cols = [c.name if isinstance(c, ColumnDef) else c for c in __toIterable(cols)]
-        curs.copy_from(f, tableName, sep=sep, columns=cols)
+        sql = f"COPY {tableName} ({", ".join(toColumnNames(cols))}) FROM STDIN WITH (FORMAT csv, DELIMITER %s);"
+        curs.copy_expert(curs.mogrify(sql, (sep,)), f)
 
     log.debug(f"CSV loaded")
 
+def dbUnloadCsv(curs, sql: str, params: Iterable[Any] | dict[str, Any], f: IO[str]) -> None:
+    if dbsqlite.isSqlite(curs):
+        return dbsqlite.dbUnloadCsv(curs, sql, params, f)
+
+    log.debug(f"Unloading CSV of query: {sql}")
+
+    sql = f"COPY ({curs.mogrify(sql, params).decode()}) TO STDOUT WITH (FORMAT csv)"
+    curs.copy_expert(sql, f, size=__COPY_BUFFER_SIZE)
+
+    log.debug(f"CSV unloaded")
+
 def dbMerge(curs,
             targetTable: str,
             sourceTable: str, *,
             on: Iterable[str] | dict[str, Any],
             cols: Iterable[str | ColumnDef] | dict[str, Any] = None,
             params: Iterable[Any] = None,
-            mode: MergeMode = None) -> None:
-
-    log.debug(f"Merging into: {targetTable}, from: {sourceTable}")
+            mode: MergeMode = None,
+            bounds: dict[str, tuple[Any, Any]] = None) -> None:
 
-    targetAlias, sourceAlias = "t", "s"
+    if dbsqlite.isSqlite(curs):
+        return dbsqlite.dbMerge(curs, targetTable, sourceTable, on=on, cols=cols, params=params, mode=mode, bounds=bounds)
 
-    on = __rowToSql(__toDict(on, ColumnDef), sourceAlias)
-
-    if not isinstance(cols, dict):
-        cols = [c.name if isinstance(c, ColumnDef) else c for c in __toIterable(cols)]
-        cols = {c: ColumnDef(c) for c in cols}
-    cols = __rowToSql(cols, sourceAlias)
-
-    onCols = {col.casefold() for col in on}
-    insert = on | {col: sql for col, sql in cols.items() if col.casefold() not in onCols}
-    update = cols
+    log.debug(f"Merging into: {targetTable}, from: {sourceTable}")
 
-    if mode == MergeMode.INSERT:
-        update = ()
-    elif mode == MergeMode.UPDATE:
-        insert = ()
-    elif mode is not None and mode != MergeMode.MERGE:
-        raise Exception(f"Invalid merge mode: {mode}")
+    on, cols, bounds, values = bindMerge(on, cols, params, bounds)
 
-    if not insert and not update:
+    sql = mergeSql(targetTable, sourceTable, on, cols, mode, bounds)
+    if sql is None:
         log.debug("Nothing to merge")
         return
 
-    sqlOn = " AND ".join(f"{targetAlias}.{col} = {val}" for col, val in on.items())
-    sql = (
-        f"MERGE INTO {targetTable} AS {targetAlias} " +
-        f"USING {sourceTable} AS {sourceAlias} " +
-        f"ON ({sqlOn})")
-
-    if insert:
-        sqlInsert = ", ".join(insert.keys())
-        sqlValues = ", ".join(insert.values())
-        sql += f" WHEN NOT MATCHED THEN INSERT ({sqlInsert}) VALUES ({sqlValues})"
-
-    if update:
-        sqlWhere = " OR ".join(f"{targetAlias}.{col} IS DISTINCT FROM {val}" for col, val in update.items())
-        sqlUpdate = ", ".join(f"{col} = {val}" for col, val in update.items())
-        sql += f" WHEN MATCHED AND ({sqlWhere}) THEN UPDATE SET {sqlUpdate}"
-
-    sql += ";"
     log.debug(f"Query: {sql}")
 
-    if params:
-        log.debug(f"Params: {params}")
-        params = [p for p in params] + [p for p in params]
+    if values:
+        log.debug(f"Params: {values}")
 
-    curs.execute(sql, params)
+    __execute(curs, sql, values)
     log.debug(f"Merge done")
 
 def dbMergeRow(curs,
@@ -162,81 +404,134 @@ def dbMergeRow(curs,
                returning: Iterable[str] = None,
                mode: MergeMode = None) -> Any | None:
 
+    if dbsqlite.isSqlite(curs):
+        return dbsqlite.dbMergeRow(curs, targetTable, row, params=params, key=key, returning=returning, mode=mode)
+
     log.debug(f"Merging row into: {targetTable}")
 
-    targetAlias = "t"
+    row, values = bindMergeRow(row, params)
+    key = tuple(toIterable(key))
+    returning = tuple(toIterable(returning))
 
-    row = __rowToSql(__toDict(row, lambda v: SqlParam()))
-    key = __toIterable(key)
-    returning = __toIterable(returning)
+    sql = mergeRowSql(targetTable, row, key, returning, mode)
+    log.debug(f"Query: {sql}")
 
-    sqlInsert = ", ".join(row.keys())
-    sqlValues = ", ".join(row.values())
+    if values:
+        log.debug(f"Params: {values}")
 
-    sql = f"INSERT INTO {targetTable} AS {targetAlias} ({sqlInsert}) VALUES ({sqlValues})"
+    __execute(curs, sql, values)
 
-    if mode is None or mode == MergeMode.MERGE:
-        keySet = {col.casefold() for col in key}
-        update = [col for col in row.keys() if col.casefold() not in keySet]
+    retVals = None
+    if returning:
+        retVals = mergeRowResult(curs.fetchone(), returning)
+        log.debug(f"Return: {retVals}")
 
-        sqlOnConflict = ", ".join(key)
-        sqlUpdate = ", ".join(f"{col} = EXCLUDED.{col}" for col in update)
-        sqlWhere = " OR ".join(f"{targetAlias}.{col} IS DISTINCT FROM EXCLUDED.{col}" for col in update)
+    log.debug(f"Row merged")
+    return retVals
 
-        sql += f" ON CONFLICT ({sqlOnConflict}) DO UPDATE SET {sqlUpdate} WHERE {sqlWhere}"
-    elif mode == MergeMode.INSERT:
-        sql += " ON CONFLICT DO NOTHING"
-    else:
-        raise Exception(f"Invalid or unsupported merge mode: {mode}")
+def dbMergeRows(curs,
+                targetTable: str,
+                rows: Iterable[Any],
+                cols: Iterable[ColumnDef], *,
+                key: Iterable[str],
+                returning: Iterable[str] = None,
+                mode: MergeMode = None) -> dict[Any, Any]:
 
-    if returning:
-        sqlReturning = ", ".join(returning)
-        sqlWhere = " AND ".join(f"{targetAlias}.{col} IS NOT DISTINCT FROM {row.get(col)}" for col in key)
+    if dbsqlite.isSqlite(curs):
+        return dbsqlite.dbMergeRows(curs, targetTable, rows, cols, key=key, returning=returning, mode=mode)
+
+    log.debug(f"Merging rows into: {targetTable}")
+
+    cols = tuple(cols)
+    colNames = tuple(c.name for c in cols)
+    key = tuple(toIterable(key))
+    returning = tuple(toIterable(returning))
+
+    stagingTable, rows = mergeRowsStaging(targetTable, rows, colNames, key)
 
-        sql = (
-            f"WITH q AS ({sql} RETURNING {sqlReturning}) " + 
-            f"SELECT * FROM q UNION ALL " + 
-            f"SELECT {sqlReturning} FROM {targetTable} AS {targetAlias} " +
-            f"WHERE {sqlWhere} AND NOT EXISTS (SELECT NULL FROM q)")
+    dbTempTable(curs, stagingTable, cols)
+    dbLoadData(curs, stagingTable, rows, cols)
 
-    sql += ";"
+    sql = mergeRowsSql(targetTable, stagingTable, colNames, key, mode)
     log.debug(f"Query: {sql}")
 
-    if params:
-        log.debug(f"Params: {params}")
-        if returning:
-            params = [p for p in params] + [p for p in params]
+    curs.execute(sql)
+    log.debug(f"Rows merged: {curs.rowcount}")
 
-    curs.execute(sql, params)
+    if not returning:
+        return {}
 
-    retVals = None
-    if returning:
-        retVals = curs.fetchone()
-        if len(returning) == 1:
-            retVals = retVals[0]
-        else:
-            retVals = {col: retVals[i] for i, col in enumerate(returning)}
-        log.debug(f"Return: {retVals}")
+    sql = mergeRowsReturningSql(targetTable, stagingTable, key, returning)
+    log.debug(f"Query: {sql}")
 
-    log.debug(f"Row merged")
+    curs.execute(sql)
+
+    retVals = mergeRowsResult(curs.fetchall(), key, returning)
+    log.debug(f"Returned {len(retVals)} rows")
     return retVals
 
-def __toIterable(value: Any) -> Iterable:
-    if value is None:
-        value = ()
-    elif isinstance(value, (ColumnDef, str)) or not isinstance(value, Iterable):
-        value = (value,)
-    return value
-
-def __toDict(value: Any, mapper: Callable) -> dict:
-    if not isinstance(value, dict):
-        value = {v: mapper(v) for v in __toIterable(value)}
-    return value
-
-def __rowToSql(row: dict[str, Any], tableAlias: str = None) -> dict[str, str]:
-    return {col: __valueToSql(val, tableAlias) for col, val in row.items()}
-
-def __valueToSql(value: Any, tableAlias: str = None) -> str:
-    if isinstance(value, ColumnDef):
-        return value.name if tableAlias is None else f"{tableAlias}.{value.name}"
-    return __SQL_CONVERTERS.get(type(value), str)(value)
+class __CopyStream(io.TextIOBase):
+    # File-like adapter feeding COPY FROM STDIN straight from a line iterator,
+    # so rows are never materialized as a whole
+
+    def __init__(self, lines: Iterator[str]):
+        self.__lines = lines
+        self.__buffer = ""
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        parts, length = [self.__buffer], len(self.__buffer)
+        while size < 0 or length < size:
+            line = next(self.__lines, None)
+            if line is None:
+                break
+            parts.append(line)
+            length += len(line)
+
+        data = "".join(parts)
+        if size < 0:
+            size = length
+        self.__buffer = data[size:]
+        return data[:size]
+
+def __execute(curs, sql: str, params: dict[str, Any]) -> None:
+    conn = curs.connection
+
+    threshold = getattr(conn, "prepareThreshold", -1)
+    if threshold < 0:
+        curs.execute(sql, params)
+        return
+
+    prepared = conn.preparedStatements.get(sql)
+    if prepared is None:
+        hits = conn.statementHits.get(sql, 0) + 1
+        conn.statementHits[sql] = hits
+
+        if hits <= threshold:
+            curs.execute(sql, params)
+            return
+
+        # Hot statement: prepare it on the server. It is kept there even if the transaction is rolled back,
+        # so it is registered as soon as prepared, apart from its execution, which may fail
+        conn.preparedCount += 1
+        name = f"stmt_{conn.preparedCount}"
+        paramNames = tuple(dict.fromkeys(__SQL_PARAM_PATTERN.findall(sql)))
+        paramNums = {n: f"${i + 1}" for i, n in enumerate(paramNames)}
+        sqlPrepare = __SQL_PARAM_PATTERN.sub(lambda m: paramNums[m.group(1)], sql)
+
+        log.debug(f"Preparing statement: {name}")
+        curs.execute(f"PREPARE {name} AS {sqlPrepare}")
+
+        prepared = conn.preparedStatements[sql] = (name, paramNames)
+        del conn.statementHits[sql]
+
+    name, paramNames = prepared
+    curs.execute(__executeSql(name, paramNames), [params[n] for n in paramNames])
+
+def __executeSql(name: str, paramNames: tuple[str]) -> str:
+    if not paramNames:
+        return f"EXECUTE {name};"
+    sqlParams = ", ".join("%s" for _ in paramNames)
+    return f"EXECUTE {name} ({sqlParams});"
@@ -16,8 +16,8 @@ from common.tools import getPeriodFromArgv, forEachSafely
 from api.finamapi import FinamApi
 
 import db.dbacc as dbacc
-from db.dbtools import DbParams, ColumnDef 
-from db.dbtools import dbConnect, dbTempTable, dbLoadData, dbMerge
+from db.dbtools import DbParams, DbPool, ColumnDef
+from db.dbtools import dbTempTable, dbLoadData, dbMerge
 
 class Account(NamedTuple):
     account_id: str
@@ -65,8 +65,11 @@ class Ingestor:
         "LOAN": "Займ"
     }
 
+    pool: DbPool
     conn: Any
     finamApi: FinamApi
+    accountIds: dict[str, int]
+    opCodes: list[str]
 
     def __init__(self):
         initConfig(self.PROFILE)
@@ -79,17 +82,32 @@ class Ingestor:
         with open(config["tokenFile"], "r") as f:
             token = f.readline()
 
-        self.conn = dbConnect(DbParams.of(config["acc-db"]))
+        self.pool = DbPool(DbParams.of(config["acc-db"]))
         try:
-            with httpx.Client(http2=True) as http:
-                self.finamApi = FinamApi(http, token)
-                return self.process(startDate, endDate)
+            with self.pool.connection() as self.conn:
+                with httpx.Client(http2=True) as http:
+                    self.finamApi = FinamApi(http, token)
+                    return self.process(startDate, endDate)
         finally:
-            self.conn.close()
+            self.pool.close()
 
     def process(self, startDate: date, endDate: date) -> bool:
         accountCodes = self.finamApi.getAccountIds()
-        return forEachSafely(accountCodes, lambda accountCode: self.processAccount(accountCode, startDate, endDate))
+
+        with self.conn.cursor() as curs:
+            with self.conn:
+                self.accountIds = dbacc.dbInsertAccounts(curs, self.BROKER, accountCodes)
+
+        self.opCodes = []
+        success = forEachSafely(accountCodes, lambda accountCode: self.processAccount(accountCode, startDate, endDate))
+
+        # Transfers are linked across accounts, so once all of them are loaded
+        if self.opCodes:
+            with self.conn.cursor() as curs:
+                with self.conn:
+                    self.dbLinkOps(curs, self.opCodes)
+
+        return success
     
     def processAccount(self, accountCode: str, startDate: date, endDate: date) -> bool:
         log.info(f"Processing account: {accountCode}, period: {startDate.isoformat()} to {endDate.isoformat()}")
@@ -111,10 +129,9 @@ class Ingestor:
         self.validateQuantity(ops)
         self.fixOpCodes(accountCode, ops)
 
-        with self.conn.cursor() as curs:
-            with self.conn:
-                accountId = dbacc.dbInsertAccount(curs, self.BROKER, accountCode)
+        accountId = self.accountIds[accountCode]
 
+        with self.conn.cursor() as curs:
             with self.conn:
                 symbols = {op.symbol for op in ops if op.symbol}
                 symbols = self.filterNewSymbols(curs, symbols)
@@ -127,8 +144,9 @@ class Ingestor:
             with self.conn:
                 if ops:
                     self.dbLoadOps(curs, accountId, ops)
+                    self.dbUpdatePositions(curs, [op.code for op in ops])
 
-                self.dbLinkOps(curs)
+        self.opCodes.extend(op.code for op in ops)
 
     def fetchAccount(self, accountCode: str) -> Account:
         url = f"accounts/{accountCode}"
@@ -296,9 +314,13 @@ class Ingestor:
 
         dbMerge(curs, "ops", stagingTable, on=("broker", "code"), cols=cols)
 
-    def dbLinkOps(self, curs) -> None:
-        log.info(f"Linking operations in DB")
-        curs.execute("CALL link_ops_finam();")
+    def dbUpdatePositions(self, curs, codes: list[str]) -> None:
+        log.info(f"Updating positions in DB")
+        curs.execute("CALL update_positions(%s, %s);", (self.BROKER, codes))
+
+    def dbLinkOps(self, curs, codes: list[str]) -> None:
+        log.info(f"Linking operations in DB, {len(codes)} loaded")
+        curs.execute("CALL link_ops_finam(%s);", (codes,))
 
 def main() -> int:
     ingestor = Ingestor()
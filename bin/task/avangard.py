@@ -13,7 +13,7 @@ from common.tools import forEachSafely
 from api.legacyssl import getLegacySession
 
 import db.dbfin as dbfin
-from db.dbtools import DbParams, dbConnect
+from db.dbtools import DbParams, DbPool
 
 class Parser(HTMLParser):
     def __init__(self, tableId: str):
@@ -67,25 +67,33 @@ class Ingestor:
 
     PAGE_URL = "https://www.avangard.ru/rus/private/preciousmetal/goldbrick"
 
+    pool: DbPool
     conn: Any
+    trades: dbfin.TradesBatch
 
     def __init__(self):
         initConfig(self.PROFILE)
         initLogging(config.get("logLevel"))
 
     def run(self) -> bool:
-        self.conn = dbConnect(DbParams.of(config["db"]))
+        self.pool = DbPool(DbParams.of(config["db"]))
         try:
-            return self.process()
+            with self.pool.connection() as self.conn:
+                return self.process()
         finally:
-            self.conn.close()
+            self.pool.close()
 
     def process(self) -> bool:
         log.info(f"Fetching HTML")
         html = self.fetchHtml()
 
         tables = ("rate_list", "rate_list_new")
-        return forEachSafely(tables, lambda table: self.parseTable(html, table))
+
+        with self.conn.cursor() as curs:
+            with self.conn:
+                with dbfin.TradesBatch(curs, dbfin.Trades.C, skipUnchanged=config.get("skipUnchanged", True), pool=self.pool) as self.trades:
+                    success = forEachSafely(tables, lambda table: self.parseTable(html, table))
+                    return self.trades.merge() and success
 
     def fetchHtml(self) -> str:
         session = getLegacySession()
@@ -116,19 +124,21 @@ class Ingestor:
 
         log.info(f"Parsed {len(parser.rows)} rows for {dt.date().isoformat()}")
 
-        return forEachSafely(parser.rows, lambda r: self.dbLoad(r[0], dt, Decimal(r[2].replace(" ", ""))))
+        assetDefs = [self.getAssetDef(r[0]) for r in parser.rows]
+        assetIds = dbfin.dbInsertAssetsSafely(self.trades.curs, assetDefs)
+
+        return forEachSafely(parser.rows, lambda r: self.dbLoad(assetIds, r[0], dt, Decimal(r[2].replace(" ", ""))))
 
-    def dbLoad(self, unit: str, dt: datetime, price: Decimal) -> None:
+    def getAssetDef(self, unit: str) -> dbfin.AssetDef:
         assetCode = f"gold-{unit}-sell"
-        log.info(f"Loading into DB: {self.MARKET} {assetCode}")
+        return dbfin.AssetDef(self.MARKET, assetCode, f"{self.MARKET} {assetCode}", unit)
 
-        with self.conn.cursor() as curs:
-            with self.conn:
-                assetName = f"{self.MARKET} {assetCode}"
-                assetId = dbfin.dbInsertAsset(curs, self.MARKET, assetCode, assetName, unit)
+    def dbLoad(self, assetIds: dict[tuple[str, str], int], unit: str, dt: datetime, price: Decimal) -> None:
+        asset = self.getAssetDef(unit)
+        log.info(f"Loading into DB: {asset.market} {asset.code}")
 
-            with self.conn:
-                dbfin.dbInsertTrades(curs, assetId, [(dt, price)], dbfin.Trades.C, dbfin.AggType.DAILY)
+        assetId = assetIds[(asset.market, asset.code)]
+        self.trades.add(assetId, dbfin.AggType.DAILY, [(dt, price)])
 
 def main() -> int:
     ingestor = Ingestor()
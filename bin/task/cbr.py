@@ -12,7 +12,7 @@ from common.tools import getPeriodFromArgv, forEachSafely, toIterable
 from api.soapclient import callSoap
 
 import db.dbfin as dbfin
-from db.dbtools import DbParams, dbConnect
+from db.dbtools import DbParams, DbPool
 
 class Value(NamedTuple):
     dt: date
@@ -24,7 +24,10 @@ class Ingestor:
 
     API_URL = "https://www.cbr.ru/DailyInfoWebServ/DailyInfo.asmx"
 
+    pool: DbPool
     conn: Any
+    trades: dbfin.TradesBatch
+    assetIds: dict[tuple[str, str], int]
 
     def __init__(self):
         initConfig(self.PROFILE)
@@ -34,23 +37,40 @@ class Ingestor:
         tomorrow = date.today() + timedelta(days=1)
         startDate, endDate = getPeriodFromArgv(tomorrow - timedelta(days=10), tomorrow)
 
-        self.conn = dbConnect(DbParams.of(config["db"]))
+        self.pool = DbPool(DbParams.of(config["db"]))
         try:
-            return self.process(startDate, endDate)
+            with self.pool.connection() as self.conn:
+                return self.process(startDate, endDate)
         finally:
-            self.conn.close()
+            self.pool.close()
 
     def process(self, startDate: date, endDate: date) -> bool:
         proc = (
             lambda: self.processCurRates(startDate, endDate),
             lambda: self.processMetalPrices(startDate, endDate)
         )
-        return forEachSafely(proc, lambda p: p())
 
-    def processCurRates(self, startDate: date, endDate: date) -> bool:
+        with self.conn.cursor() as curs:
+            with self.conn:
+                with dbfin.TradesBatch(curs, dbfin.Trades.C, skipUnchanged=config.get("skipUnchanged", True), pool=self.pool) as self.trades:
+                    codes = self.getCurCodes() + [f"METAL{metalCode}" for metalCode in self.getMetalCodes()]
+                    self.assetIds = dbfin.dbInsertAssetsSafely(curs, [dbfin.AssetDef(self.MARKET, code) for code in codes])
+
+                    success = forEachSafely(proc, lambda p: p())
+                    return self.trades.merge() and success
+
+    def getCurCodes(self) -> list[str]:
         # CBR's internal currency codes
         # See also: https://www.cbr.ru/dailyinfowebserv/dailyinfo.asmx?op=EnumValutesXML
-        curCodes = toIterable(config.get("curCodes", []))
+        return list(toIterable(config.get("curCodes", [])))
+
+    def getMetalCodes(self) -> set[int]:
+        # CBR's internal metal codes
+        # See also: https://www.cbr.ru/development/DWS - DragMetDynamic
+        return set(toIterable(config.get("metalCodes", [])))
+
+    def processCurRates(self, startDate: date, endDate: date) -> bool:
+        curCodes = self.getCurCodes()
         return forEachSafely(curCodes, lambda curCode: self.processRatesForCur(curCode, startDate, endDate))
 
     def processRatesForCur(self, curCode: str, startDate: date, endDate: date) -> None:
@@ -84,9 +104,7 @@ class Ingestor:
         ]
 
     def processMetalPrices(self, startDate: date, endDate: date) -> bool:
-        # CBR's internal metal codes
-        # See also: https://www.cbr.ru/development/DWS - DragMetDynamic
-        metalCodes = set(toIterable(config.get("metalCodes", [])))
+        metalCodes = self.getMetalCodes()
 
         log.info(f"Processing metal codes: {metalCodes}, period: {startDate.isoformat()} to {endDate.isoformat()}")
 
@@ -121,12 +139,8 @@ class Ingestor:
     def dbLoad(self, code: str, values: list[Value]) -> None:
         log.info(f"Loading into DB: {self.MARKET} {code}")
 
-        with self.conn.cursor() as curs:
-            with self.conn:
-                assetId = dbfin.dbInsertAsset(curs, self.MARKET, code)
-
-            with self.conn:
-                dbfin.dbInsertTrades(curs, assetId, values, dbfin.Trades.C, dbfin.AggType.DAILY)
+        assetId = self.assetIds[(self.MARKET, code)]
+        self.trades.add(assetId, dbfin.AggType.DAILY, values)
 
 def main() -> int:
     ingestor = Ingestor()
@@ -0,0 +1,82 @@
+import logging as log
+from typing import Any
+from datetime import datetime
+
+from common.config import config, initConfig
+from common.logtools import initLogging
+from common.tools import forEachSafely
+
+import db.dbsqlite as dbsqlite
+from db.dbtools import DbParams, dbConnect
+
+PROFILE = "compact"
+
+# Intraday trades older than retention days are rolled into daily ones
+RETENTION_DAYS = 90
+
+def main() -> int:
+    initConfig(PROFILE)
+    initLogging(config.get("logLevel"))
+
+    retentionDays = int(config.get("retentionDays", RETENTION_DAYS))
+    ohlc = bool(config.get("ohlc", False))
+    archive = bool(config.get("archive", False))
+
+    conn = dbConnect(DbParams.of(config["db"]))
+    try:
+        success = compact(conn, retentionDays, ohlc=ohlc, archive=archive)
+    finally:
+        conn.close()
+
+    return 0 if success else 1
+
+def compact(conn: Any, retentionDays: int, *, ohlc: bool = False, archive: bool = False) -> bool:
+    log.info(f"Compacting intraday trades older than {retentionDays} days, ohlc: {ohlc}, archive: {archive}")
+
+    # Batch is a month of an asset, each one compacted in its own transaction
+    with conn.cursor() as curs:
+        with conn:
+            if dbsqlite.isSqlite(curs):
+                # Periods are formatted as the stored timestamps, being compared with them as text
+                curs.execute("""
+                    WITH c AS (SELECT STRFTIME('%%Y-%%m-%%dT00:00:00+00:00', 'now', -%s || ' days') AS cutoff_dt)
+                    SELECT t.asset_id, STRFTIME('%%Y-%%m-01T00:00:00+00:00', t.dt) AS start_dt,
+                        MIN(STRFTIME('%%Y-%%m-%%dT00:00:00+00:00', t.dt, 'start of month', '+1 month'), c.cutoff_dt)
+                    FROM trades AS t, c
+                    WHERE t.agg_type = 'I'
+                        AND t.dt < c.cutoff_dt
+                    GROUP BY t.asset_id, start_dt, c.cutoff_dt
+                    ORDER BY t.asset_id, start_dt;
+                    """, (retentionDays,))
+            else:
+                curs.execute("""
+                    WITH c AS (SELECT DATE_TRUNC('day', CURRENT_TIMESTAMP - %s * INTERVAL '1 day') AS cutoff_dt)
+                    SELECT t.asset_id, DATE_TRUNC('month', t.dt) AS start_dt, LEAST(DATE_TRUNC('month', t.dt) + INTERVAL '1 month', c.cutoff_dt)
+                    FROM trades AS t, c
+                    WHERE t.agg_type = 'I'
+                        AND t.dt < c.cutoff_dt
+                    GROUP BY t.asset_id, start_dt, c.cutoff_dt
+                    ORDER BY t.asset_id, start_dt;
+                    """, (retentionDays,))
+            batches = curs.fetchall()
+
+    log.info(f"Found {len(batches)} asset months to compact")
+
+    return forEachSafely(batches, lambda batch: compactBatch(conn, *batch, ohlc=ohlc, archive=archive))
+
+def compactBatch(conn: Any, assetId: int, startDt: datetime, endDt: datetime, *, ohlc: bool, archive: bool) -> None:
+    log.debug(f"Compacting asset id: {assetId}, from: {startDt}, to: {endDt}")
+
+    with conn.cursor() as curs:
+        with conn:
+            # Function is a procedure of the schema in SQLite, selecting the counts at last
+            if dbsqlite.isSqlite(curs):
+                curs.execute("CALL compact_intraday_trades(%s, %s, %s, %s, %s);", (assetId, startDt, endDt, ohlc, archive))
+            else:
+                curs.execute("SELECT * FROM compact_intraday_trades(%s, %s, %s, %s, %s);", (assetId, startDt, endDt, ohlc, archive))
+            added, removed = curs.fetchone()
+
+    log.info(f"Compacted asset id: {assetId}, month: {str(startDt)[:7]}, {removed} intraday trades into {added} daily ones")
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,348 @@
+import os, sys, io, gzip, json, time
+import logging as log
+from typing import Any, Callable
+from datetime import datetime, timedelta
+
+from common.config import config, initConfig
+from common.logtools import initLogging
+from common.datetools import dateToDt, MOSCOW_TZ
+from common.filetools import saveJson
+from common.tools import getPeriodFromArgv, forEachSafely
+
+import db.dbsqlite as dbsqlite
+from db.dbtools import DbParams, dbConnect, dbUnloadCsv
+
+# Optional, needed for Parquet format only
+try:
+    import pyarrow, pyarrow.csv, pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Full mode exports all rows matching the filter, incremental one only the rows
+# updated since the previous export of the dataset (the watermark)
+EXPORT_MODES = ("full", "incremental")
+EXPORT_FORMATS = ("csv", "parquet")
+
+# Tables to export, all of them having asset_id, dt and updated columns
+DATASETS = ("trades", "daily_prices", "metal_prices")
+
+# Rows per output file, which is also the amount of data held in memory for Parquet
+CHUNK_ROWS = 1000000
+
+# Gzip level of CSV, lower ones are faster at the cost of size
+COMPRESS_LEVEL = 6
+
+# Updated is stamped with the start time of the writing transaction, so a long one may commit rows
+# older than the watermark taken meanwhile. Rows updated within this margin before the watermark
+# are exported again, and duplicates of them are to be resolved downstream by key and updated.
+WATERMARK_OVERLAP_MINUTES = 60
+
+STATE_FILE = "export-state.json"
+
+class ChunkWriter(io.TextIOBase):
+    # File-like sink for CSV stream, splitting it into chunks of whole rows.
+    # Row ends with line feed out of quotes, and quotes in CSV are always paired
+    # (escaped ones are doubled), so parity of their count tells where it is.
+
+    rows: int
+    chunks: int
+
+    def __init__(self, openChunk: Callable[[int], Any], chunkRows: int):
+        self.__openChunk = openChunk
+        self.__chunkRows = chunkRows
+        self.__chunk = None
+        self.__chunkRowCount = 0
+        self.__quoted = False
+        self.rows = 0
+        self.chunks = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: str) -> int:
+        start = 0
+        if self.__quoted or '"' in data or self.__chunkRowCount + data.count("\n") >= self.__chunkRows:
+            pos = 0
+            while (end := data.find("\n", pos)) >= 0:
+                if data.count('"', pos, end) % 2:
+                    self.__quoted = not self.__quoted
+                pos = end + 1
+                if self.__quoted:
+                    continue
+
+                self.__chunkRowCount += 1
+                if self.__chunkRowCount == self.__chunkRows:
+                    self.__writeChunk(data[start:pos])
+                    self.__closeChunk()
+                    start = pos
+
+            if data.count('"', pos) % 2:
+                self.__quoted = not self.__quoted
+        else:
+            self.__chunkRowCount += data.count("\n")
+
+        if start < len(data):
+            self.__writeChunk(data[start:])
+        return len(data)
+
+    def close(self) -> None:
+        if self.__chunk is not None:
+            self.__closeChunk()
+        super().close()
+
+    def discard(self) -> None:
+        # On failure, the chunk being written is dropped, while complete ones are kept
+        if self.__chunk is not None:
+            self.__chunk.discard()
+            self.__chunk = None
+        super().close()
+
+    def __writeChunk(self, data: str) -> None:
+        if self.__chunk is None:
+            self.__chunk = self.__openChunk(self.chunks + 1)
+        self.__chunk.write(data)
+
+    def __closeChunk(self) -> None:
+        self.__chunk.close()
+        self.__chunk = None
+        self.rows += self.__chunkRowCount
+        self.__chunkRowCount = 0
+        self.chunks += 1
+
+class CsvChunk:
+    # Gzipped CSV file with header, renamed into place when complete
+
+    def __init__(self, fileName: str, cols: list[str], compressLevel: int):
+        self.fileName = fileName
+        self.__f = gzip.open(f"{fileName}.part", "wt", compresslevel=compressLevel, newline="")
+        self.__f.write(",".join(cols) + "\n")
+
+    def write(self, data: str) -> None:
+        self.__f.write(data)
+
+    def close(self) -> None:
+        self.__f.close()
+        os.replace(f"{self.fileName}.part", self.fileName)
+
+    def discard(self) -> None:
+        self.__f.close()
+        os.remove(f"{self.fileName}.part")
+
+class ParquetChunk:
+    # Parquet file, converted from CSV of the whole chunk when complete
+
+    def __init__(self, fileName: str, cols: list[str], types: dict[str, Any]):
+        self.fileName = fileName
+        self.__cols = cols
+        self.__types = types
+        self.__buffer = io.StringIO()
+
+    def write(self, data: str) -> None:
+        self.__buffer.write(data)
+
+    def close(self) -> None:
+        data = io.BytesIO(self.__buffer.getvalue().encode())
+        self.__buffer = None
+
+        # Unquoted empty value is NULL in CSV of COPY, while empty string is quoted
+        table = pyarrow.csv.read_csv(data,
+            read_options=pyarrow.csv.ReadOptions(column_names=self.__cols),
+            parse_options=pyarrow.csv.ParseOptions(newlines_in_values=True),
+            convert_options=pyarrow.csv.ConvertOptions(
+                column_types=self.__types,
+                strings_can_be_null=True,
+                quoted_strings_can_be_null=False))
+
+        pyarrow.parquet.write_table(table, f"{self.fileName}.part")
+        os.replace(f"{self.fileName}.part", self.fileName)
+
+    def discard(self) -> None:
+        self.__buffer = None
+        if os.path.isfile(f"{self.fileName}.part"):
+            os.remove(f"{self.fileName}.part")
+
+class Exporter:
+    PROFILE = "export"
+
+    mode: str
+    format: str
+    datasets: list[str]
+    outputDir: str
+    chunkRows: int
+    compressLevel: int
+    markets: list[str]
+    assets: list[str]
+    watermarkOverlap: timedelta
+    period: tuple[datetime, datetime] | None
+    state: dict[str, str]
+
+    def __init__(self):
+        initConfig(self.PROFILE)
+        initLogging(config.get("logLevel"))
+
+        self.mode = config.get("mode", "full")
+        if self.mode not in EXPORT_MODES:
+            raise Exception(f"Invalid export mode: {self.mode}")
+
+        self.format = config.get("format", "csv")
+        if self.format not in EXPORT_FORMATS:
+            raise Exception(f"Invalid export format: {self.format}")
+        if self.format == "parquet" and pyarrow is None:
+            raise Exception(f"Export to Parquet requires pyarrow package")
+
+        self.datasets = config.get("datasets", list(DATASETS))
+        invalid = [d for d in self.datasets if d not in DATASETS]
+        if invalid:
+            raise Exception(f"Invalid datasets: {invalid}")
+
+        self.outputDir = config["outputDir"]
+        self.chunkRows = int(config.get("chunkRows", CHUNK_ROWS))
+        self.compressLevel = int(config.get("compressLevel", COMPRESS_LEVEL))
+        self.markets = config.get("markets", [])
+        self.assets = config.get("assets", [])
+        self.watermarkOverlap = timedelta(minutes=int(config.get("watermarkOverlapMinutes", WATERMARK_OVERLAP_MINUTES)))
+
+    def run(self) -> bool:
+        # Whole history is exported unless period is given
+        self.period = None
+        if len(sys.argv) >= 2:
+            startDate, endDate = getPeriodFromArgv()
+            self.period = (dateToDt(startDate, MOSCOW_TZ), dateToDt(endDate, MOSCOW_TZ) + timedelta(days=1))
+
+        self.state = self.loadState()
+
+        conn = dbConnect(DbParams.of(config["db"]))
+        try:
+            return forEachSafely(self.datasets, lambda dataset: self.export(conn, dataset))
+        finally:
+            conn.close()
+
+    def export(self, conn: Any, dataset: str) -> None:
+        log.info(f"Exporting {dataset}, mode: {self.mode}, format: {self.format}")
+
+        where, params = self.filterSql()
+        watermark = self.state.get(dataset) if self.mode == "incremental" else None
+
+        with conn.cursor() as curs:
+            with conn:
+                if not dbsqlite.isSqlite(curs):
+                    curs.execute("SET LOCAL TIME ZONE 'UTC';")
+
+                if self.mode == "incremental":
+                    if watermark is not None:
+                        where.append("t.updated > %s")
+                        params.append(self.sinceWatermark(curs, watermark))
+
+                    curs.execute(f"SELECT MAX(t.updated) FROM {dataset} AS t {self.joinSql()} {self.whereSql(where)};", params)
+                    newWatermark = curs.fetchone()[0]
+                    if newWatermark is None:
+                        log.info(f"No rows updated since: {watermark}")
+                        return
+
+                    # Rows updated after the watermark was taken are left for the next export, those committed
+                    # late, though stamped before it, are caught by the next one within the overlap margin
+                    where.append("t.updated <= %s")
+                    params.append(newWatermark)
+
+                sql = f"SELECT t.* FROM {dataset} AS t {self.joinSql()} {self.whereSql(where)}"
+                curs.execute(f"{sql} LIMIT 0;", params)
+                cols = [d[0] for d in curs.description]
+                types = self.arrowTypes(curs.description)
+
+                startTime = time.monotonic()
+                ts = datetime.now().strftime("%Y%m%d-%H%M%S")
+                dir = os.path.join(self.outputDir, dataset)
+                os.makedirs(dir, exist_ok=True)
+
+                def openChunk(n: int) -> Any:
+                    fileName = os.path.join(dir, f"{dataset}.{ts}.{n:04}")
+                    if self.format == "parquet":
+                        return ParquetChunk(f"{fileName}.parquet", cols, types)
+                    return CsvChunk(f"{fileName}.csv.gz", cols, self.compressLevel)
+
+                writer = ChunkWriter(openChunk, self.chunkRows)
+                try:
+                    dbUnloadCsv(curs, sql, params, writer)
+                    writer.close()
+                finally:
+                    if not writer.closed:
+                        writer.discard()
+
+        elapsed = time.monotonic() - startTime
+        log.info(f"Exported {writer.rows} rows into {writer.chunks} files in {elapsed:.1f} s")
+
+        if self.mode == "incremental":
+            self.state[dataset] = newWatermark if isinstance(newWatermark, str) else newWatermark.isoformat()
+            saveJson(os.path.join(self.outputDir, STATE_FILE), self.state)
+
+    def sinceWatermark(self, curs, watermark: str) -> Any:
+        since = datetime.fromisoformat(watermark) - self.watermarkOverlap
+
+        # Compared as text by SQLite, in the format of its CURRENT_TIMESTAMP
+        if dbsqlite.isSqlite(curs):
+            return since.strftime("%Y-%m-%d %H:%M:%S")
+        return since
+
+    def filterSql(self) -> tuple[list[str], list[Any]]:
+        where, params = [], []
+
+        if self.markets:
+            where.append(f"a.market IN ({", ".join("%s" for _ in self.markets)})")
+            params.extend(self.markets)
+
+        if self.assets:
+            where.append(f"a.code IN ({", ".join("%s" for _ in self.assets)})")
+            params.extend(self.assets)
+
+        if self.period is not None:
+            where.append("t.dt >= %s AND t.dt < %s")
+            params.extend(self.period)
+
+        return where, params
+
+    def joinSql(self) -> str:
+        if not self.markets and not self.assets:
+            return ""
+        return "JOIN assets AS a ON a.id = t.asset_id"
+
+    def whereSql(self, where: list[str]) -> str:
+        if not where:
+            return ""
+        return "WHERE " + " AND ".join(where)
+
+    def arrowTypes(self, description: Any) -> dict[str, Any]:
+        if pyarrow is None:
+            return {}
+
+        # By type OIDs of PostgreSQL, others (and all of SQLite) are left to inference
+        types = {}
+        for d in description:
+            typeCode = getattr(d, "type_code", None)
+            if typeCode in (20, 21, 23):
+                types[d.name] = pyarrow.int64()
+            elif typeCode == 1700:
+                types[d.name] = pyarrow.decimal128(d.precision, d.scale) if d.precision else pyarrow.float64()
+            elif typeCode == 1184:
+                types[d.name] = pyarrow.timestamp("us", tz="UTC")
+            elif typeCode == 1114:
+                types[d.name] = pyarrow.timestamp("us")
+            elif typeCode == 1082:
+                types[d.name] = pyarrow.date32()
+            elif typeCode in (25, 1043):
+                types[d.name] = pyarrow.string()
+        return types
+
+    def loadState(self) -> dict[str, str]:
+        fileName = os.path.join(self.outputDir, STATE_FILE)
+        if not os.path.isfile(fileName):
+            return {}
+
+        with open(fileName, "r") as f:
+            return json.load(f)
+
+def main() -> int:
+    exporter = Exporter()
+    return 0 if exporter.run() else 1
+
+if __name__ == "__main__":
+    exit(main())
@@ -1,22 +1,24 @@
 import logging as log
+import asyncio
 import httpx
 import re
-from typing import Any
+from typing import Any, Iterable, Iterator
 from typing import NamedTuple
 from datetime import date, datetime, timedelta
 from decimal import Decimal
-from collections import defaultdict
+from collections import defaultdict, deque
 
 from common.config import config, initConfig
 from common.logtools import initLogging
 from common.dtotools import ofmethod
-from common.tools import getPeriodFromArgv, forEachSafely, toIterable
+from common.tools import getPeriodFromArgv, forEachSafely, toIterable, StreamStats
 from common.datetools import dateToDt, MOSCOW_TZ
 
-from api.finamapi import FinamApi
+from api.finamapi import AsyncFinamApi
 
 import db.dbfin as dbfin
-from db.dbtools import DbParams, dbConnect
+import db.dbasync as dbasync
+from db.dbtools import DbParams, DbPool
 
 class SearchParams(NamedTuple):
     mic: str
@@ -43,8 +45,17 @@ class Ingestor:
 
     TIME_FRAME = "TIME_FRAME_D"
 
+    # Longest period fetched per request, keeps responses bounded for long backfills
+    FETCH_WINDOW_DAYS = 365
+
+    # Windows of an asset fetched ahead of loading, memory is bounded by them times assets in flight
+    PREFETCH_WINDOWS = 4
+
+    pool: DbPool
     conn: Any
-    finamApi: FinamApi
+    finamApi: AsyncFinamApi
+    trades: dbfin.TradesBatch
+    assetIds: dict[tuple[str, str], int]
 
     def __init__(self):
         initConfig(self.PROFILE)
@@ -57,15 +68,14 @@ class Ingestor:
         with open(config["tokenFile"], "r") as f:
             token = f.readline()
 
-        self.conn = dbConnect(DbParams.of(config["db"]))
+        self.pool = DbPool(DbParams.of(config["db"]))
         try:
-            with httpx.Client(http2=True) as http:
-                self.finamApi = FinamApi(http, token)
-                return self.process(startDate, endDate)
+            with self.pool.connection() as self.conn:
+                return asyncio.run(self.process(token, startDate, endDate))
         finally:
-            self.conn.close()
+            self.pool.close()
 
-    def process(self, startDate: date, endDate: date) -> bool:
+    async def process(self, token: str, startDate: date, endDate: date) -> bool:
         searchParams = [
             SearchParams(
                 mic=s["mic"],
@@ -73,32 +83,101 @@ class Ingestor:
                 tickers=toIterable(s.get("tickers"))) 
             for s in config.get("assets", [])
         ]
-        assets = self.findAssets(searchParams)
-        return forEachSafely(assets, lambda asset: self.processAsset(asset, startDate, endDate))
 
-    def processAsset(self, asset: Asset, startDate: date, endDate: date) -> None:
-        log.info(f"Processing: {asset.symbol}, period: {startDate.isoformat()} to {endDate.isoformat()}")
+        # Requests of all assets share one HTTP/2 connection, with a bounded number of them in flight
+        async with httpx.AsyncClient(http2=True) as http:
+            self.finamApi = AsyncFinamApi(http, token, config.get("maxConcurrency"))
+            assets = await self.findAssets(searchParams)
+            self.assetIds = await self.dbInsertAssets(assets)
+
+            with self.conn.cursor() as curs:
+                with self.conn:
+                    valueCols = (dbfin.Trades.O, dbfin.Trades.H, dbfin.Trades.L, dbfin.Trades.C, dbfin.Trades.V)
+                    with dbfin.TradesBatch(curs, valueCols, skipUnchanged=config.get("skipUnchanged", True), pool=self.pool) as self.trades:
+                        success = await self.processAssets(assets, startDate, endDate)
+                        return self.trades.merge() and success
+
+    async def dbInsertAssets(self, assets: list[Asset]) -> dict[tuple[str, str], int]:
+        assetDefs = [dbfin.AssetDef(a.mic, a.ticker, a.name) for a in assets]
+
+        params = self.pool.params
+        if params.engine != "postgresql":
+            with self.conn.cursor() as curs:
+                with self.conn:
+                    return dbfin.dbInsertAssetsSafely(curs, assetDefs, update=True)
+
+        # Upserted in one round trip on a connection of their own, and committed before trades refer to them
+        conn = await dbasync.dbConnect(params)
+        try:
+            return await dbfin.dbInsertAssetsAsync(conn, assetDefs, update=True)
+        finally:
+            await conn.close()
+
+    async def processAssets(self, assets: list[Asset], startDate: date, endDate: date) -> bool:
+        log.info(f"Processing {len(assets)} assets, period: {startDate.isoformat()} to {endDate.isoformat()}")
 
         startDt = dateToDt(startDate, MOSCOW_TZ)
         endDt = dateToDt(endDate, MOSCOW_TZ) + timedelta(days=1)
 
-        bars = self.fetchBars(asset.symbol, startDt, endDt, self.TIME_FRAME)
-        if not bars:
+        # Assets are fetched a few at a time, as many as requests in flight, each one window after window.
+        # They are loaded one at a time, in order of their first window arrival, in a thread consuming
+        # windows as they come, so that neither HTTP waits for COPY, nor the other way round.
+        slots = asyncio.Semaphore(config.get("maxConcurrency") or AsyncFinamApi.MAX_CONCURRENCY)
+        ready = asyncio.Queue()
+        prefetch = config.get("prefetchWindows", self.PREFETCH_WINDOWS)
+        loop = asyncio.get_running_loop()
+        fetches = set()
+
+        async def startFetches() -> None:
+            for asset in assets:
+                await slots.acquire()
+                fetch = asyncio.create_task(self.fetchAsset(asset, startDt, endDt, prefetch, ready, slots))
+                fetches.add(fetch)
+                fetch.add_done_callback(fetches.discard)
+
+        starter = asyncio.create_task(startFetches())
+
+        success = True
+        try:
+            for _ in assets:
+                asset, windows, fetch = await ready.get()
+                try:
+                    await asyncio.to_thread(self.processAsset, asset, self.streamBars(windows, loop))
+                except Exception:
+                    log.exception(f"Failed to process: {asset}")
+                    success = False
+                finally:
+                    fetch.cancel()
+        finally:
+            starter.cancel()
+            for fetch in list(fetches):
+                fetch.cancel()
+
+        return success
+
+    def processAsset(self, asset: Asset, bars: Iterable[Bar]) -> None:
+        log.info(f"Processing: {asset.symbol}")
+
+        stats = StreamStats(key=lambda b: b.timestamp)
+        bars = stats.track(self.validateBars(bars))
+
+        self.dbLoad(asset, bars)
+
+        if not stats.count:
             log.warning("No bars retrieved")
             return
-        
-        key = lambda b: b.timestamp
-        count, start, end = len(bars), min(bars, key=key), max(bars, key=key)
-        log.info(f"Fetched {count} bars, period: {start.timestamp.isoformat()} to {end.timestamp.isoformat()}")
 
-        if any(b.volume != int(b.volume) for b in bars):
-            raise ValueError("Fractional volumes do not supported")
+        log.info(f"Fetched {stats.count} bars, period: {stats.min.timestamp.isoformat()} to {stats.max.timestamp.isoformat()}")
 
-        self.dbLoad(asset, bars)
+    def validateBars(self, bars: Iterable[Bar]) -> Iterator[Bar]:
+        for b in bars:
+            if b.volume != int(b.volume):
+                raise ValueError("Fractional volumes do not supported")
+            yield b
 
-    def findAssets(self, searchParams: list[SearchParams]) -> list[Asset]:
+    async def findAssets(self, searchParams: list[SearchParams]) -> list[Asset]:
         assets = defaultdict(dict)
-        for a in self.fetchAssets():
+        for a in await self.fetchAssets():
             assets[a.mic][a.ticker] = a
             
         searchTickers = [s for s in searchParams if s.tickers]
@@ -125,23 +204,78 @@ class Ingestor:
                     log.warning(f"Found no assets for {s.mic} by pattern: {pattern}")
                 foundAssets.update(a)
 
-        return foundAssets.values()
+        return list(foundAssets.values())
 
-    def fetchAssets(self) -> list[Asset]:
-        data = self.finamApi.get("assets", None)
+    async def fetchAssets(self) -> list[Asset]:
+        data = await self.finamApi.get("assets", None)
         return [Asset.of(a) for a in data["assets"]]
 
-    def fetchBars(self, symbol: str, startDt: datetime, endDt: datetime, timeFrame: str) -> list[Bar]:
+    async def fetchAsset(self,
+                         asset: Asset,
+                         startDt: datetime,
+                         endDt: datetime,
+                         prefetch: int,
+                         ready: asyncio.Queue,
+                         slots: asyncio.Semaphore) -> None:
+
+        # Puts the asset into ready queue along with the first window, and then bars of windows
+        # into its own queue, in order, ending with None or an exception
+        window = timedelta(days=config.get("fetchWindowDays", self.FETCH_WINDOW_DAYS))
+        windows = asyncio.Queue(1)
+        pending = deque()
+        try:
+            try:
+                while startDt < endDt or pending:
+                    while startDt < endDt and len(pending) < prefetch:
+                        windowEndDt = min(startDt + window, endDt)
+                        pending.append(asyncio.create_task(self.fetchBarsWindow(asset.symbol, startDt, windowEndDt, self.TIME_FRAME)))
+                        startDt = windowEndDt
+
+                    bars = await pending.popleft()
+                    if ready is not None:
+                        ready.put_nowait((asset, windows, asyncio.current_task()))
+                        ready = None
+                    await windows.put(bars)
+                last = None
+            except Exception as e:
+                last = e
+
+            if ready is not None:
+                ready.put_nowait((asset, windows, asyncio.current_task()))
+            await windows.put(last)
+        finally:
+            for fetch in pending:
+                fetch.cancel()
+            slots.release()
+
+    def streamBars(self, windows: asyncio.Queue, loop: asyncio.AbstractEventLoop) -> Iterator[Bar]:
+        # Runs in a thread, taking windows from the event loop as they arrive
+        prevMaxDt, maxDt = None, None
+        while (bars := asyncio.run_coroutine_threadsafe(windows.get(), loop).result()) is not None:
+            if isinstance(bars, Exception):
+                raise bars
+
+            # A bar on the window boundary may come in both adjacent windows
+            for bar in bars:
+                if prevMaxDt is None or bar.timestamp > prevMaxDt:
+                    maxDt = bar.timestamp if maxDt is None else max(maxDt, bar.timestamp)
+                    yield bar
+            prevMaxDt = maxDt
+
+    async def fetchBarsWindow(self, symbol: str, startDt: datetime, endDt: datetime, timeFrame: str) -> list[Bar]:
+        log.debug(f"Fetching bars of {symbol}, period: {startDt.isoformat()} to {endDt.isoformat()}")
+
         url = f"instruments/{symbol}/bars"
         params = {
             "interval.start_time": startDt.isoformat(),
             "interval.end_time": endDt.isoformat(),
             "timeframe": timeFrame
         }
-        data = self.finamApi.get(url, params)
+        data = await self.finamApi.get(url, params)
 
         return [
-            Bar(timestamp=datetime.fromisoformat(b["timestamp"]),
+            Bar(
+                timestamp=datetime.fromisoformat(b["timestamp"]),
                 open=Decimal(b["open"]["value"]),
                 high=Decimal(b["high"]["value"]),
                 low=Decimal(b["low"]["value"]),
@@ -150,16 +284,11 @@ class Ingestor:
             for b in data["bars"]
         ]
 
-    def dbLoad(self, asset: Asset, bars: list[Bar]) -> None:
+    def dbLoad(self, asset: Asset, bars: Iterable[Bar]) -> None:
         log.info(f"Loading into DB: {asset.mic} {asset.ticker}")
 
-        with self.conn.cursor() as curs:
-            with self.conn:
-                assetId = dbfin.dbInsertAsset(curs, asset.mic, asset.ticker, asset.name, update=True)
-
-            with self.conn:
-                valueCols = (dbfin.Trades.O, dbfin.Trades.H, dbfin.Trades.L, dbfin.Trades.C, dbfin.Trades.V)
-                dbfin.dbInsertTrades(curs, assetId, bars, valueCols, dbfin.AggType.DAILY)
+        assetId = self.assetIds[(asset.mic, asset.ticker)]
+        self.trades.add(assetId, dbfin.AggType.DAILY, bars)
 
 def main() -> int:
     ingestor = Ingestor()
@@ -12,7 +12,7 @@ from common.dtotools import ofmethod
 from common.tools import forEachSafely
 
 import db.dbfin as dbfin
-from db.dbtools import DbParams, dbConnect
+from db.dbtools import DbParams, DbPool
 
 @ofmethod
 class Product(NamedTuple):
@@ -36,22 +36,40 @@ class Ingestor:
     PRODUCT_LIST_URL = "v2/product/active-product"
     PRODUCT_PRICES_URL = "product/price-chart"
 
+    PRICE_TYPES = ("online", "offline")
+
+    pool: DbPool
     conn: Any
+    trades: dbfin.TradesBatch
+    assetIds: dict[tuple[str, str], int]
 
     def __init__(self):
         initConfig(self.PROFILE)
         initLogging(config.get("logLevel"))
 
     def run(self) -> bool:
-        self.conn = dbConnect(DbParams.of(config["db"]))
+        self.pool = DbPool(DbParams.of(config["db"]))
         try:
-            return self.process()
+            with self.pool.connection() as self.conn:
+                return self.process()
         finally:
-            self.conn.close()
+            self.pool.close()
 
     def process(self) -> bool:
         products = self.fetchProducts()
-        return forEachSafely(products, lambda product: self.processProduct(product))
+
+        with self.conn.cursor() as curs:
+            with self.conn:
+                with dbfin.TradesBatch(curs, dbfin.Trades.C, skipUnchanged=config.get("skipUnchanged", True), pool=self.pool) as self.trades:
+                    assetDefs = [
+                        dbfin.AssetDef(self.MARKET, self.getAssetCode(product, priceType), self.getAssetName(product, priceType), str(product.weight))
+                        for product in products
+                        for priceType in self.PRICE_TYPES
+                    ]
+                    self.assetIds = dbfin.dbInsertAssetsSafely(curs, assetDefs, update=True)
+
+                    success = forEachSafely(products, lambda product: self.processProduct(product))
+                    return self.trades.merge() and success
 
     def processProduct(self, product: Product) -> None:
         log.info(f"Processing: {product.description}")
@@ -102,28 +120,27 @@ class Ingestor:
         if not status:
             raise ValueError(f"Invalid status, return code: {data.get("status")}")
 
-    def dbLoad(self, product: Product, prices: list[Price]) -> None:
-        prefix = f"{product.metalType}-{product.type}-{product.productId}"
+    def getAssetCode(self, product: Product, priceType: str) -> str:
+        return f"{product.metalType}-{product.type}-{product.productId}-{priceType}-sell"
 
+    def getAssetName(self, product: Product, priceType: str) -> str:
+        return f"{product.description} ({priceType})"
+
+    def dbLoad(self, product: Product, prices: list[Price]) -> None:
         # Seems that Goznak data semantics is pretty reversed - fields with "buy" in their names are for sale prices, in fact
 
         data = [(p.date, p.buyPrice) for p in prices]
-        self.dbLoadAsset(prefix, "online", product, data)
+        self.dbLoadAsset("online", product, data)
 
         data = [(p.date, p.offlineBuyPrice) for p in prices]
-        self.dbLoadAsset(prefix, "offline", product, data)
+        self.dbLoadAsset("offline", product, data)
 
-    def dbLoadAsset(self, prefix: str, priceType: str, product: Product, prices: list[Price]) -> None:
-        assetCode = f"{prefix}-{priceType}-sell"
+    def dbLoadAsset(self, priceType: str, product: Product, prices: list[Price]) -> None:
+        assetCode = self.getAssetCode(product, priceType)
         log.info(f"Loading into DB: {self.MARKET} {assetCode}")
 
-        with self.conn.cursor() as curs:
-            with self.conn:
-                assetName = f"{product.description} ({priceType})"
-                assetId = dbfin.dbInsertAsset(curs, self.MARKET, assetCode, assetName, str(product.weight), update=True)
-
-            with self.conn:
-                dbfin.dbInsertTrades(curs, assetId, prices, dbfin.Trades.C, dbfin.AggType.DAILY)
+        assetId = self.assetIds[(self.MARKET, assetCode)]
+        self.trades.add(assetId, dbfin.AggType.DAILY, prices)
 
 def main() -> int:
     ingestor = Ingestor()
@@ -0,0 +1,247 @@
+import os, glob, json, time
+import threading
+import logging as log
+from typing import Any
+from queue import Queue
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from common.config import config, initConfig
+from common.logtools import initLogging
+from common.datetools import UTC_TZ, MOSCOW_TZ
+from common.tools import toIterable
+
+import db.dbfin as dbfin
+import db.dbsqlite as dbsqlite
+from db.dbtools import DbParams, DbPool, ColumnDef, MergeMode
+from db.dbtools import dbTempTable, dbLoadCsv, dbLoadData, dbMerge
+
+# CSV columns, in the order of files, mapped to staging ones by name. Either "code" of the asset
+# is among them, or it is taken from the file name (up to the first dot). Others are skipped with "-".
+COLUMN_DEFS = {
+    "code": dbfin.Assets.CODE,
+    "dt": dbfin.Trades.DT,
+    "o": dbfin.Trades.O,
+    "h": dbfin.Trades.H,
+    "l": dbfin.Trades.L,
+    "c": dbfin.Trades.C,
+    "v": dbfin.Trades.V,
+    "unit": dbfin.Trades.UNIT
+}
+SKIP_COLUMN = "-"
+
+STATE_FILE = "import-state.json"
+
+class Importer:
+    PROFILE = "import"
+
+    STAGING_TABLE = "import_staging"
+    ASSETS_TABLE = "import_assets"
+
+    inputDir: str
+    market: str
+    aggType: str
+    cols: tuple[ColumnDef]
+    valueCols: tuple[ColumnDef]
+    sep: str
+    mergeMode: MergeMode
+    timeZone: str
+
+    pool: DbPool
+    conn: Any
+
+    # Assets are resolved on the caller's connection, one worker at a time,
+    # for new ones to be committed before any other worker looks for them
+    assetLock: threading.Lock
+
+    # File name -> modification time of imported files, to resume from after an interruption
+    state: dict[str, int]
+    stateFile: str
+    stateLock: threading.Lock
+
+    rows: int
+    failed: list[str]
+
+    def __init__(self):
+        initConfig(self.PROFILE)
+        initLogging(config.get("logLevel"))
+
+        self.inputDir = config["inputDir"]
+        self.market = config["market"]
+        self.aggType = config.get("aggType", dbfin.AggType.DAILY)
+        self.sep = config.get("sep", ",")
+        self.mergeMode = MergeMode.MERGE if config.get("update", True) else MergeMode.INSERT
+        self.timeZone = config.get("timeZone", MOSCOW_TZ.key)
+
+        columns = toIterable(config.get("columns", ["code", "dt", "c"]))
+        invalid = [c for c in columns if c != SKIP_COLUMN and c not in COLUMN_DEFS]
+        if invalid or "dt" not in columns:
+            raise Exception(f"Invalid columns: {columns}")
+
+        self.cols = tuple(COLUMN_DEFS[c] if c != SKIP_COLUMN else ColumnDef(f"skip_{i + 1}") for i, c in enumerate(columns))
+        self.valueCols = tuple(c for c in self.cols if c.name in COLUMN_DEFS and c.name not in ("code", "dt"))
+
+    def run(self) -> bool:
+        pattern = config.get("pattern", "*.csv*")
+        fileNames = sorted(os.path.relpath(f, self.inputDir) for f in glob.glob(os.path.join(self.inputDir, pattern)))
+
+        self.stateFile = config.get("stateFile", os.path.join(self.inputDir, STATE_FILE))
+        self.state = self.loadState()
+        self.stateLock = threading.Lock()
+        self.assetLock = threading.Lock()
+
+        pending = [f for f in fileNames if self.state.get(f) != self.fileTime(f)]
+        log.info(f"Found {len(fileNames)} files, {len(fileNames) - len(pending)} of them already imported")
+        if not pending:
+            return True
+
+        params = DbParams.of(config["db"])
+        workers = int(config.get("workers", params.loadWorkers))
+
+        # Workers borrow from the pool besides the caller, resolving assets on its connection
+        if workers >= params.poolMaxSize:
+            log.warning(f"Workers limited to {params.poolMaxSize - 1} by pool size")
+            workers = max(params.poolMaxSize - 1, 1)
+
+        self.rows = 0
+        self.failed = []
+        startTime = time.monotonic()
+
+        self.pool = DbPool(params)
+        try:
+            with self.pool.connection() as self.conn:
+                queue = Queue()
+                for fileName in pending:
+                    queue.put(fileName)
+
+                threads = []
+                for i in range(min(workers, len(pending))):
+                    queue.put(None)
+                    thread = threading.Thread(target=self.work, args=(queue,), name=f"import-{i + 1}", daemon=True)
+                    thread.start()
+                    threads.append(thread)
+
+                for thread in threads:
+                    thread.join()
+
+                # Files are left in the queue if no worker got a connection to import them
+                while not queue.empty():
+                    fileName = queue.get()
+                    if fileName is not None:
+                        log.error(f"Not imported: {fileName}")
+                        self.failed.append(fileName)
+        finally:
+            self.pool.close()
+
+        elapsed = time.monotonic() - startTime
+        log.info(f"Imported {self.rows} rows from {len(pending) - len(self.failed)} files in {elapsed:.1f} s, {self.rows / elapsed:.0f} rows/s")
+
+        if self.failed:
+            log.error(f"Failed to import {len(self.failed)} files: {", ".join(self.failed)}")
+            return False
+        return True
+
+    def work(self, queue: Queue) -> None:
+        # Worker failed to get a connection stops, leaving the files to the others
+        try:
+            with self.pool.connection() as conn:
+                while (fileName := queue.get()) is not None:
+                    try:
+                        self.importFile(conn, fileName)
+                    except Exception:
+                        log.exception(f"Failed to import: {fileName}")
+                        with self.stateLock:
+                            self.failed.append(fileName)
+        except Exception:
+            log.exception(f"Import worker failed")
+
+    def importFile(self, conn: Any, fileName: str) -> None:
+        log.info(f"Importing: {fileName}")
+
+        startTime = time.monotonic()
+        fileTime = self.fileTime(fileName)
+
+        with conn.cursor() as curs:
+            with conn:
+                # Timestamps without offset in files are of this time zone
+                if not dbsqlite.isSqlite(curs):
+                    curs.execute("SELECT SET_CONFIG('TimeZone', %s, TRUE);", (self.timeZone,))
+
+                dbTempTable(curs, self.STAGING_TABLE, self.cols)
+                dbLoadCsv(curs, self.STAGING_TABLE, os.path.join(self.inputDir, fileName), self.cols, self.sep)
+                rows = curs.rowcount
+
+                # SQLite keeps them as loaded, so they are brought to UTC as the rest of its timestamps
+                if dbsqlite.isSqlite(curs):
+                    curs.connection.create_function("IMPORT_DT", 1, self.toUtcDt, deterministic=True)
+                    curs.execute(f"UPDATE {self.STAGING_TABLE} SET dt = IMPORT_DT(dt);")
+
+                curs.execute(f"SELECT MIN(dt), MAX(dt) FROM {self.STAGING_TABLE};")
+                dtRange = curs.fetchone()
+                if dtRange[0] is not None:
+                    self.dbMergeTrades(curs, fileName, dtRange)
+
+        with self.stateLock:
+            self.rows += rows
+            self.state[fileName] = fileTime
+            self.saveState()
+
+        elapsed = time.monotonic() - startTime
+        log.info(f"Imported: {fileName}, {rows} rows in {elapsed:.1f} s, {rows / max(elapsed, 0.001):.0f} rows/s")
+
+    def dbMergeTrades(self, curs, fileName: str, dtRange: tuple[Any, Any]) -> None:
+        hasCode = any(c.name == "code" for c in self.cols)
+        if hasCode:
+            curs.execute(f"SELECT DISTINCT code FROM {self.STAGING_TABLE};")
+            codes = [code for code, in curs.fetchall()]
+        else:
+            codes = [os.path.basename(fileName).split(".")[0]]
+
+        with self.assetLock:
+            with self.conn.cursor() as assetCurs:
+                with self.conn:
+                    assetIds = dbfin.dbInsertAssets(assetCurs, [dbfin.AssetDef(self.market, code) for code in codes])
+
+        cols = (dbfin.Trades.ASSET_ID, dbfin.Assets.CODE)
+        dbTempTable(curs, self.ASSETS_TABLE, cols)
+        dbLoadData(curs, self.ASSETS_TABLE, [(assetId, code) for (_, code), assetId in assetIds.items()], cols)
+
+        sqlCols = ", ".join(f"s.{c.name}" for c in (dbfin.Trades.DT,) + self.valueCols)
+        sqlJoin = f"JOIN {self.ASSETS_TABLE} AS a ON a.code = s.code" if hasCode else f"CROSS JOIN {self.ASSETS_TABLE} AS a"
+        sourceTable = f"(SELECT a.asset_id, {sqlCols} FROM {self.STAGING_TABLE} AS s {sqlJoin})"
+
+        dbfin.dbEnsureTradesPartitions(curs, *dtRange)
+        dbMerge(curs, "trades", sourceTable, on={"asset_id": ColumnDef("asset_id"), "agg_type": self.aggType, "dt": ColumnDef("dt")},
+                cols=self.valueCols, mode=self.mergeMode, bounds={"dt": dtRange})
+
+    def toUtcDt(self, value: str | None) -> str | None:
+        if value is None:
+            return None
+
+        dt = datetime.fromisoformat(value)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=ZoneInfo(self.timeZone))
+        return dt.astimezone(UTC_TZ).isoformat()
+
+    def fileTime(self, fileName: str) -> int:
+        return os.stat(os.path.join(self.inputDir, fileName)).st_mtime_ns
+
+    def loadState(self) -> dict[str, int]:
+        if not os.path.isfile(self.stateFile):
+            return {}
+
+        with open(self.stateFile, "r") as f:
+            return json.load(f)
+
+    def saveState(self) -> None:
+        # Replaced as a whole, so that an interruption never leaves it half written
+        with open(f"{self.stateFile}.part", "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(f"{self.stateFile}.part", self.stateFile)
+
+def main() -> int:
+    importer = Importer()
+    return 0 if importer.run() else 1
+
+if __name__ == "__main__":
+    exit(main())
@@ -1,31 +1,132 @@
+import sys, json, time
 import logging as log
 from typing import Any
 
 from common.config import config, initConfig
 from common.logtools import initLogging
 
-from db.dbtools import DbParams, dbConnect
+from db.dbtools import DbParams, dbConnect, dbListen, dbWaitNotifies
 
 PROFILE = "refresh"
 
+# Incremental refresh recalculates only assets and periods with changed trades,
+# full one rebuilds everything from scratch (e.g. after schema or view changes)
+REFRESH_MODES = ("incremental", "full")
+
+# Long running mode: waits for trade changes notified by ingestors and refreshes incrementally
+LISTEN_MODE = "listen"
+LISTEN_CHANNEL = "trades_changed"
+
+# Burst of notifications is coalesced until there is a quiet period of debounce seconds,
+# but no longer than max delay seconds since the first notification of the burst
+DEBOUNCE_SECONDS = 5
+MAX_DELAY_SECONDS = 60
+
+# Failed refresh is retried after a pause, reconnecting first if the connection is lost
+RETRY_SECONDS = 30
+
 def main() -> int:
     initConfig(PROFILE)
     initLogging(config.get("logLevel"))
 
-    conn = dbConnect(DbParams.of(config["db"]))
+    mode = getModeFromArgv(config.get("mode", "incremental"))
+
+    params = DbParams.of(config["db"])
+    if mode == LISTEN_MODE:
+        listen(params)
+        return 0
+
+    conn = dbConnect(params)
     try:
-        refresh(conn)
+        refresh(conn, mode)
     finally:
         conn.close()
 
     return 0
 
-def refresh(conn: Any) -> None:
-    log.info("Refreshing materialized views")
+def getModeFromArgv(defaultMode: str) -> str:
+    if len(sys.argv) > 2:
+        log.warning(f"Extra command line args ignored: {sys.argv[2:]}")
+
+    mode = sys.argv[1] if len(sys.argv) >= 2 else defaultMode
+    if mode not in REFRESH_MODES and mode != LISTEN_MODE:
+        raise Exception(f"Invalid refresh mode: {mode}")
+
+    return mode
+
+def refresh(conn: Any, mode: str = "incremental") -> None:
+    log.info(f"Refreshing derived tables, mode: {mode}")
 
     with conn.cursor() as curs:
         with conn:
-            curs.execute("CALL refresh_mv();")
+            curs.execute(f"CALL refresh_{mode}();")
+
+def listen(params: DbParams) -> None:
+    debounce = float(config.get("debounceSeconds", DEBOUNCE_SECONDS))
+    maxDelay = float(config.get("maxDelaySeconds", MAX_DELAY_SECONDS))
+    retryDelay = float(config.get("retrySeconds", RETRY_SECONDS))
+
+    conn = dbConnect(params)
+    try:
+        dbListen(conn, LISTEN_CHANNEL)
+        log.info(f"Listening for trade changes, debounce: {debounce} s, max delay: {maxDelay} s")
+
+        markets, assets = set(), set()
+        firstAt = lastAt = None
+        catchUp = True
+        while True:
+            try:
+                if conn.closed:
+                    log.info("Reconnecting to listen for trade changes")
+                    conn = dbConnect(params)
+                    dbListen(conn, LISTEN_CHANNEL)
+                    catchUp = True
+
+                # Changes are queued in DB, so catch up with the ones made while not listening
+                if catchUp:
+                    refresh(conn)
+                    catchUp = False
+
+                    markets.clear()
+                    assets.clear()
+                    firstAt = lastAt = None
+
+                timeout = None
+                if firstAt is not None:
+                    timeout = min(lastAt + debounce, firstAt + maxDelay) - time.monotonic()
+
+                notifies = dbWaitNotifies(conn, timeout)
+                if notifies:
+                    lastAt = time.monotonic()
+                    if firstAt is None:
+                        firstAt = lastAt
+
+                for n in notifies:
+                    try:
+                        payload = json.loads(n.payload)
+                        markets.update(payload.get("markets") or ())
+                        assets.update(payload.get("assets") or ())
+                    except (ValueError, AttributeError):
+                        log.warning(f"Invalid notify payload: {n.payload}")
+
+                if firstAt is None or time.monotonic() < min(lastAt + debounce, firstAt + maxDelay):
+                    continue
+
+                log.info(f"Trades changed, markets: {", ".join(sorted(markets))}, assets notified: {len(assets)}")
+                refresh(conn)
+
+                markets.clear()
+                assets.clear()
+                firstAt = lastAt = None
+
+            except Exception:
+                # Changes stay queued in DB, so the pending burst is just refreshed again on retry
+                log.exception(f"Failed to refresh, retrying in {retryDelay} s")
+                if not conn.closed:
+                    conn.rollback()
+                time.sleep(retryDelay)
+    finally:
+        conn.close()
 
 if __name__ == "__main__":
     exit(main())
@@ -12,7 +12,7 @@ from common.datetools import dateToDt, MOSCOW_TZ
 from api.selentools import initWebDriver, callApiNoF5
 
 import db.dbfin as dbfin
-from db.dbtools import DbParams, dbConnect
+from db.dbtools import DbParams, DbPool
 
 class RateValues(NamedTuple):
     dt: datetime
@@ -38,8 +38,10 @@ class Ingestor:
 
     RATE_TYPE = "PMR-1"
 
+    pool: DbPool
     conn: Any
     driver: Any
+    trades: dbfin.TradesBatch
 
     def __init__(self):
         initConfig(self.PROFILE)
@@ -48,19 +50,25 @@ class Ingestor:
     def run(self) -> bool:
         d = getDateFromArgv()
 
-        self.conn = dbConnect(DbParams.of(config["db"]))
+        self.pool = DbPool(DbParams.of(config["db"]))
         try:
-            self.driver = initWebDriver()
-            try:
-                return self.process(d)
-            finally:
-                self.driver.quit()
+            with self.pool.connection() as self.conn:
+                self.driver = initWebDriver()
+                try:
+                    return self.process(d)
+                finally:
+                    self.driver.quit()
         finally:
-            self.conn.close()
+            self.pool.close()
 
     def process(self, d: date) -> bool:
         isoCodes = toIterable(config.get("isoCodes", []))
-        return forEachSafely(isoCodes, lambda isoCode: self.processIsoCode(isoCode, self.RATE_TYPE, d))
+
+        with self.conn.cursor() as curs:
+            with self.conn:
+                with dbfin.TradesBatch(curs, (dbfin.Trades.C, dbfin.Trades.UNIT), skipUnchanged=config.get("skipUnchanged", True), pool=self.pool) as self.trades:
+                    success = forEachSafely(isoCodes, lambda isoCode: self.processIsoCode(isoCode, self.RATE_TYPE, d))
+                    return self.trades.merge() and success
 
     def processIsoCode(self, isoCode: str, rateType: str, d: date) -> None:
         log.info(f"Processing: {isoCode} {rateType}, date: {d.isoformat()}")
@@ -119,25 +127,25 @@ class Ingestor:
         return {k: v["rangeList"] for d in values for k, v in d.items() if v["lotSize"] == 1}
 
     def dbLoad(self, isoCode: str, rateType: str, rateValues: dict[str, list[RateValues]]) -> None:
+        prefixes = {subCode: f"{isoCode}-{rateType}-{subCode}" for subCode in rateValues}
+
+        assetDefs = [dbfin.AssetDef(self.MARKET, f"{prefix}-{side}") for prefix in prefixes.values() for side in ("BUY", "SELL")]
+        assetIds = dbfin.dbInsertAssetsSafely(self.trades.curs, assetDefs)
+
         for subCode, values in rateValues.items():
-            prefix = f"{isoCode}-{rateType}-{subCode}"
+            prefix = prefixes[subCode]
 
             data = [(v.dt, v.rateBuy, v.unit) for v in values]
-            self.dbLoadAsset(f"{prefix}-BUY", data)
+            self.dbLoadAsset(assetIds, f"{prefix}-BUY", data)
 
             data = [(v.dt, v.rateSell, v.unit) for v in values]
-            self.dbLoadAsset(f"{prefix}-SELL", data)
+            self.dbLoadAsset(assetIds, f"{prefix}-SELL", data)
 
-    def dbLoadAsset(self, assetCode: str, data: list[tuple[datetime, Decimal, str]]) -> None:
+    def dbLoadAsset(self, assetIds: dict[tuple[str, str], int], assetCode: str, data: list[tuple[datetime, Decimal, str]]) -> None:
         log.info(f"Loading into DB: {self.MARKET} {assetCode}")
 
-        with self.conn.cursor() as curs:
-            with self.conn:
-                assetId = dbfin.dbInsertAsset(curs, self.MARKET, assetCode)
-
-            with self.conn:
-                valueCols = (dbfin.Trades.C, dbfin.Trades.UNIT)
-                dbfin.dbInsertTrades(curs, assetId, data, valueCols, dbfin.AggType.INTRADAY)
+        assetId = assetIds[(self.MARKET, assetCode)]
+        self.trades.add(assetId, dbfin.AggType.INTRADAY, data)
 
 def main() -> int:
     ingestor = Ingestor()
@@ -14,7 +14,7 @@ from common.tools import getPeriodFromArgv, forEachSafely, toIterable
 from common.datetools import minusMonth
 
 import db.dbfin as dbfin
-from db.dbtools import DbParams, dbConnect
+from db.dbtools import DbParams, DbPool
 
 @ofmethod
 class Category(NamedTuple):
@@ -49,7 +49,10 @@ class Ingestor:
 
     PRICE_PARSERS: dict[str, Callable]
 
+    pool: DbPool
     conn: Any
+    trades: dbfin.TradesBatch
+    assetIds: dict[tuple[str, str], int]
 
     def __init__(self):
         initConfig(self.PROFILE)
@@ -64,21 +67,32 @@ class Ingestor:
         today = date.today()
         startDate, endDate = getPeriodFromArgv(minusMonth(today), today)
 
-        self.conn = dbConnect(DbParams.of(config["db"]))
+        self.pool = DbPool(DbParams.of(config["db"]))
         try:
-            return self.process(startDate, endDate)
+            with self.pool.connection() as self.conn:
+                return self.process(startDate, endDate)
         finally:
-            self.conn.close()
+            self.pool.close()
 
     def process(self, startDate: date, endDate: date) -> bool:
         categories = config.get("categories", [])
-        return forEachSafely(categories, lambda c: self.processCategory(Category.of(c), startDate, endDate))
+
+        with self.conn.cursor() as curs:
+            with self.conn:
+                with dbfin.TradesBatch(curs, (dbfin.Trades.C, dbfin.Trades.UNIT), skipUnchanged=config.get("skipUnchanged", True), pool=self.pool) as self.trades:
+                    self.assetIds = {}
+
+                    success = forEachSafely(categories, lambda c: self.processCategory(Category.of(c), startDate, endDate))
+                    return self.trades.merge() and success
 
     def processCategory(self, category: Category, startDate: date, endDate: date) -> bool:
         log.info(f"Processing: {category.secondName}, period: {startDate.isoformat()} to {endDate.isoformat()}")
 
         products = self.fetchProducts(category)
 
+        assetDefs = [dbfin.AssetDef(self.MARKET, p.product_code, p.product_name, p.unit) for p in products]
+        self.assetIds |= dbfin.dbInsertAssetsSafely(self.trades.curs, assetDefs, update=True)
+
         parser = self.PRICE_PARSERS[category.priceType or "PRICE"]
 
         return forEachSafely(products, lambda product: self.processProduct(product, startDate, endDate, parser))
@@ -172,13 +186,8 @@ class Ingestor:
     def dbLoad(self, product: Product, prices: list[Price]) -> None:
         log.info(f"Loading into DB: {self.MARKET} {product.product_code}")
 
-        with self.conn.cursor() as curs:
-            with self.conn:
-                assetId = dbfin.dbInsertAsset(curs, self.MARKET, product.product_code, product.product_name, product.unit, update=True)
-
-            with self.conn:
-                valueCols = (dbfin.Trades.C, dbfin.Trades.UNIT)
-                dbfin.dbInsertTrades(curs, assetId, prices, valueCols, dbfin.AggType.DAILY)
+        assetId = self.assetIds[(self.MARKET, product.product_code)]
+        self.trades.add(assetId, dbfin.AggType.DAILY, prices)
 
 def main() -> int:
     ingestor = Ingestor()
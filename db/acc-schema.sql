@@ -33,22 +33,176 @@ CREATE TABLE ops (
     quantity BIGINT,
     amount DECIMAL(20, 4),
     cur VARCHAR(3),
-    comment TEXT);
+    comment TEXT,
+    -- Code without account prefix, shared by ops of both accounts of a transfer
+    link_code VARCHAR(50) GENERATED ALWAYS AS (REGEXP_REPLACE(code, '^[^-]+-', '')) STORED);
 
 ALTER TABLE ops ADD CONSTRAINT ops_uk_01 UNIQUE NULLS NOT DISTINCT (broker, code);
+CREATE INDEX ops_idx_01 ON ops(broker, link_code);
 
 
-CREATE OR REPLACE PROCEDURE link_ops_finam()
+-- Links transfer ops sharing link_code with the given ones (e.g. just merged), on both sides of the transfer
+CREATE OR REPLACE PROCEDURE link_ops_finam(codes VARCHAR[])
 LANGUAGE 'plpgsql' SECURITY DEFINER AS $$
 BEGIN
     UPDATE ops
     SET corr_id = (
         SELECT id FROM ops AS c
         WHERE c.broker = ops.broker
-            AND REGEXP_REPLACE(c.code, '^[^-]+-', '') = REGEXP_REPLACE(ops.code, '^[^-]+-', '')
+            AND c.link_code = ops.link_code
             AND c.code != ops.code
     )
     WHERE ops.broker = 'FINAM'
-        AND ops.op_type = 'TRANSFER';
+        AND ops.op_type = 'TRANSFER'
+        AND ops.link_code IN (
+            SELECT l.link_code FROM ops AS l
+            WHERE l.broker = 'FINAM'
+                AND l.code = ANY(codes));
+END;
+$$;
+
+
+-- Ops changing positions, quantity signed by direction and price per unit of trades.
+-- Others (e.g. transfers of securities) move quantity at the average cost.
+CREATE OR REPLACE VIEW position_ops AS
+SELECT
+    id AS op_id,
+    account_id,
+    asset_id,
+    trans_dt,
+    CASE op_type WHEN 'BUY' THEN ABS(quantity) WHEN 'SELL' THEN -ABS(quantity) ELSE quantity END AS quantity,
+    CASE WHEN op_type IN ('BUY', 'SELL') THEN ABS(amount) / ABS(quantity) END AS price
+FROM ops
+WHERE asset_id IS NOT NULL
+    AND quantity != 0
+    AND op_type != 'UNSPECIFIED';
+
+CREATE INDEX ops_idx_02 ON ops(account_id, asset_id, trans_dt, id);
+
+-- Position after each op, replayed from by update_position()
+CREATE TABLE position_history (
+    op_id BIGINT PRIMARY KEY CONSTRAINT position_history_fk_01 REFERENCES ops(id),
+    account_id BIGINT NOT NULL,
+    asset_id BIGINT NOT NULL,
+    trans_dt TIMESTAMP WITH TIME ZONE NOT NULL,
+    quantity BIGINT NOT NULL,
+    cost DECIMAL(20, 4) NOT NULL,
+    realized_pnl DECIMAL(20, 4) NOT NULL);
+
+CREATE INDEX position_history_idx_01 ON position_history(account_id, asset_id, trans_dt);
+
+-- Current positions, as of the last op applied. Cost and P&L are by average cost, fees and income aside.
+CREATE TABLE positions (
+    account_id BIGINT NOT NULL CONSTRAINT positions_fk_01 REFERENCES accounts(id),
+    asset_id BIGINT NOT NULL CONSTRAINT positions_fk_02 REFERENCES assets(id),
+    op_id BIGINT NOT NULL,
+    trans_dt TIMESTAMP WITH TIME ZONE NOT NULL,
+    quantity BIGINT NOT NULL,
+    cost DECIMAL(20, 4) NOT NULL,
+    avg_cost DECIMAL(20, 6) GENERATED ALWAYS AS (CASE WHEN quantity != 0 THEN cost / quantity END) STORED,
+    realized_pnl DECIMAL(20, 4) NOT NULL);
+
+ALTER TABLE positions ADD CONSTRAINT positions_pkey PRIMARY KEY (account_id, asset_id);
+
+-- Replays ops of the account and asset from the state before the period start.
+-- Ops preceding the start but not replayed yet (e.g. loaded before positions were introduced) are caught up too.
+CREATE OR REPLACE FUNCTION update_position(account_id BIGINT, asset_id BIGINT, start_dt TIMESTAMP WITH TIME ZONE)
+RETURNS VOID LANGUAGE 'plpgsql' AS $$
+BEGIN
+    DELETE FROM position_history AS h
+    WHERE h.account_id = update_position.account_id
+        AND h.asset_id = update_position.asset_id
+        AND h.trans_dt >= update_position.start_dt;
+
+    -- Closing part of a trade realizes P&L against the average cost, the rest of it opens a reverse position
+    INSERT INTO position_history (op_id, account_id, asset_id, trans_dt, quantity, cost, realized_pnl)
+    WITH RECURSIVE s AS (
+        SELECT
+            0 AS n,
+            COALESCE(b.op_id, 0) AS op_id,
+            COALESCE(b.trans_dt, '-infinity') AS trans_dt,
+            COALESCE(b.quantity, 0) AS quantity,
+            COALESCE(b.cost, 0)::DECIMAL AS cost,
+            COALESCE(b.realized_pnl, 0)::DECIMAL AS realized_pnl
+        FROM (SELECT) AS z
+        LEFT JOIN (
+            SELECT h.op_id, h.trans_dt, h.quantity, h.cost, h.realized_pnl
+            FROM position_history AS h
+            WHERE h.account_id = update_position.account_id
+                AND h.asset_id = update_position.asset_id
+            ORDER BY h.trans_dt DESC, h.op_id DESC
+            LIMIT 1
+        ) AS b ON TRUE
+        UNION ALL
+        SELECT
+            s.n + 1,
+            o.op_id,
+            o.trans_dt,
+            s.quantity + o.quantity,
+            ROUND(CASE
+                WHEN s.quantity * o.quantity >= 0 THEN s.cost + o.quantity * COALESCE(o.price, CASE WHEN s.quantity != 0 THEN s.cost / s.quantity ELSE 0 END)
+                WHEN s.quantity * (s.quantity + o.quantity) > 0 THEN s.cost * (s.quantity + o.quantity) / s.quantity
+                ELSE (s.quantity + o.quantity) * COALESCE(o.price, 0)
+            END, 4),
+            ROUND(s.realized_pnl + CASE
+                WHEN s.quantity * o.quantity < 0 AND o.price IS NOT NULL
+                THEN (CASE WHEN ABS(o.quantity) < ABS(s.quantity) THEN -o.quantity ELSE s.quantity END) * (o.price - s.cost / s.quantity)
+                ELSE 0
+            END, 4)
+        FROM s
+        JOIN position_ops AS o ON o.op_id = (
+            SELECT p.op_id FROM position_ops AS p
+            WHERE p.account_id = update_position.account_id
+                AND p.asset_id = update_position.asset_id
+                AND (p.trans_dt, p.op_id) > (s.trans_dt, s.op_id)
+            ORDER BY p.trans_dt, p.op_id
+            LIMIT 1)
+    )
+    SELECT s.op_id, update_position.account_id, update_position.asset_id, s.trans_dt, s.quantity, s.cost, s.realized_pnl
+    FROM s
+    WHERE s.n > 0
+    -- Op moved from another account or asset may still have its row there, if that one isn't replayed yet
+    ON CONFLICT (op_id) DO UPDATE SET
+        account_id = EXCLUDED.account_id,
+        asset_id = EXCLUDED.asset_id,
+        trans_dt = EXCLUDED.trans_dt,
+        quantity = EXCLUDED.quantity,
+        cost = EXCLUDED.cost,
+        realized_pnl = EXCLUDED.realized_pnl;
+
+    DELETE FROM positions AS p
+    WHERE p.account_id = update_position.account_id
+        AND p.asset_id = update_position.asset_id;
+
+    INSERT INTO positions (account_id, asset_id, op_id, trans_dt, quantity, cost, realized_pnl)
+    SELECT h.account_id, h.asset_id, h.op_id, h.trans_dt, h.quantity, h.cost, h.realized_pnl
+    FROM position_history AS h
+    WHERE h.account_id = update_position.account_id
+        AND h.asset_id = update_position.asset_id
+    ORDER BY h.trans_dt DESC, h.op_id DESC
+    LIMIT 1;
+END;
+$$;
+
+-- Updates positions from the given ops (e.g. just merged), replaying history from the earliest of them
+-- both where they are now and where they were before. NULL codes rebuild positions of the whole broker.
+CREATE OR REPLACE PROCEDURE update_positions(broker VARCHAR, codes VARCHAR[])
+LANGUAGE 'plpgsql' SECURITY DEFINER AS $$
+BEGIN
+    PERFORM update_position(c.account_id, c.asset_id, MIN(c.trans_dt))
+    FROM (
+        SELECT p.account_id, p.asset_id, p.trans_dt
+        FROM position_ops AS p
+        JOIN ops AS o ON o.id = p.op_id
+        WHERE o.broker = update_positions.broker
+            AND (codes IS NULL OR o.code = ANY(codes))
+        UNION ALL
+        SELECT h.account_id, h.asset_id, h.trans_dt
+        FROM position_history AS h
+        JOIN ops AS o ON o.id = h.op_id
+        WHERE o.broker = update_positions.broker
+            AND (codes IS NULL OR o.code = ANY(codes))
+    ) AS c
+    GROUP BY c.account_id, c.asset_id;
 END;
 $$;
@@ -13,18 +13,113 @@ CREATE TABLE assets (
     market VARCHAR(15) NOT NULL,
     code VARCHAR(30) NOT NULL,
     name TEXT NOT NULL,
-    unit VARCHAR(15));
+    unit VARCHAR(15),
+    -- Classification by metal_rules, set by trigger
+    metal VARCHAR(15),
+    dir VARCHAR(15),
+    grams DECIMAL);
 
 ALTER TABLE assets ADD CONSTRAINT assets_uk_01 UNIQUE NULLS NOT DISTINCT (market, code);
+CREATE INDEX assets_idx_01 ON assets(metal) WHERE metal IS NOT NULL;
 
 CREATE TRIGGER on_assets_update
 BEFORE UPDATE ON assets FOR EACH ROW
 EXECUTE FUNCTION on_update();
 
 
-CREATE TABLE trades (
+-- Metal asset classification rules, first matching rule by priority wins.
+-- NULL pattern matches anything, dir_pattern extracts deal direction from code by its first group.
+CREATE TABLE metal_rules (
     id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
     updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    priority INT NOT NULL DEFAULT 0,
+    market VARCHAR(15) NOT NULL,
+    code_pattern TEXT,
+    name_pattern TEXT,
+    dir_pattern TEXT,
+    metal VARCHAR(15) NOT NULL);
+
+CREATE INDEX metal_rules_idx_01 ON metal_rules(market);
+
+CREATE TRIGGER on_metal_rules_update
+BEFORE UPDATE ON metal_rules FOR EACH ROW
+EXECUTE FUNCTION on_update();
+
+INSERT INTO metal_rules (market, code_pattern, name_pattern, dir_pattern, metal) VALUES
+    ('SMM', '^SMM-AU-', NULL, NULL, 'Gold'),
+    ('SMM', '^SMM-AG-', NULL, NULL, 'Silver'),
+    ('XCEC', NULL, 'GOLD FUTURES', NULL, 'Gold'),
+    ('XCEC', NULL, 'SILVER FUTURES', NULL, 'Silver'),
+    ('MISX', '^GLDRUB_', NULL, NULL, 'Gold'),
+    ('MISX', '^SLVRUB_', NULL, NULL, 'Silver'),
+    ('CBR', '^METAL1$', NULL, NULL, 'Gold'),
+    ('CBR', '^METAL2$', NULL, NULL, 'Silver'),
+    ('GOZNAK', '^gold(-|$)', NULL, '^.+-([^-]+)$', 'Gold'),
+    ('GOZNAK', '^silver(-|$)', NULL, '^.+-([^-]+)$', 'Silver'),
+    ('SBER', '^A98(-|$)', NULL, '^.+-([^-]+)$', 'Gold'),
+    ('SBER', '^A99(-|$)', NULL, '^.+-([^-]+)$', 'Silver'),
+    ('AVANGARD', '^gold(-|$)', NULL, '^.+-([^-]+)$', 'Gold');
+
+CREATE OR REPLACE FUNCTION to_grams(unit TEXT)
+RETURNS DECIMAL
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT CASE WHEN unit ~ '^[0-9.]+$' THEN unit::DECIMAL END
+$$;
+
+CREATE OR REPLACE FUNCTION classify_asset(market TEXT, code TEXT, name TEXT)
+RETURNS TABLE (
+    metal VARCHAR(15),
+    dir VARCHAR(15)
+)
+LANGUAGE sql STABLE AS $$
+    SELECT r.metal, UPPER(REGEXP_REPLACE(classify_asset.code, r.dir_pattern, '\1'))
+    FROM public.metal_rules AS r
+    WHERE r.market = classify_asset.market
+        AND (r.code_pattern IS NULL OR classify_asset.code ~ r.code_pattern)
+        AND (r.name_pattern IS NULL OR classify_asset.name ~ r.name_pattern)
+    ORDER BY r.priority, r.id
+    LIMIT 1;
+$$;
+
+CREATE OR REPLACE FUNCTION on_asset_classify()
+RETURNS TRIGGER LANGUAGE 'plpgsql' AS $$
+BEGIN
+    SELECT c.metal, c.dir INTO NEW.metal, NEW.dir
+    FROM public.classify_asset(NEW.market, NEW.code, NEW.name) AS c;
+    NEW.grams = public.to_grams(NEW.unit);
+    RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER on_assets_classify
+BEFORE INSERT OR UPDATE ON assets FOR EACH ROW
+EXECUTE FUNCTION on_asset_classify();
+
+-- Assets are classified again on rules change, only the changed ones get updated
+CREATE OR REPLACE FUNCTION on_metal_rules_change()
+RETURNS TRIGGER LANGUAGE 'plpgsql' AS $$
+BEGIN
+    UPDATE public.assets AS a
+    SET metal = c.metal, dir = c.dir
+    FROM public.assets AS x
+    LEFT JOIN LATERAL public.classify_asset(x.market, x.code, x.name) AS c ON TRUE
+    WHERE a.id = x.id
+        AND (a.metal, a.dir) IS DISTINCT FROM (c.metal, c.dir);
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER on_metal_rules_change
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON metal_rules
+FOR EACH STATEMENT EXECUTE FUNCTION on_metal_rules_change();
+
+
+-- Trades are partitioned by year of dt, so that range scans and loads touch only the relevant partitions.
+-- There is no default partition, which would defeat ordered scans like the one of get_rate(),
+-- so partitions have to be created by ensure_trades_partitions() before trades are written.
+CREATE TABLE trades (
+    id BIGINT GENERATED ALWAYS AS IDENTITY,
+    updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
     asset_id BIGINT NOT NULL CONSTRAINT trades_fk_01 REFERENCES assets(id),
     agg_type VARCHAR(15) NOT NULL,
     dt TIMESTAMP WITH TIME ZONE NOT NULL,
@@ -33,11 +128,12 @@ CREATE TABLE trades (
     l DECIMAL(20, 4),
     c DECIMAL(20, 4),
     v BIGINT,
-    unit VARCHAR(15));
+    unit VARCHAR(15))
+PARTITION BY RANGE (dt);
 
 -- Some of possible agg_type values:
 -- D - daily
--- W - weekly
+-- W - weekly (rolled up from daily, as the next ones, see update_trades_rollups())
 -- M - monthly
 -- Q - quarterly
 -- Y - annual
@@ -46,20 +142,337 @@ CREATE TABLE trades (
 -- M1, M15, ... - values of interval in minutes, 15 minutes, etc.
 -- H - hourly
 
+ALTER TABLE trades ADD CONSTRAINT trades_pkey PRIMARY KEY (id, dt);
 ALTER TABLE trades ADD CONSTRAINT trades_uk_01 UNIQUE NULLS NOT DISTINCT (asset_id, agg_type, dt, unit);
+CREATE INDEX trades_idx_01 ON trades USING BRIN (dt);
 
 CREATE TRIGGER on_tradess_update
 BEFORE UPDATE ON trades FOR EACH ROW
 EXECUTE FUNCTION on_update();
 
+-- Creates missing yearly partitions of trades covering the period, called by loaders before merge.
+-- Partitions are attached rather than created in place, which would lock trades against readers until commit.
+-- Being DDL on trades, it can't be called by statements on trades, including their triggers.
+CREATE OR REPLACE FUNCTION ensure_trades_partitions(start_dt TIMESTAMP WITH TIME ZONE, end_dt TIMESTAMP WITH TIME ZONE)
+RETURNS VOID LANGUAGE 'plpgsql' AS $$
+DECLARE
+    from_dt TIMESTAMP WITH TIME ZONE;
+    y INTEGER;
+    part_name TEXT;
+    part_from TIMESTAMP WITH TIME ZONE;
+    part_to TIMESTAMP WITH TIME ZONE;
+BEGIN
+    -- Rollups of the period (see update_trades_rollups()) start with its Moscow year, which may be the previous UTC one
+    from_dt := DATE_TRUNC('year', start_dt AT TIME ZONE 'Europe/Moscow') AT TIME ZONE 'Europe/Moscow';
+
+    FOR y IN EXTRACT(YEAR FROM from_dt AT TIME ZONE 'UTC')::INTEGER .. EXTRACT(YEAR FROM end_dt AT TIME ZONE 'UTC')::INTEGER LOOP
+        part_name := 'trades_y' || y;
+        CONTINUE WHEN TO_REGCLASS('public.' || part_name) IS NOT NULL;
+
+        part_from := MAKE_TIMESTAMPTZ(y, 1, 1, 0, 0, 0, 'UTC');
+        part_to := MAKE_TIMESTAMPTZ(y + 1, 1, 1, 0, 0, 0, 'UTC');
+
+        BEGIN
+            EXECUTE FORMAT('CREATE TABLE public.%I (LIKE public.trades INCLUDING DEFAULTS)', part_name);
+            EXECUTE FORMAT('ALTER TABLE public.trades ATTACH PARTITION public.%I FOR VALUES FROM (%L) TO (%L)',
+                part_name, part_from, part_to);
+        EXCEPTION WHEN duplicate_table OR unique_violation THEN
+            -- Created meanwhile by a concurrent loader
+            NULL;
+        END;
+    END LOOP;
+END;
+$$;
+
+
+-- Fingerprints of loaded series windows per asset, used to skip unchanged reloads.
+-- Loading a window drops fingerprints of the ones overlapping it, as they no longer tell what is stored.
+CREATE TABLE load_fingerprints (
+    updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    asset_id BIGINT NOT NULL CONSTRAINT load_fingerprints_fk_01 REFERENCES assets(id),
+    agg_type VARCHAR(15) NOT NULL,
+    start_dt TIMESTAMP WITH TIME ZONE NOT NULL,
+    end_dt TIMESTAMP WITH TIME ZONE NOT NULL,
+    hash VARCHAR(64) NOT NULL);
+
+ALTER TABLE load_fingerprints ADD CONSTRAINT load_fingerprints_pkey PRIMARY KEY (asset_id, agg_type, start_dt, end_dt);
+
+CREATE TRIGGER on_load_fingerprints_update
+BEFORE UPDATE ON load_fingerprints FOR EACH ROW
+EXECUTE FUNCTION on_update();
+
+
+-- Assets and periods of changed trades, consumed by incremental refresh
+-- NULL period means the whole history of the asset
+CREATE TABLE trade_changes (
+    id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    asset_id BIGINT NOT NULL,
+    start_dt TIMESTAMP WITH TIME ZONE,
+    end_dt TIMESTAMP WITH TIME ZONE);
+
+CREATE OR REPLACE FUNCTION on_trades_change()
+RETURNS TRIGGER LANGUAGE 'plpgsql' AS $$
+BEGIN
+    INSERT INTO public.trade_changes (asset_id, start_dt, end_dt)
+    SELECT asset_id, MIN(dt), MAX(dt)
+    FROM changed_rows
+    GROUP BY asset_id;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER on_trades_insert_change
+AFTER INSERT ON trades REFERENCING NEW TABLE AS changed_rows
+FOR EACH STATEMENT EXECUTE FUNCTION on_trades_change();
+
+CREATE TRIGGER on_trades_update_change
+AFTER UPDATE ON trades REFERENCING NEW TABLE AS changed_rows
+FOR EACH STATEMENT EXECUTE FUNCTION on_trades_change();
+
+CREATE TRIGGER on_trades_delete_change
+AFTER DELETE ON trades REFERENCING OLD TABLE AS changed_rows
+FOR EACH STATEMENT EXECUTE FUNCTION on_trades_change();
+
+CREATE OR REPLACE FUNCTION on_asset_change()
+RETURNS TRIGGER LANGUAGE 'plpgsql' AS $$
+BEGIN
+    INSERT INTO public.trade_changes (asset_id) VALUES (NEW.id);
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER on_assets_change
+AFTER UPDATE ON assets FOR EACH ROW
+WHEN ((OLD.market, OLD.code, OLD.name, OLD.unit, OLD.metal, OLD.dir) IS DISTINCT FROM (NEW.market, NEW.code, NEW.name, NEW.unit, NEW.metal, NEW.dir))
+EXECUTE FUNCTION on_asset_change();
+
+-- Tells listeners (see "refresh listen" task) about changed markets and assets, delivered on commit
+CREATE OR REPLACE FUNCTION on_trade_changes_insert()
+RETURNS TRIGGER LANGUAGE 'plpgsql' AS $$
+DECLARE
+    payload TEXT;
+BEGIN
+    SELECT JSON_BUILD_OBJECT(
+            'markets', JSON_AGG(DISTINCT a.market),
+            'assets', JSON_AGG(DISTINCT c.asset_id))::TEXT
+        INTO payload
+    FROM new_changes AS c
+    JOIN public.assets AS a ON a.id = c.asset_id
+    HAVING COUNT(*) > 0;
+
+    -- Payload is limited to 8000 bytes, so drop asset list for large loads
+    IF LENGTH(payload) > 7000 THEN
+        SELECT JSON_BUILD_OBJECT('markets', JSON_AGG(DISTINCT a.market))::TEXT
+            INTO payload
+        FROM new_changes AS c
+        JOIN public.assets AS a ON a.id = c.asset_id;
+    END IF;
+
+    IF payload IS NOT NULL THEN
+        PERFORM PG_NOTIFY('trades_changed', payload);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER on_trade_changes_insert
+AFTER INSERT ON trade_changes REFERENCING NEW TABLE AS new_changes
+FOR EACH STATEMENT EXECUTE FUNCTION on_trade_changes_insert();
+
+
+-- Latest trade of each series, maintained by triggers on trades within the writing statement
+CREATE TABLE latest_trades (
+    updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    asset_id BIGINT NOT NULL,
+    agg_type VARCHAR(15) NOT NULL,
+    unit VARCHAR(15),
+    dt TIMESTAMP WITH TIME ZONE NOT NULL,
+    trade_id BIGINT NOT NULL);
 
-CREATE MATERIALIZED VIEW latest_trade_ids AS
-SELECT DISTINCT ON (asset_id, agg_type, unit) id
+ALTER TABLE latest_trades ADD CONSTRAINT latest_trades_uk_01 UNIQUE NULLS NOT DISTINCT (asset_id, agg_type, unit);
+CREATE UNIQUE INDEX latest_trades_uk_02 ON latest_trades(trade_id);
+
+CREATE TRIGGER on_latest_trades_update
+BEFORE UPDATE ON latest_trades FOR EACH ROW
+EXECUTE FUNCTION on_update();
+
+CREATE OR REPLACE VIEW latest_trades_source AS
+SELECT DISTINCT ON (asset_id, agg_type, unit) asset_id, agg_type, unit, dt, id AS trade_id
 FROM public.trades
 ORDER BY asset_id, agg_type, unit, dt DESC;
 
+CREATE OR REPLACE FUNCTION on_trades_latest()
+RETURNS TRIGGER LANGUAGE 'plpgsql' AS $$
+DECLARE
+    stale_ids BIGINT[];
+BEGIN
+    -- Latest trades deleted or moved to another series or dt are looked up again
+    IF TG_OP = 'DELETE' THEN
+        SELECT ARRAY_AGG(l.trade_id) INTO stale_ids
+        FROM public.latest_trades AS l
+        JOIN old_rows AS o ON o.id = l.trade_id;
+    ELSIF TG_OP = 'UPDATE' THEN
+        SELECT ARRAY_AGG(l.trade_id) INTO stale_ids
+        FROM public.latest_trades AS l
+        JOIN old_rows AS o ON o.id = l.trade_id
+        JOIN new_rows AS n ON n.id = o.id
+        WHERE (n.asset_id, n.agg_type, n.unit, n.dt) IS DISTINCT FROM (o.asset_id, o.agg_type, o.unit, o.dt);
+    END IF;
+
+    IF stale_ids IS NOT NULL THEN
+        WITH k AS (
+            DELETE FROM public.latest_trades
+            WHERE trade_id = ANY(stale_ids)
+            RETURNING asset_id, agg_type, unit
+        )
+        INSERT INTO public.latest_trades (asset_id, agg_type, unit, dt, trade_id)
+        SELECT t.*
+        FROM k
+        CROSS JOIN LATERAL (
+            SELECT t.asset_id, t.agg_type, t.unit, t.dt, t.id
+            FROM public.trades AS t
+            WHERE t.asset_id = k.asset_id
+                AND t.agg_type = k.agg_type
+                AND t.unit IS NOT DISTINCT FROM k.unit
+            ORDER BY t.dt DESC
+            LIMIT 1
+        ) AS t;
+    END IF;
+
+    -- Incoming trades replace the latest ones only when newer
+    IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+        INSERT INTO public.latest_trades AS l (asset_id, agg_type, unit, dt, trade_id)
+        SELECT DISTINCT ON (asset_id, agg_type, unit) asset_id, agg_type, unit, dt, id
+        FROM new_rows
+        ORDER BY asset_id, agg_type, unit, dt DESC
+        ON CONFLICT (asset_id, agg_type, unit) DO UPDATE
+        SET dt = EXCLUDED.dt, trade_id = EXCLUDED.trade_id
+        WHERE EXCLUDED.dt > l.dt;
+    END IF;
+
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER on_trades_insert_latest
+AFTER INSERT ON trades REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION on_trades_latest();
+
+CREATE TRIGGER on_trades_update_latest
+AFTER UPDATE ON trades REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION on_trades_latest();
+
+CREATE TRIGGER on_trades_delete_latest
+AFTER DELETE ON trades REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION on_trades_latest();
+
+CREATE OR REPLACE VIEW latest_trade_ids AS
+SELECT trade_id AS id, asset_id
+FROM public.latest_trades;
+
+-- Weekly, monthly, quarterly and annual trades rolled up from daily ones within the period.
+-- Buckets start at Moscow midnight, as daily trades are dated by Moscow or UTC midnight.
+-- Partitions for them are created along with the ones of daily trades, see ensure_trades_partitions().
+CREATE OR REPLACE FUNCTION update_trades_rollups(id BIGINT, start_dt TIMESTAMP WITH TIME ZONE, end_dt TIMESTAMP WITH TIME ZONE)
+RETURNS VOID LANGUAGE 'plpgsql' AS $$
+DECLARE
+    r RECORD;
+    from_dt TIMESTAMP WITH TIME ZONE;
+    to_dt TIMESTAMP WITH TIME ZONE;
+BEGIN
+    FOR r IN
+        SELECT *
+        FROM (VALUES
+            ('W', 'week', INTERVAL '1 week'),
+            ('M', 'month', INTERVAL '1 month'),
+            ('Q', 'quarter', INTERVAL '3 months'),
+            ('Y', 'year', INTERVAL '1 year')
+        ) AS v (agg_type, field, span)
+    LOOP
+        from_dt := DATE_TRUNC(r.field, start_dt AT TIME ZONE 'Europe/Moscow') AT TIME ZONE 'Europe/Moscow';
+        to_dt := (DATE_TRUNC(r.field, end_dt AT TIME ZONE 'Europe/Moscow') + r.span) AT TIME ZONE 'Europe/Moscow';
+
+        WITH b AS (
+            SELECT
+                DATE_TRUNC(r.field, t.dt, 'Europe/Moscow') AS dt,
+                t.unit,
+                (ARRAY_AGG(COALESCE(t.o, t.c) ORDER BY t.dt))[1] AS o,
+                MAX(COALESCE(t.h, t.c)) AS h,
+                MIN(COALESCE(t.l, t.c)) AS l,
+                (ARRAY_AGG(t.c ORDER BY t.dt DESC))[1] AS c,
+                SUM(t.v) AS v
+            FROM public.trades AS t
+            WHERE t.asset_id = update_trades_rollups.id
+                AND t.agg_type = 'D'
+                AND t.dt >= from_dt
+                AND t.dt < to_dt
+            GROUP BY 1, t.unit
+        ),
+        d AS (
+            DELETE FROM public.trades AS t
+            WHERE t.asset_id = update_trades_rollups.id
+                AND t.agg_type = r.agg_type
+                AND t.dt >= from_dt
+                AND t.dt < to_dt
+                AND NOT EXISTS (SELECT FROM b WHERE b.dt = t.dt AND b.unit IS NOT DISTINCT FROM t.unit)
+        )
+        INSERT INTO public.trades AS t (asset_id, agg_type, dt, o, h, l, c, v, unit)
+        SELECT update_trades_rollups.id, r.agg_type, b.dt, b.o, b.h, b.l, b.c, b.v, b.unit
+        FROM b
+        ON CONFLICT (asset_id, agg_type, dt, unit) DO UPDATE
+        SET o = EXCLUDED.o, h = EXCLUDED.h, l = EXCLUDED.l, c = EXCLUDED.c, v = EXCLUDED.v
+        WHERE (t.o, t.h, t.l, t.c, t.v) IS DISTINCT FROM (EXCLUDED.o, EXCLUDED.h, EXCLUDED.l, EXCLUDED.c, EXCLUDED.v);
+    END LOOP;
+END;
+$$;
+
+-- Rollups are updated by the statement writing daily trades. Being trades too, they are not daily and end the recursion.
+CREATE OR REPLACE FUNCTION on_trades_rollup()
+RETURNS TRIGGER LANGUAGE 'plpgsql' AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM public.update_trades_rollups(n.asset_id, MIN(n.dt), MAX(n.dt))
+        FROM new_rows AS n
+        WHERE n.agg_type = 'D'
+        GROUP BY n.asset_id;
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM public.update_trades_rollups(c.asset_id, MIN(c.dt), MAX(c.dt))
+        FROM (
+            SELECT asset_id, agg_type, dt FROM old_rows
+            UNION ALL
+            SELECT asset_id, agg_type, dt FROM new_rows
+        ) AS c
+        WHERE c.agg_type = 'D'
+        GROUP BY c.asset_id;
+    ELSE
+        PERFORM public.update_trades_rollups(o.asset_id, MIN(o.dt), MAX(o.dt))
+        FROM old_rows AS o
+        WHERE o.agg_type = 'D'
+        GROUP BY o.asset_id;
+    END IF;
+
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER on_trades_insert_rollup
+AFTER INSERT ON trades REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION on_trades_rollup();
 
-CREATE MATERIALIZED VIEW daily_prices AS
+CREATE TRIGGER on_trades_update_rollup
+AFTER UPDATE ON trades REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION on_trades_rollup();
+
+CREATE TRIGGER on_trades_delete_rollup
+AFTER DELETE ON trades REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION on_trades_rollup();
+
+
+-- Tables derived from trades are filled from their *_source views, see refresh_full() and refresh_incremental()
+
+
+CREATE OR REPLACE VIEW daily_prices_source AS
 WITH agg AS (
     SELECT DISTINCT ON (asset_id, dt::DATE, unit)
         id, updated, asset_id, dt, c AS price, unit
@@ -76,8 +489,11 @@ SELECT * FROM agg
 UNION ALL
 SELECT * FROM daily;
 
-CREATE UNIQUE INDEX daily_prices_pkey ON daily_prices(id);
-CREATE UNIQUE INDEX daily_prices_uk_01 ON daily_prices(asset_id, dt, unit) NULLS NOT DISTINCT;
+CREATE TABLE daily_prices AS
+SELECT * FROM daily_prices_source WITH NO DATA;
+
+ALTER TABLE daily_prices ADD CONSTRAINT daily_prices_pkey PRIMARY KEY (id);
+ALTER TABLE daily_prices ADD CONSTRAINT daily_prices_uk_01 UNIQUE NULLS NOT DISTINCT (asset_id, dt, unit);
 
 
 CREATE OR REPLACE FUNCTION to_price_in_oz(price DECIMAL, grams DECIMAL)
@@ -109,60 +525,84 @@ LANGUAGE sql AS $$
 $$;
 
 
--- Metal assets
+-- Currency rate assets, used for price conversion
+CREATE OR REPLACE VIEW rate_assets AS
+SELECT a.*
+FROM public.assets AS a
+WHERE (a.market = 'CBR' AND a.code !~ '^METAL')
+    OR (a.market = 'SMM' AND a.code ~ '^SMM-EXR-');
+
+-- Daily rates as validity intervals, to be joined by range instead of get_rate() per row
+CREATE TABLE rate_intervals (
+    rate_asset_id BIGINT NOT NULL,
+    valid_from TIMESTAMP WITH TIME ZONE NOT NULL,
+    valid_to TIMESTAMP WITH TIME ZONE NOT NULL,
+    rate DECIMAL(20, 4));
+
+ALTER TABLE rate_intervals ADD CONSTRAINT rate_intervals_pkey PRIMARY KEY (rate_asset_id, valid_from);
+CREATE INDEX rate_intervals_idx_01 ON rate_intervals USING GIST (TSTZRANGE(valid_from, valid_to));
+
+CREATE OR REPLACE VIEW rate_intervals_source AS
+SELECT
+    t.asset_id AS rate_asset_id,
+    t.dt AS valid_from,
+    COALESCE(LEAD(t.dt) OVER (PARTITION BY t.asset_id ORDER BY t.dt), 'infinity') AS valid_to,
+    t.c AS rate
+FROM public.trades AS t
+JOIN public.rate_assets AS a
+    ON a.id = t.asset_id
+WHERE t.agg_type = 'D';
+
+CREATE OR REPLACE FUNCTION update_rate_intervals(id BIGINT, start_dt TIMESTAMP WITH TIME ZONE)
+RETURNS VOID LANGUAGE 'plpgsql' AS $$
+DECLARE
+    from_dt TIMESTAMP WITH TIME ZONE;
+BEGIN
+    -- Interval preceding the change gets a new end too, so rebuild from its start
+    SELECT COALESCE(MAX(r.valid_from), '-infinity') INTO from_dt
+    FROM public.rate_intervals AS r
+    WHERE r.rate_asset_id = update_rate_intervals.id
+        AND r.valid_from < update_rate_intervals.start_dt;
+
+    DELETE FROM public.rate_intervals AS r
+    WHERE r.rate_asset_id = update_rate_intervals.id
+        AND r.valid_from >= from_dt;
+
+    INSERT INTO public.rate_intervals
+    SELECT *
+    FROM public.rate_intervals_source AS r
+    WHERE r.rate_asset_id = update_rate_intervals.id
+        AND r.valid_from >= from_dt;
+END;
+$$;
+
+-- Rate intervals are updated along with the rates load, NULL period means the whole history
+CREATE OR REPLACE FUNCTION on_trade_changes_rates()
+RETURNS TRIGGER LANGUAGE 'plpgsql' AS $$
+BEGIN
+    PERFORM public.update_rate_intervals(c.asset_id, MIN(COALESCE(c.start_dt, '-infinity')))
+    FROM new_changes AS c
+    WHERE EXISTS (SELECT FROM public.rate_assets AS a WHERE a.id = c.asset_id)
+        OR EXISTS (SELECT FROM public.rate_intervals AS r WHERE r.rate_asset_id = c.asset_id)
+    GROUP BY c.asset_id;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER on_trade_changes_rates
+AFTER INSERT ON trade_changes REFERENCING NEW TABLE AS new_changes
+FOR EACH STATEMENT EXECUTE FUNCTION on_trade_changes_rates();
+
+
+-- Metal assets, see metal_rules
 CREATE OR REPLACE VIEW metal_assets AS
-WITH a AS (
-    SELECT a.*,
-    	CASE a.market
-            WHEN 'SMM' THEN
-                CASE REGEXP_SUBSTR(a.code, '^SMM-[^-]+')
-                    WHEN 'SMM-AU' THEN 'Gold'
-                    WHEN 'SMM-AG' THEN 'Silver'
-                END
-            WHEN 'XCEC' THEN
-                CASE REGEXP_SUBSTR(a.name, '(GOLD FUTURES|SILVER FUTURES)')
-                    WHEN 'GOLD FUTURES' THEN 'Gold'
-                    WHEN 'SILVER FUTURES' THEN 'Silver'
-                END
-            WHEN 'MISX' THEN
-                CASE REGEXP_SUBSTR(a.code, '^[^_]+')
-                    WHEN 'GLDRUB' THEN 'Gold'
-                    WHEN 'SLVRUB' THEN 'Silver'
-                END
-            WHEN 'CBR' THEN
-                CASE a.code
-                    WHEN 'METAL1' THEN 'Gold'
-                    WHEN 'METAL2' THEN 'Silver'
-                END
-            WHEN 'GOZNAK' THEN
-                CASE REGEXP_SUBSTR(a.code, '^[^-]+')
-                    WHEN 'gold' THEN 'Gold'
-                    WHEN 'silver' THEN 'Silver'
-                END
-            WHEN 'SBER' THEN
-                CASE REGEXP_SUBSTR(a.code, '^[^-]+')
-                    WHEN 'A98' THEN 'Gold'
-                    WHEN 'A99' THEN 'Silver'
-                END
-            WHEN 'AVANGARD' THEN
-                CASE REGEXP_SUBSTR(a.code, '^[^-]+')
-                    WHEN 'gold' THEN 'Gold'
-                END
-        END::VARCHAR(15) AS metal
-    FROM public.assets AS a
-    WHERE CASE a.market
-            WHEN 'SMM' THEN a.code ~ '^SMM-(AG|AU)-'
-            WHEN 'MISX' THEN a.code ~ '^(SLVRUB|GLDRUB)_'
-            WHEN 'CBR' THEN a.code ~ '^METAL'
-            ELSE a.market IN ('XCEC', 'GOZNAK', 'SBER', 'AVANGARD')
-    	END
-)
-SELECT id, updated, market, code, name, metal, unit
-FROM a WHERE metal IS NOT NULL;
+SELECT id, updated, market, code, name, metal, unit, dir, grams
+FROM public.assets
+WHERE metal IS NOT NULL;
 
 
 -- Metal bar prices
-CREATE MATERIALIZED VIEW bar_prices AS
+CREATE OR REPLACE VIEW bar_prices_source AS
 SELECT
     p.id,
     p.asset_id,
@@ -170,26 +610,52 @@ SELECT
     a.code,
     a.name,
     a.metal,
-    UPPER(REGEXP_REPLACE(a.code, '^.+-([^-]+)$', '\1')) AS dir,
+    a.dir,
     p.dt,
     p.price,
-    (p.price / COALESCE(p.unit, a.unit)::DECIMAL)::DECIMAL(20, 4) AS price_g,
-    COALESCE(p.unit, a.unit)::DECIMAL AS grams
+    (p.price / g.grams)::DECIMAL(20, 4) AS price_g,
+    g.grams
 FROM public.daily_prices AS p
 JOIN public.metal_assets AS a
     ON a.id = p.asset_id
+CROSS JOIN LATERAL (
+    SELECT CASE WHEN p.unit IS NULL THEN a.grams ELSE public.to_grams(p.unit) END AS grams) AS g
 WHERE a.market IN ('GOZNAK', 'SBER', 'AVANGARD')
-    AND COALESCE(p.unit, a.unit) ~ '^[0-9.]+$'
+    AND g.grams IS NOT NULL
     AND p.price > 0;
 
-CREATE UNIQUE INDEX bar_prices_pkey ON bar_prices(id);
-CREATE UNIQUE INDEX bar_prices_uk_01 ON bar_prices(asset_id, dt, grams) NULLS NOT DISTINCT;
+CREATE TABLE bar_prices AS
+SELECT * FROM bar_prices_source WITH NO DATA;
 
--- Latest metal bar prices
+ALTER TABLE bar_prices ADD CONSTRAINT bar_prices_pkey PRIMARY KEY (id);
+ALTER TABLE bar_prices ADD CONSTRAINT bar_prices_uk_01 UNIQUE NULLS NOT DISTINCT (asset_id, dt, grams);
+
+-- Latest metal bar prices, read from latest trades to be current without refresh
 CREATE OR REPLACE VIEW latest_bar_prices AS
-SELECT p.*
-FROM public.bar_prices AS p
-JOIN public.latest_trade_ids AS l ON l.id = p.id;
+SELECT
+    p.id,
+    p.asset_id,
+    a.market,
+    a.code,
+    a.name,
+    a.metal,
+    a.dir,
+    p.dt,
+    p.c AS price,
+    (p.c / g.grams)::DECIMAL(20, 4) AS price_g,
+    g.grams
+FROM public.latest_trades AS l
+JOIN public.trades AS p
+    ON p.id = l.trade_id
+    AND p.dt = l.dt
+JOIN public.metal_assets AS a
+    ON a.id = l.asset_id
+CROSS JOIN LATERAL (
+    SELECT CASE WHEN p.unit IS NULL THEN a.grams ELSE public.to_grams(p.unit) END AS grams) AS g
+WHERE l.agg_type IN ('D', 'I')
+    AND a.market IN ('GOZNAK', 'SBER', 'AVANGARD')
+    AND g.grams IS NOT NULL
+    AND p.c > 0;
 
 
 -- Shanghai Metals Market prices
@@ -217,7 +683,9 @@ CROSS JOIN (
     FROM public.assets AS r
     WHERE r.market = 'SMM'
         AND r.code = 'SMM-EXR-003')
-CROSS JOIN public.get_rate(rate_id, p.dt) AS r
+JOIN public.rate_intervals AS r
+    ON r.rate_asset_id = rate_id
+    AND TSTZRANGE(r.valid_from, r.valid_to) @> p.dt
 WHERE a.market = 'SMM'
     AND p.unit IN ('yuan/kg', 'yuan/g');
 
@@ -257,7 +725,9 @@ CROSS JOIN (
     FROM public.assets AS r
     WHERE r.market = 'CBR'
         AND r.code = 'R01235')
-CROSS JOIN public.get_rate(rate_id, p.dt) AS r
+JOIN public.rate_intervals AS r
+    ON r.rate_asset_id = rate_id
+    AND TSTZRANGE(r.valid_from, r.valid_to) @> p.dt
 WHERE a.market = 'MISX';
 
 -- CBR metal prices
@@ -279,7 +749,9 @@ CROSS JOIN (
     FROM public.assets AS r
     WHERE r.market = 'CBR'
         AND r.code = 'R01235')
-CROSS JOIN public.get_rate(rate_id, p.dt) AS r
+JOIN public.rate_intervals AS r
+    ON r.rate_asset_id = rate_id
+    AND TSTZRANGE(r.valid_from, r.valid_to) @> p.dt
 WHERE a.market = 'CBR';
 
 -- Goznak, Sberbank, Avangard metal bar prices
@@ -292,23 +764,27 @@ SELECT
     a.name,
     a.metal,
     p.dt,
-    (to_price_in_oz(p.price, COALESCE(p.unit, a.unit)::DECIMAL) / r.rate)::DECIMAL(20, 4) AS price_oz
+    (to_price_in_oz(p.price, g.grams) / r.rate)::DECIMAL(20, 4) AS price_oz
 FROM public.daily_prices AS p
 JOIN public.metal_assets AS a
     ON a.id = p.asset_id
+CROSS JOIN LATERAL (
+    SELECT CASE WHEN p.unit IS NULL THEN a.grams ELSE public.to_grams(p.unit) END AS grams) AS g
 CROSS JOIN (
     SELECT r.id AS rate_id
     FROM public.assets AS r
     WHERE r.market = 'CBR'
         AND r.code = 'R01235')
-CROSS JOIN public.get_rate(rate_id, p.dt) AS r
+JOIN public.rate_intervals AS r
+    ON r.rate_asset_id = rate_id
+    AND TSTZRANGE(r.valid_from, r.valid_to) @> p.dt
 WHERE a.market IN ('GOZNAK', 'SBER', 'AVANGARD')
-    AND COALESCE(p.unit, a.unit) ~ '^[0-9.]+$'
+    AND g.grams IS NOT NULL
     AND p.price > 0;
 
 
 -- All metal prices
-CREATE VIEW metal_prices AS
+CREATE OR REPLACE VIEW metal_prices_source AS
 SELECT * FROM public.metal_prices_smm
 UNION ALL
 SELECT * FROM public.metal_prices_xcec
@@ -319,12 +795,167 @@ SELECT * FROM public.metal_prices_cbr
 UNION ALL
 SELECT * FROM public.metal_prices_ru;
 
+CREATE TABLE metal_prices AS
+SELECT * FROM metal_prices_source WITH NO DATA;
+
+-- Time of the refresh which calculated the row, e.g. for incremental exports
+ALTER TABLE metal_prices ADD COLUMN updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+ALTER TABLE metal_prices ADD CONSTRAINT metal_prices_pkey PRIMARY KEY (id);
+CREATE INDEX metal_prices_idx_01 ON metal_prices(asset_id, dt);
+CREATE INDEX metal_prices_idx_02 ON metal_prices(metal, dt);
 
-CREATE OR REPLACE PROCEDURE refresh_mv()
+
+CREATE OR REPLACE PROCEDURE refresh_full()
+LANGUAGE 'plpgsql' SECURITY DEFINER AS $$
+DECLARE
+    start_dt TIMESTAMP WITH TIME ZONE;
+    end_dt TIMESTAMP WITH TIME ZONE;
+BEGIN
+    -- Partitions are ensured apart from the query on trades, as it would prevent attaching them
+    SELECT MIN(dt), MAX(dt) INTO start_dt, end_dt FROM public.trades WHERE agg_type = 'D';
+    IF start_dt IS NOT NULL THEN
+        PERFORM public.ensure_trades_partitions(start_dt, end_dt);
+    END IF;
+
+    PERFORM public.update_trades_rollups(asset_id, MIN(dt), MAX(dt)) FROM public.trades WHERE agg_type = 'D' GROUP BY asset_id;
+
+    DELETE FROM public.trade_changes;
+
+    TRUNCATE public.latest_trades, public.rate_intervals, public.daily_prices, public.bar_prices, public.metal_prices;
+
+    INSERT INTO public.latest_trades (asset_id, agg_type, unit, dt, trade_id) SELECT * FROM public.latest_trades_source;
+    INSERT INTO public.rate_intervals SELECT * FROM public.rate_intervals_source;
+    INSERT INTO public.daily_prices SELECT * FROM public.daily_prices_source;
+    INSERT INTO public.bar_prices SELECT * FROM public.bar_prices_source;
+    INSERT INTO public.metal_prices SELECT * FROM public.metal_prices_source;
+END;
+$$;
+
+
+CREATE OR REPLACE PROCEDURE refresh_incremental()
 LANGUAGE 'plpgsql' SECURITY DEFINER AS $$
+DECLARE
+    s RECORD;
+    rate_end_dt TIMESTAMP WITH TIME ZONE;
+BEGIN
+    -- Changes committed meanwhile are not visible here, so they are left for the next refresh.
+    -- Periods are widened to whole days, as intraday trades are aggregated by day.
+    FOR s IN
+        WITH c AS (
+            DELETE FROM public.trade_changes
+            RETURNING asset_id, start_dt, end_dt
+        )
+        SELECT
+            asset_id,
+            CASE WHEN COUNT(*) = COUNT(start_dt) THEN DATE_TRUNC('day', MIN(start_dt)) ELSE '-infinity' END AS start_dt,
+            CASE WHEN COUNT(*) = COUNT(end_dt) THEN DATE_TRUNC('day', MAX(end_dt)) + INTERVAL '1 day' ELSE 'infinity' END AS end_dt
+        FROM c
+        GROUP BY asset_id
+    LOOP
+        DELETE FROM public.metal_prices WHERE asset_id = s.asset_id AND dt >= s.start_dt AND dt < s.end_dt;
+        DELETE FROM public.bar_prices WHERE asset_id = s.asset_id AND dt >= s.start_dt AND dt < s.end_dt;
+        DELETE FROM public.daily_prices WHERE asset_id = s.asset_id AND dt >= s.start_dt AND dt < s.end_dt;
+
+        INSERT INTO public.daily_prices
+        SELECT * FROM public.daily_prices_source WHERE asset_id = s.asset_id AND dt >= s.start_dt AND dt < s.end_dt;
+        INSERT INTO public.bar_prices
+        SELECT * FROM public.bar_prices_source WHERE asset_id = s.asset_id AND dt >= s.start_dt AND dt < s.end_dt;
+        INSERT INTO public.metal_prices
+        SELECT * FROM public.metal_prices_source WHERE asset_id = s.asset_id AND dt >= s.start_dt AND dt < s.end_dt;
+
+        -- Changed rate affects prices of all assets converted with it, up to the next unchanged rate
+        IF EXISTS (SELECT FROM public.rate_assets WHERE id = s.asset_id) THEN
+            SELECT COALESCE(MIN(valid_from), 'infinity') INTO rate_end_dt
+            FROM public.rate_intervals
+            WHERE rate_asset_id = s.asset_id
+                AND valid_from >= s.end_dt;
+
+            DELETE FROM public.metal_prices WHERE dt >= s.start_dt AND dt < rate_end_dt;
+            INSERT INTO public.metal_prices
+            SELECT * FROM public.metal_prices_source WHERE dt >= s.start_dt AND dt < rate_end_dt;
+        END IF;
+    END LOOP;
+END;
+$$;
+
+
+-- Raw intraday trades rolled into daily ones by compact_intraday_trades(), if asked to keep them
+CREATE TABLE trades_archive (LIKE trades INCLUDING DEFAULTS);
+
+-- Rolls intraday trades of the asset within the period into daily ones, then deletes them or moves to trades_archive.
+-- Daily trade keeps the last value of the day and its dt, as daily_prices does, and OHLC of the day if asked.
+-- Days already having a daily trade keep it. Period is expected to be aligned to whole days.
+CREATE OR REPLACE FUNCTION compact_intraday_trades(
+    id BIGINT,
+    start_dt TIMESTAMP WITH TIME ZONE,
+    end_dt TIMESTAMP WITH TIME ZONE,
+    ohlc BOOLEAN,
+    archive BOOLEAN,
+    OUT added_count BIGINT,
+    OUT removed_count BIGINT)
+LANGUAGE 'plpgsql' AS $$
 BEGIN
-    REFRESH MATERIALIZED VIEW public.latest_trade_ids;
-    REFRESH MATERIALIZED VIEW public.daily_prices;
-    REFRESH MATERIALIZED VIEW public.bar_prices;
+    PERFORM public.ensure_trades_partitions(start_dt, end_dt);
+
+    WITH days AS (
+        SELECT
+            t.dt::DATE AS d,
+            t.unit,
+            MAX(t.dt) AS dt,
+            (ARRAY_AGG(COALESCE(t.o, t.c) ORDER BY t.dt))[1] AS o,
+            MAX(COALESCE(t.h, t.c)) AS h,
+            MIN(COALESCE(t.l, t.c)) AS l,
+            (ARRAY_AGG(t.c ORDER BY t.dt DESC))[1] AS c,
+            SUM(t.v) AS v
+        FROM public.trades AS t
+        WHERE t.asset_id = compact_intraday_trades.id
+            AND t.agg_type = 'I'
+            AND t.dt >= compact_intraday_trades.start_dt
+            AND t.dt < compact_intraday_trades.end_dt
+        GROUP BY t.dt::DATE, t.unit
+    )
+    INSERT INTO public.trades (asset_id, agg_type, dt, o, h, l, c, v, unit)
+    SELECT
+        compact_intraday_trades.id,
+        'D',
+        x.dt,
+        CASE WHEN ohlc THEN x.o END,
+        CASE WHEN ohlc THEN x.h END,
+        CASE WHEN ohlc THEN x.l END,
+        x.c,
+        CASE WHEN ohlc THEN x.v END,
+        x.unit
+    FROM days AS x
+    WHERE NOT EXISTS (
+        SELECT FROM public.trades AS t
+        WHERE t.asset_id = compact_intraday_trades.id
+            AND t.agg_type = 'D'
+            AND t.unit IS NOT DISTINCT FROM x.unit
+            AND t.dt >= x.d
+            AND t.dt < x.d + 1);
+
+    GET DIAGNOSTICS added_count = ROW_COUNT;
+
+    IF archive THEN
+        WITH removed AS (
+            DELETE FROM public.trades AS t
+            WHERE t.asset_id = compact_intraday_trades.id
+                AND t.agg_type = 'I'
+                AND t.dt >= compact_intraday_trades.start_dt
+                AND t.dt < compact_intraday_trades.end_dt
+            RETURNING t.*
+        )
+        INSERT INTO public.trades_archive
+        SELECT * FROM removed;
+    ELSE
+        DELETE FROM public.trades AS t
+        WHERE t.asset_id = compact_intraday_trades.id
+            AND t.agg_type = 'I'
+            AND t.dt >= compact_intraday_trades.start_dt
+            AND t.dt < compact_intraday_trades.end_dt;
+    END IF;
+
+    GET DIAGNOSTICS removed_count = ROW_COUNT;
 END;
 $$;
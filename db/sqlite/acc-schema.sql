@@ -0,0 +1,200 @@
+-- SQLite counterpart of acc-schema.sql, for offline runs and benchmarks (see bin/db/dbsqlite.py).
+
+-- Bodies of procedures run by CALL, with arguments bound as :arg1, :arg2, ...
+CREATE TABLE IF NOT EXISTS procedures (
+    name TEXT PRIMARY KEY,
+    body TEXT NOT NULL);
+
+
+CREATE TABLE IF NOT EXISTS accounts (
+    id INTEGER PRIMARY KEY,
+    broker VARCHAR(15) NOT NULL,
+    code VARCHAR(15) NOT NULL,
+    name TEXT NOT NULL,
+    comment TEXT,
+    -- VARCHAR(15) ARRAY in PostgreSQL
+    attrs TEXT);
+
+CREATE UNIQUE INDEX IF NOT EXISTS accounts_uk_01 ON accounts(broker, code);
+
+
+CREATE TABLE IF NOT EXISTS assets (
+    id INTEGER PRIMARY KEY,
+    market VARCHAR(15) NOT NULL,
+    ticker VARCHAR(15) NOT NULL,
+    isin VARCHAR(12),
+    name TEXT NOT NULL,
+    cur VARCHAR(3) NOT NULL);
+
+CREATE UNIQUE INDEX IF NOT EXISTS assets_uk_01 ON assets(market, ticker);
+CREATE UNIQUE INDEX IF NOT EXISTS assets_uk_02 ON assets(isin);
+
+CREATE TABLE IF NOT EXISTS ops (
+    id INTEGER PRIMARY KEY,
+    broker VARCHAR(15) NOT NULL,
+    code VARCHAR(50) NOT NULL,
+    corr_id BIGINT CONSTRAINT ops_fk_01 REFERENCES ops(id),
+    account_id BIGINT NOT NULL CONSTRAINT ops_fk_02 REFERENCES accounts(id),
+    trans_dt TIMESTAMP WITH TIME ZONE NOT NULL,
+    settle_dt TIMESTAMP WITH TIME ZONE,
+    op_type VARCHAR(15) NOT NULL,
+    asset_id BIGINT CONSTRAINT ops_fk_03 REFERENCES assets(id),
+    quantity BIGINT,
+    amount DECIMAL(20, 4),
+    cur VARCHAR(3),
+    comment TEXT,
+    -- Code without account prefix, shared by ops of both accounts of a transfer
+    link_code VARCHAR(50) GENERATED ALWAYS AS (REGEXP_REPLACE(code, '^[^-]+-', '')) STORED);
+
+CREATE UNIQUE INDEX IF NOT EXISTS ops_uk_01 ON ops(broker, code);
+CREATE INDEX IF NOT EXISTS ops_idx_01 ON ops(broker, link_code);
+
+
+INSERT OR REPLACE INTO procedures (name, body) VALUES ('link_ops_finam', '
+UPDATE ops
+SET corr_id = (
+    SELECT id FROM ops AS c
+    WHERE c.broker = ops.broker
+        AND c.link_code = ops.link_code
+        AND c.code != ops.code
+)
+WHERE ops.broker = ''FINAM''
+    AND ops.op_type = ''TRANSFER''
+    AND ops.link_code IN (
+        SELECT l.link_code FROM ops AS l
+        WHERE l.broker = ''FINAM''
+            AND l.code IN (SELECT value FROM JSON_EACH(:arg1)));
+');
+
+
+CREATE VIEW IF NOT EXISTS position_ops AS
+SELECT
+    id AS op_id,
+    account_id,
+    asset_id,
+    trans_dt,
+    CASE op_type WHEN 'BUY' THEN ABS(quantity) WHEN 'SELL' THEN -ABS(quantity) ELSE quantity END AS quantity,
+    CASE WHEN op_type IN ('BUY', 'SELL') THEN CAST(ABS(amount) AS REAL) / ABS(quantity) END AS price
+FROM ops
+WHERE asset_id IS NOT NULL
+    AND quantity != 0
+    AND op_type != 'UNSPECIFIED';
+
+CREATE INDEX IF NOT EXISTS ops_idx_02 ON ops(account_id, asset_id, trans_dt, id);
+
+CREATE TABLE IF NOT EXISTS position_history (
+    op_id INTEGER PRIMARY KEY CONSTRAINT position_history_fk_01 REFERENCES ops(id),
+    account_id BIGINT NOT NULL,
+    asset_id BIGINT NOT NULL,
+    trans_dt TIMESTAMP WITH TIME ZONE NOT NULL,
+    quantity BIGINT NOT NULL,
+    cost DECIMAL(20, 4) NOT NULL,
+    realized_pnl DECIMAL(20, 4) NOT NULL);
+
+CREATE INDEX IF NOT EXISTS position_history_idx_01 ON position_history(account_id, asset_id, trans_dt);
+
+CREATE TABLE IF NOT EXISTS positions (
+    account_id BIGINT NOT NULL CONSTRAINT positions_fk_01 REFERENCES accounts(id),
+    asset_id BIGINT NOT NULL CONSTRAINT positions_fk_02 REFERENCES assets(id),
+    op_id BIGINT NOT NULL,
+    trans_dt TIMESTAMP WITH TIME ZONE NOT NULL,
+    quantity BIGINT NOT NULL,
+    cost DECIMAL(20, 4) NOT NULL,
+    avg_cost DECIMAL(20, 6) GENERATED ALWAYS AS (CASE WHEN quantity != 0 THEN CAST(cost AS REAL) / quantity END) STORED,
+    realized_pnl DECIMAL(20, 4) NOT NULL,
+    PRIMARY KEY (account_id, asset_id));
+
+
+-- No loops here, so all accounts and assets are replayed at once, unlike update_position() of PostgreSQL
+INSERT OR REPLACE INTO procedures (name, body) VALUES ('update_positions', '
+CREATE TEMPORARY TABLE position_changes AS
+SELECT c.account_id, c.asset_id, MIN(c.trans_dt) AS start_dt
+FROM (
+    SELECT p.account_id, p.asset_id, p.trans_dt
+    FROM position_ops AS p
+    JOIN ops AS o ON o.id = p.op_id
+    WHERE o.broker = :arg1
+        AND (:arg2 IS NULL OR o.code IN (SELECT value FROM JSON_EACH(:arg2)))
+    UNION ALL
+    SELECT h.account_id, h.asset_id, h.trans_dt
+    FROM position_history AS h
+    JOIN ops AS o ON o.id = h.op_id
+    WHERE o.broker = :arg1
+        AND (:arg2 IS NULL OR o.code IN (SELECT value FROM JSON_EACH(:arg2)))
+) AS c
+GROUP BY c.account_id, c.asset_id;
+
+DELETE FROM position_history
+WHERE EXISTS (
+    SELECT 1 FROM position_changes AS c
+    WHERE c.account_id = position_history.account_id
+        AND c.asset_id = position_history.asset_id
+        AND c.start_dt <= position_history.trans_dt);
+
+INSERT INTO position_history (op_id, account_id, asset_id, trans_dt, quantity, cost, realized_pnl)
+WITH RECURSIVE s AS (
+    SELECT
+        0 AS n,
+        c.account_id,
+        c.asset_id,
+        COALESCE(b.op_id, 0) AS op_id,
+        COALESCE(b.trans_dt, '''') AS trans_dt,
+        COALESCE(b.quantity, 0) AS quantity,
+        CAST(COALESCE(b.cost, 0) AS REAL) AS cost,
+        CAST(COALESCE(b.realized_pnl, 0) AS REAL) AS realized_pnl
+    FROM position_changes AS c
+    LEFT JOIN position_history AS b ON b.op_id = (
+        SELECT h.op_id FROM position_history AS h
+        WHERE h.account_id = c.account_id
+            AND h.asset_id = c.asset_id
+        ORDER BY h.trans_dt DESC, h.op_id DESC
+        LIMIT 1)
+    UNION ALL
+    SELECT
+        s.n + 1,
+        s.account_id,
+        s.asset_id,
+        o.op_id,
+        o.trans_dt,
+        s.quantity + o.quantity,
+        ROUND(CASE
+            WHEN s.quantity * o.quantity >= 0 THEN s.cost + o.quantity * COALESCE(o.price, CASE WHEN s.quantity != 0 THEN s.cost / s.quantity ELSE 0 END)
+            WHEN s.quantity * (s.quantity + o.quantity) > 0 THEN s.cost * (s.quantity + o.quantity) / s.quantity
+            ELSE (s.quantity + o.quantity) * COALESCE(o.price, 0)
+        END, 4),
+        ROUND(s.realized_pnl + CASE
+            WHEN s.quantity * o.quantity < 0 AND o.price IS NOT NULL
+            THEN (CASE WHEN ABS(o.quantity) < ABS(s.quantity) THEN -o.quantity ELSE s.quantity END) * (o.price - s.cost / s.quantity)
+            ELSE 0
+        END, 4)
+    FROM s
+    JOIN position_ops AS o ON o.op_id = (
+        SELECT p.op_id FROM position_ops AS p
+        WHERE p.account_id = s.account_id
+            AND p.asset_id = s.asset_id
+            AND (p.trans_dt, p.op_id) > (s.trans_dt, s.op_id)
+        ORDER BY p.trans_dt, p.op_id
+        LIMIT 1)
+)
+SELECT s.op_id, s.account_id, s.asset_id, s.trans_dt, s.quantity, s.cost, s.realized_pnl
+FROM s
+WHERE s.n > 0;
+
+DELETE FROM positions
+WHERE EXISTS (
+    SELECT 1 FROM position_changes AS c
+    WHERE c.account_id = positions.account_id
+        AND c.asset_id = positions.asset_id);
+
+INSERT INTO positions (account_id, asset_id, op_id, trans_dt, quantity, cost, realized_pnl)
+SELECT h.account_id, h.asset_id, h.op_id, h.trans_dt, h.quantity, h.cost, h.realized_pnl
+FROM position_changes AS c
+JOIN position_history AS h ON h.op_id = (
+    SELECT l.op_id FROM position_history AS l
+    WHERE l.account_id = c.account_id
+        AND l.asset_id = c.asset_id
+    ORDER BY l.trans_dt DESC, l.op_id DESC
+    LIMIT 1);
+
+DROP TABLE position_changes;
+');
@@ -0,0 +1,460 @@
+-- SQLite counterpart of fin-schema.sql, for offline runs and benchmarks (see bin/db/dbsqlite.py).
+-- Tables keep the same columns and keys. Derived tables of refresh are plain views here,
+-- and functions of the schema are inlined into the views or emulated by triggers and procedures.
+
+-- Bodies of procedures run by CALL
+CREATE TABLE IF NOT EXISTS procedures (
+    name TEXT PRIMARY KEY,
+    body TEXT NOT NULL);
+
+
+CREATE TABLE IF NOT EXISTS assets (
+    id INTEGER PRIMARY KEY,
+    updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    market VARCHAR(15) NOT NULL,
+    code VARCHAR(30) NOT NULL,
+    name TEXT NOT NULL,
+    unit VARCHAR(15),
+    -- Classification by metal_rules, set by trigger
+    metal VARCHAR(15),
+    dir VARCHAR(15),
+    grams DECIMAL);
+
+CREATE UNIQUE INDEX IF NOT EXISTS assets_uk_01 ON assets(market, code);
+
+CREATE TRIGGER IF NOT EXISTS on_assets_update
+AFTER UPDATE ON assets FOR EACH ROW WHEN NEW.updated IS OLD.updated
+BEGIN
+    UPDATE assets SET updated = CURRENT_TIMESTAMP WHERE id = NEW.id;
+END;
+
+
+-- Metal asset classification rules, first matching rule by priority wins.
+-- NULL pattern matches anything, dir_pattern extracts deal direction from code by its first group.
+CREATE TABLE IF NOT EXISTS metal_rules (
+    id INTEGER PRIMARY KEY,
+    updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    priority INT NOT NULL DEFAULT 0,
+    market VARCHAR(15) NOT NULL,
+    code_pattern TEXT,
+    name_pattern TEXT,
+    dir_pattern TEXT,
+    metal VARCHAR(15) NOT NULL);
+
+CREATE INDEX IF NOT EXISTS metal_rules_idx_01 ON metal_rules(market);
+
+CREATE TRIGGER IF NOT EXISTS on_metal_rules_update
+AFTER UPDATE ON metal_rules FOR EACH ROW WHEN NEW.updated IS OLD.updated
+BEGIN
+    UPDATE metal_rules SET updated = CURRENT_TIMESTAMP WHERE id = NEW.id;
+END;
+
+-- Classification of assets, counterpart of classify_asset() and to_grams()
+CREATE VIEW IF NOT EXISTS asset_classes AS
+SELECT
+    a.id,
+    r.metal,
+    UPPER(REGEXP_REPLACE(a.code, r.dir_pattern, '\1')) AS dir,
+    CASE WHEN a.unit REGEXP '^[0-9.]+$' THEN CAST(a.unit AS DECIMAL) END AS grams
+FROM assets AS a
+LEFT JOIN metal_rules AS r
+    ON r.id = (
+        SELECT x.id
+        FROM metal_rules AS x
+        WHERE x.market = a.market
+            AND (x.code_pattern IS NULL OR a.code REGEXP x.code_pattern)
+            AND (x.name_pattern IS NULL OR a.name REGEXP x.name_pattern)
+        ORDER BY x.priority, x.id
+        LIMIT 1);
+
+CREATE TRIGGER IF NOT EXISTS on_assets_classify
+AFTER INSERT ON assets FOR EACH ROW
+BEGIN
+    UPDATE assets SET (metal, dir, grams) = (SELECT c.metal, c.dir, c.grams FROM asset_classes AS c WHERE c.id = NEW.id)
+    WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS on_assets_reclassify
+AFTER UPDATE OF market, code, name, unit ON assets FOR EACH ROW
+BEGIN
+    UPDATE assets SET (metal, dir, grams) = (SELECT c.metal, c.dir, c.grams FROM asset_classes AS c WHERE c.id = NEW.id)
+    WHERE id = NEW.id;
+END;
+
+-- Assets are classified again on rules change, only the changed ones get updated and recorded as changed
+CREATE TRIGGER IF NOT EXISTS on_metal_rules_insert_change
+AFTER INSERT ON metal_rules
+BEGIN
+    INSERT INTO trade_changes (asset_id)
+    SELECT a.id FROM assets AS a JOIN asset_classes AS c ON c.id = a.id WHERE (a.metal, a.dir) IS NOT (c.metal, c.dir);
+
+    UPDATE assets SET (metal, dir) = (SELECT c.metal, c.dir FROM asset_classes AS c WHERE c.id = assets.id)
+    WHERE (metal, dir) IS NOT (SELECT c.metal, c.dir FROM asset_classes AS c WHERE c.id = assets.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS on_metal_rules_update_change
+AFTER UPDATE OF priority, market, code_pattern, name_pattern, dir_pattern, metal ON metal_rules
+BEGIN
+    INSERT INTO trade_changes (asset_id)
+    SELECT a.id FROM assets AS a JOIN asset_classes AS c ON c.id = a.id WHERE (a.metal, a.dir) IS NOT (c.metal, c.dir);
+
+    UPDATE assets SET (metal, dir) = (SELECT c.metal, c.dir FROM asset_classes AS c WHERE c.id = assets.id)
+    WHERE (metal, dir) IS NOT (SELECT c.metal, c.dir FROM asset_classes AS c WHERE c.id = assets.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS on_metal_rules_delete_change
+AFTER DELETE ON metal_rules
+BEGIN
+    INSERT INTO trade_changes (asset_id)
+    SELECT a.id FROM assets AS a JOIN asset_classes AS c ON c.id = a.id WHERE (a.metal, a.dir) IS NOT (c.metal, c.dir);
+
+    UPDATE assets SET (metal, dir) = (SELECT c.metal, c.dir FROM asset_classes AS c WHERE c.id = assets.id)
+    WHERE (metal, dir) IS NOT (SELECT c.metal, c.dir FROM asset_classes AS c WHERE c.id = assets.id);
+END;
+
+CREATE TABLE IF NOT EXISTS trades (
+    id INTEGER PRIMARY KEY,
+    updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    asset_id BIGINT NOT NULL CONSTRAINT trades_fk_01 REFERENCES assets(id),
+    agg_type VARCHAR(15) NOT NULL,
+    dt TIMESTAMP WITH TIME ZONE NOT NULL,
+    o DECIMAL(20, 4),
+    h DECIMAL(20, 4),
+    l DECIMAL(20, 4),
+    c DECIMAL(20, 4),
+    v BIGINT,
+    unit VARCHAR(15));
+
+-- NULLS NOT DISTINCT emulated by the expression
+CREATE UNIQUE INDEX IF NOT EXISTS trades_uk_01 ON trades(asset_id, agg_type, dt, IFNULL(unit, ''));
+
+CREATE TRIGGER IF NOT EXISTS on_trades_update
+AFTER UPDATE ON trades FOR EACH ROW WHEN NEW.updated IS OLD.updated
+BEGIN
+    UPDATE trades SET updated = CURRENT_TIMESTAMP WHERE id = NEW.id;
+END;
+
+
+CREATE TABLE IF NOT EXISTS load_fingerprints (
+    updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    asset_id BIGINT NOT NULL CONSTRAINT load_fingerprints_fk_01 REFERENCES assets(id),
+    agg_type VARCHAR(15) NOT NULL,
+    start_dt TIMESTAMP WITH TIME ZONE NOT NULL,
+    end_dt TIMESTAMP WITH TIME ZONE NOT NULL,
+    hash VARCHAR(64) NOT NULL,
+    CONSTRAINT load_fingerprints_pkey PRIMARY KEY (asset_id, agg_type, start_dt, end_dt));
+
+CREATE TRIGGER IF NOT EXISTS on_load_fingerprints_update
+AFTER UPDATE ON load_fingerprints FOR EACH ROW WHEN NEW.updated IS OLD.updated
+BEGIN
+    UPDATE load_fingerprints SET updated = CURRENT_TIMESTAMP WHERE asset_id = NEW.asset_id AND agg_type = NEW.agg_type
+        AND start_dt = NEW.start_dt AND end_dt = NEW.end_dt;
+END;
+
+
+-- Assets and periods of changed trades, NULL period means the whole history of the asset.
+-- Triggers here are per row, so each asset keeps one open period widened by them, rather than one per statement.
+CREATE TABLE IF NOT EXISTS trade_changes (
+    id INTEGER PRIMARY KEY,
+    updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    asset_id BIGINT NOT NULL,
+    start_dt TIMESTAMP WITH TIME ZONE,
+    end_dt TIMESTAMP WITH TIME ZONE);
+
+CREATE INDEX IF NOT EXISTS trade_changes_idx_01 ON trade_changes(asset_id);
+
+CREATE TRIGGER IF NOT EXISTS on_trades_insert_change
+AFTER INSERT ON trades FOR EACH ROW
+BEGIN
+    INSERT INTO trade_changes (asset_id, start_dt, end_dt)
+    SELECT NEW.asset_id, NEW.dt, NEW.dt
+    WHERE NOT EXISTS (SELECT NULL FROM trade_changes WHERE asset_id = NEW.asset_id AND start_dt IS NOT NULL);
+
+    UPDATE trade_changes SET start_dt = MIN(start_dt, NEW.dt), end_dt = MAX(end_dt, NEW.dt)
+    WHERE asset_id = NEW.asset_id AND start_dt IS NOT NULL AND (NEW.dt < start_dt OR NEW.dt > end_dt);
+END;
+
+CREATE TRIGGER IF NOT EXISTS on_trades_update_change
+AFTER UPDATE ON trades FOR EACH ROW
+BEGIN
+    INSERT INTO trade_changes (asset_id, start_dt, end_dt)
+    SELECT NEW.asset_id, NEW.dt, NEW.dt
+    WHERE NOT EXISTS (SELECT NULL FROM trade_changes WHERE asset_id = NEW.asset_id AND start_dt IS NOT NULL);
+
+    UPDATE trade_changes SET start_dt = MIN(start_dt, NEW.dt), end_dt = MAX(end_dt, NEW.dt)
+    WHERE asset_id = NEW.asset_id AND start_dt IS NOT NULL AND (NEW.dt < start_dt OR NEW.dt > end_dt);
+END;
+
+CREATE TRIGGER IF NOT EXISTS on_trades_delete_change
+AFTER DELETE ON trades FOR EACH ROW
+BEGIN
+    INSERT INTO trade_changes (asset_id, start_dt, end_dt)
+    SELECT OLD.asset_id, OLD.dt, OLD.dt
+    WHERE NOT EXISTS (SELECT NULL FROM trade_changes WHERE asset_id = OLD.asset_id AND start_dt IS NOT NULL);
+
+    UPDATE trade_changes SET start_dt = MIN(start_dt, OLD.dt), end_dt = MAX(end_dt, OLD.dt)
+    WHERE asset_id = OLD.asset_id AND start_dt IS NOT NULL AND (OLD.dt < start_dt OR OLD.dt > end_dt);
+END;
+
+-- Classification set after insert is not a change, so that of rules change is recorded by metal_rules triggers
+CREATE TRIGGER IF NOT EXISTS on_assets_change
+AFTER UPDATE OF market, code, name, unit ON assets FOR EACH ROW
+WHEN (OLD.market, OLD.code, OLD.name, OLD.unit) IS NOT (NEW.market, NEW.code, NEW.name, NEW.unit)
+BEGIN
+    INSERT INTO trade_changes (asset_id) VALUES (NEW.id);
+END;
+
+-- Metal rules are seeded once, so that rules edited later are kept by the init script run on connect.
+-- Seeded after trade_changes, which their triggers write to.
+INSERT INTO metal_rules (market, code_pattern, name_pattern, dir_pattern, metal)
+SELECT * FROM (VALUES
+    ('SMM', '^SMM-AU-', NULL, NULL, 'Gold'),
+    ('SMM', '^SMM-AG-', NULL, NULL, 'Silver'),
+    ('XCEC', NULL, 'GOLD FUTURES', NULL, 'Gold'),
+    ('XCEC', NULL, 'SILVER FUTURES', NULL, 'Silver'),
+    ('MISX', '^GLDRUB_', NULL, NULL, 'Gold'),
+    ('MISX', '^SLVRUB_', NULL, NULL, 'Silver'),
+    ('CBR', '^METAL1$', NULL, NULL, 'Gold'),
+    ('CBR', '^METAL2$', NULL, NULL, 'Silver'),
+    ('GOZNAK', '^gold(-|$)', NULL, '^.+-([^-]+)$', 'Gold'),
+    ('GOZNAK', '^silver(-|$)', NULL, '^.+-([^-]+)$', 'Silver'),
+    ('SBER', '^A98(-|$)', NULL, '^.+-([^-]+)$', 'Gold'),
+    ('SBER', '^A99(-|$)', NULL, '^.+-([^-]+)$', 'Silver'),
+    ('AVANGARD', '^gold(-|$)', NULL, '^.+-([^-]+)$', 'Gold'))
+WHERE NOT EXISTS (SELECT NULL FROM metal_rules);
+
+
+CREATE VIEW IF NOT EXISTS latest_trades AS
+SELECT updated, asset_id, agg_type, unit, dt, id AS trade_id
+FROM (
+    SELECT *, ROW_NUMBER() OVER (PARTITION BY asset_id, agg_type, unit ORDER BY dt DESC) AS n
+    FROM trades)
+WHERE n = 1;
+
+CREATE VIEW IF NOT EXISTS latest_trade_ids AS
+SELECT trade_id AS id, asset_id
+FROM latest_trades;
+
+
+CREATE VIEW IF NOT EXISTS daily_prices AS
+WITH agg AS (
+    SELECT id, updated, asset_id, dt, c AS price, unit,
+        ROW_NUMBER() OVER (PARTITION BY asset_id, DATE(dt), unit ORDER BY dt DESC) AS n
+    FROM trades
+    WHERE agg_type = 'I'
+)
+SELECT id, updated, asset_id, dt, price, unit FROM agg WHERE n = 1
+UNION ALL
+SELECT id, updated, asset_id, dt, c AS price, unit FROM trades WHERE agg_type = 'D';
+
+
+-- Currency rate assets, used for price conversion
+CREATE VIEW IF NOT EXISTS rate_assets AS
+SELECT a.*
+FROM assets AS a
+WHERE (a.market = 'CBR' AND a.code NOT REGEXP '^METAL')
+    OR (a.market = 'SMM' AND a.code REGEXP '^SMM-EXR-');
+
+-- Daily rates as validity intervals. Text of 'infinity' sorts after any timestamp, as '-infinity' before.
+-- Updated of the rate is added, for metal prices to be stamped by the later of the price and the rate.
+CREATE VIEW IF NOT EXISTS rate_intervals AS
+SELECT
+    t.asset_id AS rate_asset_id,
+    t.dt AS valid_from,
+    COALESCE(LEAD(t.dt) OVER (PARTITION BY t.asset_id ORDER BY t.dt), 'infinity') AS valid_to,
+    t.c AS rate,
+    t.updated
+FROM trades AS t
+JOIN rate_assets AS a
+    ON a.id = t.asset_id
+WHERE t.agg_type = 'D';
+
+
+-- Metal assets, see metal_rules
+CREATE VIEW IF NOT EXISTS metal_assets AS
+SELECT id, updated, market, code, name, metal, unit, dir, grams
+FROM assets
+WHERE metal IS NOT NULL;
+
+-- Daily prices of metal assets with grams of the price unit, shared by bar and metal price views
+CREATE VIEW IF NOT EXISTS metal_daily_prices AS
+SELECT
+    p.id,
+    p.updated,
+    p.asset_id,
+    a.market,
+    a.code,
+    a.name,
+    a.metal,
+    a.dir,
+    p.dt,
+    p.price,
+    p.unit,
+    CASE WHEN p.unit IS NULL THEN a.grams WHEN p.unit REGEXP '^[0-9.]+$' THEN CAST(p.unit AS DECIMAL) END AS grams
+FROM daily_prices AS p
+JOIN metal_assets AS a
+    ON a.id = p.asset_id;
+
+
+-- Metal bar prices
+CREATE VIEW IF NOT EXISTS bar_prices AS
+SELECT id, asset_id, market, code, name, metal, dir, dt, price, ROUND(price / grams, 4) AS price_g, grams
+FROM metal_daily_prices
+WHERE market IN ('GOZNAK', 'SBER', 'AVANGARD')
+    AND grams IS NOT NULL
+    AND price > 0;
+
+-- Latest metal bar prices
+CREATE VIEW IF NOT EXISTS latest_bar_prices AS
+SELECT p.id, p.asset_id, p.market, p.code, p.name, p.metal, p.dir, p.dt, p.price, p.price_g, p.grams
+FROM latest_trades AS l
+JOIN bar_prices AS p
+    ON p.id = l.trade_id
+WHERE l.agg_type IN ('D', 'I');
+
+
+-- Metal prices per ounce in USD, to_price_in_oz() inlined as price * 31.103477 / grams
+CREATE VIEW IF NOT EXISTS metal_prices AS
+WITH rates AS (
+    SELECT r.*, a.market AS rate_market, a.code AS rate_code
+    FROM rate_intervals AS r
+    JOIN assets AS a
+        ON a.id = r.rate_asset_id
+    WHERE (a.market = 'SMM' AND a.code = 'SMM-EXR-003')
+        OR (a.market = 'CBR' AND a.code = 'R01235')
+),
+-- Shanghai Metals Market prices, excluding VAT, as SMM itself does when converting from CNY to USD
+smm AS (
+    SELECT p.id, p.asset_id, p.market, p.code, p.name, p.metal, p.dt,
+        ROUND(p.price * 31.103477 / CASE p.unit WHEN 'yuan/kg' THEN 1000 WHEN 'yuan/g' THEN 1 END / r.rate / (1 + 0.13), 4) AS price_oz,
+        MAX(p.updated, r.updated) AS updated
+    FROM metal_daily_prices AS p
+    JOIN rates AS r
+        ON r.rate_market = 'SMM'
+        AND p.dt >= r.valid_from
+        AND p.dt < r.valid_to
+    WHERE p.market = 'SMM'
+        AND p.unit IN ('yuan/kg', 'yuan/g')
+),
+-- COMEX metal prices
+xcec AS (
+    SELECT p.id, p.asset_id, p.market, p.code, p.name, p.metal, p.dt, p.price AS price_oz, p.updated
+    FROM metal_daily_prices AS p
+    WHERE p.market = 'XCEC'
+        AND p.unit IS NULL
+),
+-- Moscow Exchange, CBR, and Goznak, Sberbank, Avangard metal bar prices
+rub AS (
+    SELECT p.id, p.asset_id, p.market, p.code, p.name, p.metal, p.dt,
+        ROUND(CASE p.price_grams
+            WHEN 31.1 THEN p.price
+            WHEN 15.55 THEN p.price * 2
+            WHEN 7.78 THEN p.price * 4
+            WHEN 3.11 THEN p.price * 10
+            ELSE p.price * 31.103477 / p.price_grams
+        END / r.rate, 4) AS price_oz,
+        MAX(p.updated, r.updated) AS updated
+    FROM (
+        SELECT *, CASE WHEN market IN ('MISX', 'CBR') THEN 1 ELSE grams END AS price_grams
+        FROM metal_daily_prices) AS p
+    JOIN rates AS r
+        ON r.rate_market = 'CBR'
+        AND p.dt >= r.valid_from
+        AND p.dt < r.valid_to
+    WHERE p.market IN ('MISX', 'CBR')
+        OR (p.market IN ('GOZNAK', 'SBER', 'AVANGARD') AND p.grams IS NOT NULL AND p.price > 0)
+)
+SELECT * FROM smm
+UNION ALL
+SELECT * FROM xcec
+UNION ALL
+SELECT * FROM rub;
+
+
+-- Raw intraday trades rolled into daily ones by compact_intraday_trades, if asked to keep them
+CREATE TABLE IF NOT EXISTS trades_archive (
+    id INTEGER,
+    updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    asset_id BIGINT NOT NULL,
+    agg_type VARCHAR(15) NOT NULL,
+    dt TIMESTAMP WITH TIME ZONE NOT NULL,
+    o DECIMAL(20, 4),
+    h DECIMAL(20, 4),
+    l DECIMAL(20, 4),
+    c DECIMAL(20, 4),
+    v BIGINT,
+    unit VARCHAR(15));
+
+
+-- Derived tables are plain views, so refresh just consumes trade changes
+INSERT OR REPLACE INTO procedures (name, body) VALUES ('refresh_full', 'DELETE FROM trade_changes;');
+INSERT OR REPLACE INTO procedures (name, body) VALUES ('refresh_incremental', 'DELETE FROM trade_changes;');
+
+-- Counterpart of compact_intraday_trades() function, called with the same arguments:
+-- asset id, start and end of the period, ohlc and archive flags. Selects added and removed counts at last.
+INSERT OR REPLACE INTO procedures (name, body) VALUES ('compact_intraday_trades', '
+CREATE TEMPORARY TABLE IF NOT EXISTS compact_counts (added_count BIGINT, removed_count BIGINT);
+DELETE FROM temp.compact_counts;
+
+WITH ranked AS (
+    SELECT t.*,
+        ROW_NUMBER() OVER (PARTITION BY DATE(t.dt), t.unit ORDER BY t.dt) AS first_n,
+        ROW_NUMBER() OVER (PARTITION BY DATE(t.dt), t.unit ORDER BY t.dt DESC) AS last_n
+    FROM trades AS t
+    WHERE t.asset_id = :arg1
+        AND t.agg_type = ''I''
+        AND t.dt >= :arg2
+        AND t.dt < :arg3
+),
+days AS (
+    SELECT
+        DATE(dt) AS d,
+        unit,
+        MAX(dt) AS dt,
+        MAX(CASE WHEN first_n = 1 THEN COALESCE(o, c) END) AS o,
+        MAX(COALESCE(h, c)) AS h,
+        MIN(COALESCE(l, c)) AS l,
+        MAX(CASE WHEN last_n = 1 THEN c END) AS c,
+        SUM(v) AS v
+    FROM ranked
+    GROUP BY DATE(dt), unit
+)
+INSERT INTO trades (asset_id, agg_type, dt, o, h, l, c, v, unit)
+SELECT
+    :arg1,
+    ''D'',
+    x.dt,
+    CASE WHEN :arg4 THEN x.o END,
+    CASE WHEN :arg4 THEN x.h END,
+    CASE WHEN :arg4 THEN x.l END,
+    x.c,
+    CASE WHEN :arg4 THEN x.v END,
+    x.unit
+FROM days AS x
+WHERE NOT EXISTS (
+    SELECT NULL FROM trades AS t
+    WHERE t.asset_id = :arg1
+        AND t.agg_type = ''D''
+        AND t.unit IS x.unit
+        AND DATE(t.dt) = x.d);
+
+INSERT INTO temp.compact_counts (added_count) SELECT CHANGES();
+
+INSERT INTO trades_archive
+SELECT * FROM trades
+WHERE :arg5
+    AND asset_id = :arg1
+    AND agg_type = ''I''
+    AND dt >= :arg2
+    AND dt < :arg3;
+
+DELETE FROM trades
+WHERE asset_id = :arg1
+    AND agg_type = ''I''
+    AND dt >= :arg2
+    AND dt < :arg3;
+
+UPDATE temp.compact_counts SET removed_count = CHANGES();
+
+SELECT added_count, removed_count FROM temp.compact_counts;
+');